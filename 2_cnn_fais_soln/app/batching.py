@@ -0,0 +1,79 @@
+import asyncio
+import numpy as np
+from typing import Any, Callable, List, Optional, Tuple
+from app.config import SEARCH_BATCH_MAX_SIZE, SEARCH_BATCH_MAX_WAIT_MS
+from app.executors import run_in_stage
+
+
+class MicroBatcher:
+    """
+    Collects concurrent embedding requests for one model and runs them as a
+    single batched forward pass.
+
+    `batch_fn` takes a list of inputs (PIL images or strings) and returns an
+    (N, D) matrix, e.g. `extract_embeddings_batch`. Callers `await submit(x)`
+    and get back their own row.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], np.ndarray],
+        name: str,
+        max_batch_size: int = SEARCH_BATCH_MAX_SIZE,
+        max_wait_ms: float = SEARCH_BATCH_MAX_WAIT_MS,
+    ):
+        self.batch_fn = batch_fn
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, item: Any) -> np.ndarray:
+        """Queue one input and wait for its embedding."""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            # Callers that were cancelled while waiting don't need a forward pass
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            items = [item for item, _ in batch]
+            try:
+                # While this batch runs, new requests keep queueing up for the next one
+                embs = await run_in_stage("inference", self.batch_fn, items)
+            except Exception as e:
+                print(f"[{self.name}] batched inference failed for {len(items)} inputs: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), emb in zip(batch, embs):
+                if not future.done():
+                    future.set_result(emb)
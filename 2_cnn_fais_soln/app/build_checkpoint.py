@@ -0,0 +1,172 @@
+import os
+import json
+import shutil
+import numpy as np
+from typing import Dict, Iterator, List, Optional
+from app.config import BUILD_CHECKPOINT_DIR
+
+
+def _fsync_append(path: str, data: bytes) -> int:
+    """Append `data` to `path`, fsync it and return the new file size."""
+    with open(path, "ab") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+class BuildCheckpoint:
+    """
+    Durable progress of one index build, kept in BUILD_CHECKPOINT_DIR/<name>.
+
+    Vectors go straight into one preallocated, memory-mapped float32 matrix
+    per model (`capacity` rows, the most the build can produce), so a build
+    never holds more than a batch of vectors in RAM. Every committed batch
+    writes its rows there and appends its metadata docs to metadata.jsonl,
+    syncs both to disk, then atomically rewrites state.json with the offset of
+    the next input record and the number of committed rows. On resume, rows
+    and metadata written after the last state.json are ignored / truncated.
+
+    `signature` describes the build input (source file, record count, models...);
+    a checkpoint with a different signature is discarded instead of resumed.
+    Builds that write their vectors elsewhere (Chroma) pass no dims.
+    """
+
+    def __init__(self, name: str, dims: Dict[str, int], signature: Dict, capacity: int = 0):
+        self.name = name
+        self.dims = dims
+        self.signature = signature
+        self.capacity = capacity
+        self.dir = os.path.join(BUILD_CHECKPOINT_DIR, name)
+        self.state_path = os.path.join(self.dir, "state.json")
+        self.metadata_path = os.path.join(self.dir, "metadata.jsonl")
+        self.next_offset = 0
+        self.num_rows = 0
+        self._metadata_bytes = 0
+        self._vectors: Dict[str, np.memmap] = {}
+
+    def _vectors_path(self, model_name: str) -> str:
+        return os.path.join(self.dir, f"{model_name}.f32")
+
+    def _write_state(self):
+        state = {
+            "signature": self.signature,
+            "next_offset": self.next_offset,
+            "num_rows": self.num_rows,
+            "metadata_bytes": self._metadata_bytes,
+        }
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    def _load_state(self) -> Optional[Dict]:
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if state.get("signature") != self.signature:
+            print(f"Checkpoint {self.dir} was made for a different input, starting over.")
+            return None
+        return state
+
+    def resume(self) -> int:
+        """
+        Restore the last committed state (or start a fresh checkpoint) and
+        return the offset of the first input record that still has to be processed.
+        """
+        state = self._load_state()
+        if state is None:
+            self.clear()
+            os.makedirs(self.dir, exist_ok=True)
+            self._open_vectors("w+")
+            self._write_state()
+            return 0
+
+        self.next_offset = state["next_offset"]
+        self.num_rows = state["num_rows"]
+        self._metadata_bytes = state["metadata_bytes"]
+        self._open_vectors("r+")
+
+        # Drop whatever a killed batch managed to append after the last commit
+        open(self.metadata_path, "ab").close()
+        os.truncate(self.metadata_path, self._metadata_bytes)
+
+        print(f"Resuming {self.name} from record {self.next_offset} ({self.num_rows} rows committed).")
+        return self.next_offset
+
+    def _open_vectors(self, mode: str):
+        # Files are sparse until rows are written, preallocating costs no disk up front
+        self._vectors = {
+            model_name: np.memmap(
+                self._vectors_path(model_name), dtype="float32", mode=mode, shape=(max(self.capacity, 1), dim)
+            )
+            for model_name, dim in self.dims.items()
+        }
+
+    def commit(self, next_offset: int, vectors: Dict[str, np.ndarray], metadata_docs: List[Dict]):
+        """
+        Durably append one batch and advance the resume point to `next_offset`.
+        A batch with no metadata docs (nothing could be embedded) only moves the offset.
+        """
+        if metadata_docs:
+            rows = slice(self.num_rows, self.num_rows + len(metadata_docs))
+            for model_name, matrix in self._vectors.items():
+                matrix[rows] = vectors[model_name]
+                matrix.flush()
+            data = "".join(json.dumps(doc) + "\n" for doc in metadata_docs).encode("utf-8")
+            self._metadata_bytes = _fsync_append(self.metadata_path, data)
+        self.num_rows += len(metadata_docs)
+        self.next_offset = next_offset
+        self._write_state()
+
+    def vectors(self, model_name: str) -> np.ndarray:
+        """All committed vectors of `model_name`, an (num_rows, dim) view of the memory-mapped matrix."""
+        return self._vectors[model_name][:self.num_rows]
+
+    def move_vectors(self, model_name: str, path: str):
+        """
+        Publish the committed vectors of `model_name` as the raw float32 file
+        `path` without copying them: the preallocated file is cut to num_rows
+        and renamed (copied only if `path` is on another filesystem).
+        """
+        matrix = self._vectors.pop(model_name)
+        matrix.flush()
+        del matrix
+        source = self._vectors_path(model_name)
+        os.truncate(source, self.num_rows * self.dims[model_name] * 4)
+        shutil.move(source, path)
+
+    def metadata_docs(self) -> Iterator[Dict]:
+        with open(self.metadata_path, "r") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def clear(self):
+        """Remove the checkpoint once its build has been published."""
+        self._vectors = {}
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def publish_metadata(collection, docs: Iterator[Dict], index_field: str = "faiss_id", chunk_size: int = 1000):
+    """
+    Replace the contents of a Mongo collection without an empty window:
+    docs go to a staging collection that is then renamed over `collection`.
+    """
+    staging = collection.database[f"{collection.name}_staging"]
+    staging.drop()
+
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) == chunk_size:
+            staging.insert_many(chunk)
+            chunk = []
+    if chunk:
+        staging.insert_many(chunk)
+
+    staging.create_index(index_field)
+    staging.rename(collection.name, dropTarget=True)
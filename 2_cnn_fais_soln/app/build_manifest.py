@@ -0,0 +1,175 @@
+import os
+import json
+import hashlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from app.config import BUILD_MANIFEST_DIR, LOADER_WORKERS
+
+
+def _file_sha1(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageManifest:
+    """
+    What an index currently contains: image_id -> {"hash", "size", "mtime",
+    "item_id", "image_path", "model"}, saved as JSON in BUILD_MANIFEST_DIR/<name>.json.
+    `model` is the `model_version` the stored vector was made with.
+    """
+
+    def __init__(self, name: str, entries: Optional[Dict[str, Dict]] = None):
+        self.name = name
+        self.path = os.path.join(BUILD_MANIFEST_DIR, f"{name}.json")
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls, name: str) -> "ImageManifest":
+        manifest = cls(name)
+        try:
+            with open(manifest.path, "r") as f:
+                manifest.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        return manifest
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def save(self):
+        os.makedirs(BUILD_MANIFEST_DIR, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def fingerprint_images(records: Iterable[Dict], images_folder: str, known: List[ImageManifest]) -> Dict[str, Dict]:
+    """
+    Content hash of every image file in `records`, keyed by image_id.
+    Files whose size and mtime match an entry of a `known` manifest reuse its
+    hash, so only new or touched files are read. Missing files are left out.
+    `records` is consumed once, so it can be a stream (see `iter_json_array`).
+    """
+    cached = {}
+    for manifest in known:
+        cached.update(manifest.entries)
+
+    def fingerprint(record: Dict) -> Optional[Tuple[str, Dict]]:
+        image_id = str(record["image_id"])
+        path = os.path.join(images_folder, record["image_path"])
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        entry = {
+            "size": st.st_size,
+            "mtime": st.st_mtime_ns,
+            "item_id": record["item_id"],
+            "image_path": record["image_path"],
+        }
+        old = cached.get(image_id)
+        if old and old["size"] == entry["size"] and old["mtime"] == entry["mtime"]:
+            entry["hash"] = old["hash"]
+        else:
+            entry["hash"] = _file_sha1(path)
+        return image_id, entry
+
+    fingerprints = {}
+    records = iter(records)
+    with ThreadPoolExecutor(max_workers=LOADER_WORKERS, thread_name_prefix="image-hash") as pool:
+        # Executor.map takes its whole input at once; feed it in chunks to keep the stream a stream
+        while True:
+            chunk = list(itertools.islice(records, 4096))
+            if not chunk:
+                return fingerprints
+            fingerprints.update(fp for fp in pool.map(fingerprint, chunk) if fp is not None)
+
+
+def is_current(entry: Optional[Dict], fingerprint: Dict, model: str) -> bool:
+    """True when a manifest entry still describes the image and was embedded with `model`."""
+    return (
+        entry is not None
+        and entry["hash"] == fingerprint["hash"]
+        and entry["model"] == model
+        and entry["item_id"] == fingerprint["item_id"]
+        and entry["image_path"] == fingerprint["image_path"]
+    )
+
+
+def diff_manifest(
+    fingerprints: Dict[str, Dict],
+    manifest: ImageManifest,
+    model: str,
+) -> Tuple[Set[str], List[str], List[str]]:
+    """
+    Compare the current image set with what `manifest` says an index holds.
+    Returns (image_ids to embed, image_ids to keep as they are, image_ids to drop).
+    Changed images are both embedded and dropped; images whose file is gone are dropped.
+    """
+    to_embed, keep = set(), []
+    for image_id, fingerprint in fingerprints.items():
+        if is_current(manifest.entries.get(image_id), fingerprint, model):
+            keep.append(image_id)
+        else:
+            to_embed.add(image_id)
+    keep_set = set(keep)
+    drop = [image_id for image_id in manifest.entries if image_id not in keep_set]
+    return to_embed, keep, drop
+
+
+def plan_image_build(
+    records: Iterable[Dict],
+    images_folder: str,
+    manifests: Dict[str, ImageManifest],
+    models: Dict[str, str],
+    incremental: bool,
+) -> Tuple[Set[str], Dict[str, List[str]], Dict[str, Dict]]:
+    """
+    Work out what a build over `records` has to do for several targets at once
+    (`manifests` and `models` are keyed by target, `models` holding each
+    target's model_version). Every image is decoded once for all targets, so an
+    image that is new or changed for any target is re-embedded for all of them.
+
+    Returns (image_ids to embed, image_ids each target keeps from its current
+    index, fingerprints of the current files). Without `incremental` nothing is kept.
+    Pick the records to embed from a fresh stream with `select_records`.
+    """
+    fingerprints = fingerprint_images(records, images_folder, list(manifests.values()))
+    if not incremental:
+        return set(fingerprints), {target: [] for target in manifests}, fingerprints
+
+    keep = {}
+    todo_ids = set()
+    for target, manifest in manifests.items():
+        to_embed, keep[target], _ = diff_manifest(fingerprints, manifest, models[target])
+        todo_ids |= to_embed
+
+    keep = {target: [image_id for image_id in ids if image_id not in todo_ids] for target, ids in keep.items()}
+    return todo_ids, keep, fingerprints
+
+
+def select_records(records: Iterable[Dict], image_ids: Set[str]) -> Iterator[Dict]:
+    """The records of `image_ids`, in input order, each image_id once."""
+    pending = set(image_ids)
+    for record in records:
+        image_id = str(record["image_id"])
+        if image_id in pending:
+            pending.discard(image_id)
+            yield record
+
+
+def ids_digest(image_ids: Set[str]) -> str:
+    """Short digest of which images a build embeds, part of its checkpoint signature."""
+    digest = hashlib.sha1()
+    for image_id in sorted(image_ids):
+        digest.update(image_id.encode("utf-8") + b"\n")
+    return digest.hexdigest()
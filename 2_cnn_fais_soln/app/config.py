@@ -28,4 +28,116 @@ gemini_api_key = os.getenv("GEMINI_API_KEY")
 
 CHROMA_CNN_EMBEDDINGS_COLLECTION = "cnn_embeddings"
 CHROMA_CLIP_IMAGE_EMBEDDINGS_COLLECTION = "clip_image_embeddings"
-CHROMA_CLIP_ITEM_EMBEDDINGS_COLLECTION = "clip_item_embeddings"
\ No newline at end of file
+CHROMA_CLIP_ITEM_EMBEDDINGS_COLLECTION = "clip_item_embeddings"
+# Image candidates re-scored with the item text vectors in image+text search
+HYBRID_CANDIDATE_K = int(os.getenv("HYBRID_CANDIDATE_K", "100"))
+# Group-by-item search: image hits fetched per wanted item on the first try,
+# and the most hits a widened scan may fetch
+GROUP_OVERFETCH = int(os.getenv("GROUP_OVERFETCH", "4"))
+GROUP_MAX_FETCH = int(os.getenv("GROUP_MAX_FETCH", "1000"))
+# Category partitions: image builds also write one sub-index per product
+# category with at least CATEGORY_PARTITION_MIN_SIZE images. Queries are routed
+# by CLIP zero-shot classification against CATEGORY_PROMPT embeddings to the
+# most likely categories covering CATEGORY_ROUTE_MIN_CONFIDENCE of the
+# probability (at most CATEGORY_ROUTE_MAX_PARTITIONS), else the global index
+FAISS_CATEGORY_PARTITIONS = os.getenv("FAISS_CATEGORY_PARTITIONS", "0") == "1"
+CATEGORY_PARTITION_MIN_SIZE = int(os.getenv("CATEGORY_PARTITION_MIN_SIZE", "256"))
+CATEGORY_PROMPT = os.getenv("CATEGORY_PROMPT", "a photo of {} jewelry")
+CATEGORY_ROUTE_MIN_CONFIDENCE = float(os.getenv("CATEGORY_ROUTE_MIN_CONFIDENCE", "0.6"))
+CATEGORY_ROUTE_MAX_PARTITIONS = int(os.getenv("CATEGORY_ROUTE_MAX_PARTITIONS", "2"))
+# Item-centroid index: image builds also write one normalized mean vector per
+# item_id ("<index>.items"). Group-by-item FAISS searches then take
+# ITEM_CANDIDATE_FACTOR * top_k items from it and re-rank only their images
+FAISS_ITEM_CENTROIDS = os.getenv("FAISS_ITEM_CENTROIDS", "0") == "1"
+ITEM_CANDIDATE_FACTOR = int(os.getenv("ITEM_CANDIDATE_FACTOR", "4"))
+# SIFT re-ranking of CNN results: the top SIFT_RERANK_TOP_N candidates are
+# geometrically verified (ratio test + RANSAC homography) against SIFT features
+# cached at build time, within SIFT_RERANK_BUDGET_MS per request. Images are
+# scaled to SIFT_MAX_IMAGE_SIDE and keep their SIFT_MAX_DESCRIPTORS strongest
+# keypoints; a candidate gains SIFT_RERANK_WEIGHT * inliers / query keypoints
+SIFT_RERANK_TOP_N = int(os.getenv("SIFT_RERANK_TOP_N", "20"))
+SIFT_RERANK_BUDGET_MS = float(os.getenv("SIFT_RERANK_BUDGET_MS", "150"))
+SIFT_MAX_DESCRIPTORS = int(os.getenv("SIFT_MAX_DESCRIPTORS", "500"))
+SIFT_MAX_IMAGE_SIDE = int(os.getenv("SIFT_MAX_IMAGE_SIDE", "512"))
+SIFT_RATIO = float(os.getenv("SIFT_RATIO", "0.75"))
+SIFT_RERANK_WEIGHT = float(os.getenv("SIFT_RERANK_WEIGHT", "0.5"))
+# CNN+SIFT hybrid index: visual word codebook of SIFT_CODEBOOK_K centroids,
+# trained by FAISS k-means on SIFT_CODEBOOK_TRAIN_SIZE reservoir-sampled descriptors
+SIFT_CODEBOOK_K = int(os.getenv("SIFT_CODEBOOK_K", "256"))
+SIFT_CODEBOOK_TRAIN_SIZE = int(os.getenv("SIFT_CODEBOOK_TRAIN_SIZE", "262144"))
+SIFT_KMEANS_NITER = int(os.getenv("SIFT_KMEANS_NITER", "20"))
+# Upper edges of the price bands offered as a search filter ("0-100", ..., "1000+")
+PRICE_BANDS = [float(edge) for edge in os.getenv("PRICE_BANDS", "100,250,500,1000").split(",") if edge.strip()]
+
+# Max number of images / texts pushed through a model in one forward pass
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+
+# Micro-batching of concurrent /search/ queries: a batch is flushed when it
+# reaches SEARCH_BATCH_MAX_SIZE or after SEARCH_BATCH_MAX_WAIT_MS
+SEARCH_BATCH_MAX_SIZE = int(os.getenv("SEARCH_BATCH_MAX_SIZE", "32"))
+SEARCH_BATCH_MAX_WAIT_MS = float(os.getenv("SEARCH_BATCH_MAX_WAIT_MS", "5"))
+
+# Thread pools used to keep blocking work off the event loop, sized per stage.
+# EXECUTOR_MAX_PENDING bounds how many calls may wait on one stage at a time.
+INFERENCE_EXECUTOR_WORKERS = int(os.getenv("INFERENCE_EXECUTOR_WORKERS", "1"))
+DECODE_EXECUTOR_WORKERS = int(os.getenv("DECODE_EXECUTOR_WORKERS", "4"))
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "8"))
+IO_EXECUTOR_WORKERS = int(os.getenv("IO_EXECUTOR_WORKERS", "2"))
+SEARCH_EXECUTOR_WORKERS = int(os.getenv("SEARCH_EXECUTOR_WORKERS", "4"))
+EXECUTOR_MAX_PENDING = int(os.getenv("EXECUTOR_MAX_PENDING", "256"))
+# OpenCV SIFT matching runs in worker processes instead (query re-ranking / index builds)
+SIFT_EXECUTOR_WORKERS = int(os.getenv("SIFT_EXECUTOR_WORKERS", "2"))
+SIFT_BUILD_WORKERS = int(os.getenv("SIFT_BUILD_WORKERS", str(os.cpu_count() or 2)))
+
+# Models are loaded lazily on first use. ENABLED_MODELS ("cnn", "clip", comma
+# separated) are preloaded when the API starts; with MODEL_FAST_START=1 that
+# preload runs in the background so the worker starts serving immediately.
+ENABLED_MODELS = [name.strip() for name in os.getenv("ENABLED_MODELS", "cnn,clip").split(",") if name.strip()]
+MODEL_FAST_START = os.getenv("MODEL_FAST_START", "0") == "1"
+# Ready-to-run model artifacts are cached here after the first load
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "../data/model_cache")
+
+# Inference backend for the embedding models: "eager", "torchscript" or "onnx".
+# TorchScript / ONNX artifacts are exported once into MODEL_CACHE_DIR.
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")
+ONNX_NUM_THREADS = int(os.getenv("ONNX_NUM_THREADS", "0"))  # 0 = let onnxruntime decide
+
+# Embedding model precision: "fp32" or "int8" (statically quantized ResNet50,
+# dynamically quantized CLIP). Check recall with tests/validate_quantization.py
+# before switching a deployment to int8.
+MODEL_PRECISION = os.getenv("MODEL_PRECISION", "fp32")
+QUANT_CALIBRATION_IMAGES = int(os.getenv("QUANT_CALIBRATION_IMAGES", "128"))
+
+# Index builders: image decode/preprocess threads and how many ready batches
+# (of EMBEDDING_BATCH_SIZE images) may wait in the queue for inference
+LOADER_WORKERS = int(os.getenv("LOADER_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+LOADER_PREFETCH_BATCHES = int(os.getenv("LOADER_PREFETCH_BATCHES", "4"))
+
+# Image index builds checkpoint every batch here and resume from the last
+# checkpoint after a crash; the checkpoint is removed once the build is published
+BUILD_CHECKPOINT_DIR = os.getenv("BUILD_CHECKPOINT_DIR", "../data/build_checkpoints")
+
+# Per-index manifests (image_id -> content hash + model version) that let the
+# image builders re-embed only new or changed images
+BUILD_MANIFEST_DIR = os.getenv("BUILD_MANIFEST_DIR", "../data/build_manifests")
+
+# FAISS index type built for the image / text indexes, as a faiss.index_factory
+# spec: "Flat" (exact), "IVF4096,Flat" (inverted lists, trained coarse
+# quantizer) or "HNSW32" (graph, M=32). Inner-product metric in all cases.
+FAISS_INDEX_SPEC = os.getenv("FAISS_INDEX_SPEC", "Flat")
+FAISS_HNSW_EF_CONSTRUCTION = int(os.getenv("FAISS_HNSW_EF_CONSTRUCTION", "200"))
+# Rows sampled from the catalog to train IVF quantizers (aim for >= 39 * nlist)
+FAISS_TRAIN_SIZE = int(os.getenv("FAISS_TRAIN_SIZE", "65536"))
+# Query-time knobs stored next to a new index and restored by load_index
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+# Compressed specs ("IVF4096,PQ64", "OPQ64,IVF4096,PQ64") keep only PQ codes in
+# RAM; the top FAISS_RERANK_K candidates are re-scored exactly from the
+# original vectors on disk, so scores stay comparable with a Flat index
+FAISS_RERANK_K = int(os.getenv("FAISS_RERANK_K", "100"))
+
+# Load FAISS indexes memory-mapped and read-only, so all uvicorn workers on a
+# box share the page cache instead of each reading a private copy. IVF indexes
+# are then saved with their inverted lists in a separate "<index>.<n>.ivfdata"
+# file. Processes that add to an index (AddController) need load_index(..., mmap=False).
+FAISS_MMAP = os.getenv("FAISS_MMAP", "0") == "1"
@@ -1,24 +1,31 @@
 import os
+import asyncio
 import string
 import secrets
 from fastapi import UploadFile, HTTPException
 from PIL import Image
 from bson import ObjectId
-from app.model import extract_embedding, extract_clip_embedding
+from app.model import extract_multi_embeddings_batch
 from app.db.mongo import products_col, embedding_cnn_faiss_metadata_col, embedding_clip_faiss_metadata_col
-from app.search import save_index
+from app.search import save_index, faiss_id, faiss_ids, add_vectors
 from app.config import SHOE_IMAGES_FOLDER, FAISS_INDEX_PATH, CLIP_FAISS_INDEX_PATH
+from app.executors import run_in_stage
+from app.metadata_table import MetadataTable
 
 class AddController:
     def __init__(
         self,
         faiss_cnn_index, 
-        faiss_clip_index
+        faiss_clip_index,
+        cnn_metadata: MetadataTable = None,
+        clip_metadata: MetadataTable = None,
     ):
         self.faiss_cnn_index = faiss_cnn_index
         self.faiss_clip_index = faiss_clip_index
-        self.extract_embedding = extract_embedding
-        self.extract_clip_embedding = extract_clip_embedding
+        # In-memory metadata tables of the search services, updated with every add
+        self.cnn_metadata = cnn_metadata
+        self.clip_metadata = clip_metadata
+        self.extract_multi_embeddings = extract_multi_embeddings_batch
         self.save_index = save_index
         self.images_folder = SHOE_IMAGES_FOLDER  # e.g. "../data/shoe_images"
         self.products_col = products_col
@@ -27,6 +34,9 @@ class AddController:
         self.faiss_cnn_index_path = FAISS_INDEX_PATH
         self.faiss_clip_index_path = CLIP_FAISS_INDEX_PATH
         self.embedding_metadata = []  # Initialize or load from file if needed
+        # One writer per index: faiss can't add to an index while it is being
+        # serialized, and two saves of the same index must not overlap
+        self._index_locks = {"cnn": asyncio.Lock(), "clip": asyncio.Lock()}
 
     def _generate_image_id(self, length=7):
         alphabet = string.ascii_uppercase + string.digits
@@ -41,107 +51,71 @@ class AddController:
         other_images: list = None,
     ):
         # Check if item_id already exists in products collection
-        if self.products_col.find_one({"item_id": item_id}):
+        if await run_in_stage("db", self.products_col.find_one, {"item_id": item_id}):
             raise HTTPException(status_code=400, detail=f"Product with item_id '{item_id}' already exists")
 
         if not main_image.content_type.startswith("image/"):
             raise HTTPException(status_code=400, detail="Main image must be an image")
 
-        main_image_id = item_id + self._generate_image_id()
-        main_image_path = await self._save_image(main_image, main_image_id)
+        other_images = other_images or []
+        for img_file in other_images:
+            if not img_file.content_type.startswith("image/"):
+                raise HTTPException(status_code=400, detail="One of the other images is not an image")
 
-        # Open image once
-        with Image.open(main_image_path) as img:
-            image_rgb = img.convert("RGB")
+        # Save every image first; the main image is row 0 of all the batches below
+        image_ids = []
+        image_paths = []
+        for img_file in [main_image] + other_images:
+            img_id = item_id + self._generate_image_id()
+            image_ids.append(img_id)
+            image_paths.append(await self._save_image(img_file, img_id))
 
-            # Extract embeddings
-            main_image_emb_cnn = self.extract_embedding(image_rgb)
-            main_image_emb_clip = self.extract_clip_embedding(image_rgb)
-
-        main_image_rel_path = self._get_relative_image_path(main_image_path)
-
-        # Add embeddings to FAISS indexes and get new indices
-        main_faiss_index_cnn = self.faiss_cnn_index.ntotal
-        self.faiss_cnn_index.add(main_image_emb_cnn.reshape(1, -1))
-
-        main_faiss_index_clip = self.faiss_clip_index.ntotal
-        self.faiss_clip_index.add(main_image_emb_clip.reshape(1, -1))
+        # Decode each image once and embed all of them with CNN and CLIP in one pass
+        images = await run_in_stage("decode", self._decode_image_files, image_paths)
+        embeddings = await run_in_stage("inference", self.extract_multi_embeddings, images, ("cnn", "clip"))
 
         # Prepare metadata documents
-        main_image_meta_cnn = {
-            "faiss_index": main_faiss_index_cnn,
-            "image_id": main_image_id,
-            "image_path": main_image_rel_path,
-            "item_id": item_id,
-        }
-        main_image_meta_clip = {
-            "faiss_index": main_faiss_index_clip,
-            "image_id": main_image_id,
-            "image_path": main_image_rel_path,
-            "item_id": item_id,
-        }
-
-        # --- Other images ---
-        other_image_metas_cnn = []
-        other_image_metas_clip = []
-
-        if other_images:
-            for img_file in other_images:
-                if not img_file.content_type.startswith("image/"):
-                    raise HTTPException(status_code=400, detail="One of the other images is not an image")
-                img_id = item_id + self._generate_image_id()
-                img_path = await self._save_image(img_file, img_id)
-
-                with Image.open(img_path) as img:
-                    image_rgb = img.convert("RGB")
-                    emb_cnn = self.extract_embedding(image_rgb)
-                    emb_clip = self.extract_clip_embedding(image_rgb)
-
-                img_rel_path = self._get_relative_image_path(img_path)
-
-                faiss_index_cnn = self.faiss_cnn_index.ntotal
-                self.faiss_cnn_index.add(emb_cnn.reshape(1, -1))
-                # because the faiss.add takes in batches and we are adding single embedding so from [d] to [1,d] reshaped the ndarray
-
-                faiss_index_clip = self.faiss_clip_index.ntotal
-                self.faiss_clip_index.add(emb_clip.reshape(1, -1))
-
-                other_image_metas_cnn.append({
-                    "faiss_index": faiss_index_cnn,
-                    "image_id": img_id,
-                    "image_path": img_rel_path,
-                    "item_id": item_id,
-                })
-                other_image_metas_clip.append({
-                    "faiss_index": faiss_index_clip,
-                    "image_id": img_id,
-                    "image_path": img_rel_path,
-                    "item_id": item_id,
-                })
-
-        # Insert metadata into MongoDB
-        self.embedding_cnn_faiss_metadata_col.insert_many([main_image_meta_cnn] + other_image_metas_cnn)
-        self.embedding_clip_faiss_metadata_col.insert_many([main_image_meta_clip] + other_image_metas_clip)
-
-        # Save updated FAISS indexes
-        self.save_index(self.faiss_cnn_index, self.faiss_cnn_index_path)
-        self.save_index(self.faiss_clip_index, self.faiss_clip_index_path)
+        image_metas = []
+        for img_id, img_path in zip(image_ids, image_paths):
+            image_metas.append({
+                "faiss_id": faiss_id(img_id),
+                "image_id": img_id,
+                "image_path": self._get_relative_image_path(img_path),
+                "item_id": item_id,
+            })
+
+        # Add embeddings to FAISS indexes under ids derived from the image ids,
+        # so nothing depends on ntotal or on the order concurrent requests add in
+        ids = faiss_ids(image_ids)
+        targets = (
+            ("cnn", self.faiss_cnn_index, self.faiss_cnn_index_path, self.embedding_cnn_faiss_metadata_col, self.cnn_metadata),
+            ("clip", self.faiss_clip_index, self.faiss_clip_index_path, self.embedding_clip_faiss_metadata_col, self.clip_metadata),
+        )
+        for name, index, index_path, metadata_col, table in targets:
+            async with self._index_locks[name]:
+                add_vectors(index, ids, embeddings[name])
+                # insert_many sets _id on the docs it gets, so each collection gets its own copies
+                await run_in_stage("db", metadata_col.insert_many, [dict(meta) for meta in image_metas])
+                if table is not None:
+                    table.add(image_metas)
+                # Save updated FAISS index
+                await run_in_stage("io", self.save_index, index, index_path)
 
         # Insert product metadata into MongoDB
         product_doc = {
             "item_id": item_id,
             "product_type": product_type,
             "item_name": item_name,
-            "main_image_id": main_image_id,
-            "other_image_id": [m["image_id"] for m in other_image_metas_cnn],
+            "main_image_id": image_ids[0],
+            "other_image_id": image_ids[1:],
         }
-        self.products_col.insert_one(product_doc)
+        await run_in_stage("db", self.products_col.insert_one, product_doc)
 
         return {
             "message": "Product added successfully to both CNN and CLIP indexes",
             "item_id": item_id,
-            "main_image_id": main_image_id,
-            "other_image_ids": [m["image_id"] for m in other_image_metas_cnn],
+            "main_image_id": image_ids[0],
+            "other_image_ids": image_ids[1:],
         }
 
     async def _save_image(self, file: UploadFile, image_id: str) -> str:
@@ -153,11 +127,22 @@ class AddController:
         save_path = os.path.join(save_dir, filename)
 
         contents = await file.read()
-        with open(save_path, "wb") as f:
+        await run_in_stage("io", self._write_file, save_path, contents)
+
+        return save_path  # Return absolute path
+
+    @staticmethod
+    def _write_file(path: str, contents: bytes):
+        with open(path, "wb") as f:
             # binary write mode
             f.write(contents)
 
-        return save_path  # Return absolute path
+    def _decode_image_files(self, image_paths: list) -> list:
+        images = []
+        for image_path in image_paths:
+            with Image.open(image_path) as img:
+                images.append(img.convert("RGB"))
+        return images
 
     def _get_relative_image_path(self, absolute_path: str) -> str:
         # Return path relative to self.images_folder (e.g. "new/XXXXX.jpg")
@@ -1,15 +1,16 @@
 from fastapi import HTTPException
 from typing import Optional, List, Dict
 from app.db.mongo import products_col, embedding_cnn_faiss_metadata_col
+from app.executors import run_in_stage
 
 class ProductsController:
     def __init__(self):
         pass
 
     async def get_product(self, item_id: str) -> Optional[dict]:
-        product = self._fetch_product(item_id)
+        product = await run_in_stage("db", self._fetch_product, item_id)
         image_ids = self._collect_image_ids(product)
-        embedding_dict = self._fetch_embedding_metadata(image_ids)
+        embedding_dict = await run_in_stage("db", self._fetch_embedding_metadata, image_ids)
         transformed_product = self._transform_product(product, embedding_dict)
         return transformed_product
 
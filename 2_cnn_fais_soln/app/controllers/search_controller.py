@@ -10,6 +10,7 @@ from app.services.cnn_chroma import CNNChromaSearch
 
 from app.services.gemini_description import GeminiDescriptionService
 from app.config import gemini_api_key
+from app.executors import run_in_stage
 
 
 class SearchController:
@@ -23,24 +24,39 @@ class SearchController:
             raise HTTPException(status_code=400, detail="File must be an image")
         
         img_bytes = await file.read()
-        image = Image.open(io.BytesIO(img_bytes)).convert("RGB")
+        image = await run_in_stage("decode", self._decode_image, img_bytes)
 
         print(f"Search params: {params}")
 
+        # group_by_item: top_k distinct products, each with its best-matching image
+        group_by_item = getattr(params, "group_by_item", False)
+        # Attribute filters ({"category": ["rings"], ...}), applied inside the vector search
+        filters = getattr(params, "filters", None)
+
         if params.method == "cnn_chroma":
-            return await self.cnn_chroma_search.search_image(image, params.top_k)
+            if group_by_item:
+                return await self.cnn_chroma_search.search_items(image, params.top_k, filters)
+            return await self.cnn_chroma_search.search_image(image, params.top_k, filters)
         
         elif params.method == "clip_chroma":
-            return await self.clip_chroma_search.search_image(image, params.top_k)
+            if group_by_item:
+                return await self.clip_chroma_search.search_items(image, params.top_k, filters)
+            return await self.clip_chroma_search.search_image(image, params.top_k, filters)
         
         elif params.method == "clip_gemini_chroma":
             description = await self.gemini_service.generate_description(img_bytes)  
             print(f"Generated description: {description}")
-            return await self.clip_chroma_search.search_image_and_text(image, description, params.top_k)
+            return await self.clip_chroma_search.search_image_and_text(
+                image, description, params.top_k, group_by_item=group_by_item, filters=filters
+            )
         
         else:
             raise HTTPException(status_code=400, detail=f"Unknown search method: {params.method}")
 
+    @staticmethod
+    def _decode_image(img_bytes: bytes) -> Image.Image:
+        return Image.open(io.BytesIO(img_bytes)).convert("RGB")
+
 
 
 # class SearchController:
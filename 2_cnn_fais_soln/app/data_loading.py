@@ -1,4 +1,7 @@
-from typing import List, Dict
+import os
+from pathlib import Path
+from typing import List, Dict, Tuple
+from PIL import Image
 from app.search import load_embedding_metadata, load_product_metadata
 
 def load_and_transform_data(
@@ -36,3 +39,32 @@ def load_and_transform_data(
     product_dict = {p["item_id"]: p for p in transformed_products}
 
     return transformed_products, product_dict
+
+
+def load_batch_images(
+    batch_metadata: List[Dict],
+    images_folder: str,
+    start: int = 0,
+) -> Tuple[List[Image.Image], List[Tuple[int, Dict]]]:
+    """
+    Open and decode every image of a build batch.
+    Returns the RGB images and the matching (position, record) pairs,
+    skipping records whose file is missing or cannot be decoded.
+    """
+    images = []
+    loaded = []
+    for idx, record in enumerate(batch_metadata, start=start):
+        relative_path = Path(record["image_path"])
+        image_file_path = Path(os.path.join(images_folder, relative_path))
+
+        if not image_file_path.exists():
+            print(f"Image not found: {image_file_path}")
+            continue
+
+        try:
+            images.append(Image.open(image_file_path).convert("RGB"))
+            loaded.append((idx, record))
+        except Exception as e:
+            print(f"Failed to process {relative_path}: {e}")
+
+    return images, loaded
@@ -1,6 +1,7 @@
 import chromadb
+import numpy as np
 from chromadb.config import Settings
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
 import chromadb.errors
 
@@ -30,12 +31,13 @@ class ChromaDBClient:
         """Retrieve or create a collection by name."""
         return self.client.get_or_create_collection(collection_name)
 
-    def search_embeddings(self, collection_name: str, query_embedding: List[float], top_k: int):
-        """Search embeddings in a specific collection."""
+    def search_embeddings(self, collection_name: str, query_embedding: List[float], top_k: int, where: Optional[Dict] = None):
+        """Search embeddings in a specific collection, only among entries matching `where` if given."""
         collection = self.get_collection(collection_name)
         return collection.query(
             query_embeddings=[query_embedding],
             n_results=top_k,
+            where=where,
             include=["metadatas", "distances"]
         )
 
@@ -54,6 +56,17 @@ class ChromaDBClient:
         collection = self.get_collection(collection_name)
         return collection.get(ids=item_ids, include=["embeddings", "metadatas"])
 
+    def get_all_embeddings(self, collection_name: str, page_size: int = 5000) -> Tuple[List[str], np.ndarray]:
+        """All ids and embeddings of a collection as (ids, float32 matrix), read page by page."""
+        collection = self.get_collection(collection_name)
+        ids, pages = [], []
+        for offset in range(0, collection.count(), page_size):
+            page = collection.get(limit=page_size, offset=offset, include=["embeddings"])
+            ids.extend(page["ids"])
+            if len(page["ids"]):
+                pages.append(np.asarray(page["embeddings"], dtype="float32"))
+        return ids, np.concatenate(pages) if pages else np.empty((0, 0), dtype="float32")
+
     def insert_embeddings(self, collection_name: str, ids: List[str], embeddings: List[List[float]], metadatas: List[Dict]):
         """
         Insert embeddings into the specified collection.
@@ -71,6 +84,33 @@ class ChromaDBClient:
             metadatas=metadatas
         )
 
+    def upsert_embeddings(self, collection_name: str, ids: List[str], embeddings: List[List[float]], metadatas: List[Dict]):
+        """
+        Like insert_embeddings, but existing ids are overwritten, so re-sending
+        a batch (e.g. after a resumed build) does not fail or duplicate rows.
+        """
+        collection = self.get_collection(collection_name)
+        collection.upsert(
+            ids=ids,
+            embeddings=embeddings,
+            metadatas=metadatas
+        )
+
+    def delete_embeddings(self, collection_name: str, ids: List[str]):
+        """Delete embeddings by ID from the specified collection."""
+        collection = self.get_collection(collection_name)
+        collection.delete(ids=ids)
+
+    def replace_collection(self, staging_name: str, collection_name: str):
+        """Drop `collection_name` and rename the fully built `staging_name` collection to it."""
+        print(f"Publish collection: {staging_name} -> {collection_name}")
+        try:
+            self.client.delete_collection(collection_name)
+        except chromadb.errors.NotFoundError:
+            pass
+
+        self.client.get_collection(staging_name).modify(name=collection_name)
+
     def reset_collection(self, collection_name:str):
         print(f"Reset collection: {collection_name}")
         try: 
@@ -0,0 +1,83 @@
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+from app.config import (
+    INFERENCE_EXECUTOR_WORKERS,
+    DECODE_EXECUTOR_WORKERS,
+    DB_EXECUTOR_WORKERS,
+    IO_EXECUTOR_WORKERS,
+    SEARCH_EXECUTOR_WORKERS,
+    SIFT_EXECUTOR_WORKERS,
+    EXECUTOR_MAX_PENDING,
+)
+
+# Stages of a request and the thread pool size of each one:
+# - inference: torch forward passes (torch already uses all cores per call)
+# - decode:    PIL image decoding / resizing
+# - db:        Chroma queries and pymongo calls
+# - io:        file writes, FAISS index serialization, external APIs
+# - search:    in-process FAISS scans, metadata resolution and vector reads
+# - sift:      OpenCV SIFT extraction / matching, in worker processes (CPU bound
+#              Python-level loops that would hold the GIL of the API worker)
+STAGE_WORKERS = {
+    "inference": INFERENCE_EXECUTOR_WORKERS,
+    "decode": DECODE_EXECUTOR_WORKERS,
+    "db": DB_EXECUTOR_WORKERS,
+    "io": IO_EXECUTOR_WORKERS,
+    "search": SEARCH_EXECUTOR_WORKERS,
+    "sift": SIFT_EXECUTOR_WORKERS,
+}
+# Stages backed by a process pool; their functions and arguments must be picklable
+PROCESS_STAGES = {"sift"}
+
+
+class StageExecutor:
+    """
+    Thread (or process) pool for one blocking stage with a bounded number of
+    pending calls. Once `max_pending` calls are queued, callers wait on the
+    event loop instead of piling more work onto the pool.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_pending: int = EXECUTOR_MAX_PENDING, processes: bool = False):
+        self.name = name
+        if processes:
+            # spawn: forking a worker that already holds torch / FAISS threads is unsafe
+            self.pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-stage")
+        self.max_pending = max_pending
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        loop = asyncio.get_running_loop()
+        async with self._slots:
+            return await loop.run_in_executor(self.pool, functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+_executors: Dict[str, StageExecutor] = {}
+
+
+def get_executor(stage: str) -> StageExecutor:
+    if stage not in STAGE_WORKERS:
+        raise ValueError(f"Unknown executor stage: {stage}")
+    if stage not in _executors:
+        _executors[stage] = StageExecutor(stage, STAGE_WORKERS[stage], processes=stage in PROCESS_STAGES)
+    return _executors[stage]
+
+
+async def run_in_stage(stage: str, fn: Callable, *args, **kwargs) -> Any:
+    """Run a blocking call on the executor of `stage` and await its result."""
+    return await get_executor(stage).run(fn, *args, **kwargs)
+
+
+def shutdown_executors():
+    for executor in _executors.values():
+        executor.shutdown()
+    _executors.clear()
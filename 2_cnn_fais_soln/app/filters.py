@@ -0,0 +1,164 @@
+import re
+import threading
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple
+from app.config import PRICE_BANDS
+from app.search import make_id_selector
+
+# Filter name -> product metadata key (compared stripped and lower-cased,
+# the catalog has keys like " Stone" and "stone Color")
+FILTER_FIELDS = {
+    "category": "category",
+    "stone": "stone",
+    "stone_color": "stone color",
+}
+# Derived from the first metadata key containing "price"
+PRICE_BAND_FILTER = "price_band"
+FILTER_NAMES = tuple(FILTER_FIELDS) + (PRICE_BAND_FILTER,)
+
+# Prefix of the normalized filter fields stored in Chroma metadata
+CHROMA_FILTER_PREFIX = "filter_"
+
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def _normalize(value) -> str:
+    return str(value).strip().lower()
+
+
+def price_band(value) -> Optional[str]:
+    """Band label of a price ("0-100", ..., "1000+") for the PRICE_BANDS edges, None if unparsable."""
+    match = _NUMBER.search(str(value).replace(",", ""))
+    if match is None:
+        return None
+    price = float(match.group())
+    low = 0
+    for edge in PRICE_BANDS:
+        if price < edge:
+            return f"{low:g}-{edge:g}"
+        low = edge
+    return f"{low:g}+"
+
+
+def product_attributes(metadata: Dict) -> Dict[str, str]:
+    """Normalized filter values of one product's metadata, e.g. {"category": "rings", "price_band": "100-250"}."""
+    by_key = {_normalize(key): value for key, value in metadata.items() if not isinstance(value, (dict, list))}
+    attributes = {}
+    for name, key in FILTER_FIELDS.items():
+        value = by_key.get(key)
+        if value is not None and _normalize(value) not in ("", "not found"):
+            attributes[name] = _normalize(value)
+    price_key = next((key for key in by_key if "price" in key), None)
+    band = price_band(by_key[price_key]) if price_key is not None else None
+    if band is not None:
+        attributes[PRICE_BAND_FILTER] = band
+    return attributes
+
+
+def chroma_filter_fields(metadata: Dict) -> Dict[str, str]:
+    """The filter values as flat Chroma metadata fields ("filter_category", ...)."""
+    return {CHROMA_FILTER_PREFIX + name: value for name, value in product_attributes(metadata).items()}
+
+
+def parse_filters(values: Dict[str, Optional[str]]) -> Dict[str, List[str]]:
+    """
+    Request filters from form values: each filter is a comma-separated list of
+    accepted values (OR), different filters must all match (AND). Empty ones are dropped.
+    """
+    filters = {}
+    for name in FILTER_NAMES:
+        accepted = [_normalize(v) for v in (values.get(name) or "").split(",") if v.strip()]
+        if accepted:
+            filters[name] = accepted
+    return filters
+
+
+def chroma_where(filters: Optional[Dict[str, List[str]]]) -> Optional[Dict]:
+    """Chroma `where` clause for `filters`, None when there are none."""
+    clauses = [{CHROMA_FILTER_PREFIX + name: {"$in": values}} for name, values in (filters or {}).items()]
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+class FilterIndex:
+    """
+    One packed bitmap per (filter, value) over the faiss ids of an image index,
+    built once at startup. matching_ids ORs the bitmaps of the accepted values
+    of each filter and ANDs the filters, on packed uint8 words, and the result
+    goes into the search as an IDSelector, so the index only scores images
+    that pass the filters instead of post-filtering its top_k.
+    Rows are append-only; add() swaps in a new snapshot.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (faiss ids in row order, {(filter, value): packed bitmap over those rows})
+        self._snapshot: Tuple[np.ndarray, Dict[Tuple[str, str], np.ndarray]] = (np.empty(0, dtype="int64"), {})
+
+    @classmethod
+    def from_collections(cls, image_metadata_col, products_col) -> "FilterIndex":
+        """Filter bitmaps of every image in `image_metadata_col`, from its product's metadata."""
+        item_attributes = {
+            product["item_id"]: product_attributes(product.get("metadata") or {})
+            for product in products_col.find({}, {"_id": 0, "item_id": 1, "metadata": 1})
+        }
+        ids, attributes = [], []
+        for doc in image_metadata_col.find({}, {"_id": 0, "faiss_id": 1, "item_id": 1}):
+            if "faiss_id" in doc:
+                ids.append(doc["faiss_id"])
+                attributes.append(item_attributes.get(doc.get("item_id"), {}))
+        index = cls()
+        index.add(ids, attributes)
+        return index
+
+    def __len__(self) -> int:
+        return len(self._snapshot[0])
+
+    def add(self, ids: Sequence[int], attributes: Sequence[Dict[str, str]]):
+        """Append images (their faiss ids and product_attributes)."""
+        if not len(ids):
+            return
+        with self._lock:
+            old_ids, old_bitmaps = self._snapshot
+            start = len(old_ids)
+            ids = np.concatenate([old_ids, np.asarray(ids, dtype="int64")])
+            rows: Dict[Tuple[str, str], List[int]] = {}
+            for row, attrs in enumerate(attributes, start=start):
+                for name, value in attrs.items():
+                    rows.setdefault((name, value), []).append(row)
+
+            bitmaps = {}
+            for key in set(old_bitmaps) | set(rows):
+                bits = np.zeros(len(ids), dtype=bool)
+                if key in old_bitmaps:
+                    bits[:start] = np.unpackbits(old_bitmaps[key], count=start, bitorder="little")
+                bits[rows.get(key, [])] = True
+                bitmaps[key] = np.packbits(bits, bitorder="little")
+            self._snapshot = (ids, bitmaps)
+
+    def matching_ids(self, filters: Dict[str, List[str]]) -> Optional[np.ndarray]:
+        """Faiss ids passing all `filters`, None when there are no filters."""
+        if not filters:
+            return None
+        ids, bitmaps = self._snapshot
+        mask = None
+        for name, accepted in filters.items():
+            words = np.zeros((len(ids) + 7) // 8, dtype=np.uint8)
+            for value in accepted:
+                bitmap = bitmaps.get((name, value))
+                if bitmap is not None:
+                    words |= bitmap
+            mask = words if mask is None else mask & words
+        return ids[np.unpackbits(mask, count=len(ids), bitorder="little").astype(bool)]
+
+
+def filtered_selector(filter_index: Optional[FilterIndex], filters: Optional[Dict[str, List[str]]]):
+    """
+    (applies, IDSelector) for a FAISS search with `filters`: (False, None) without
+    filters, (True, None) when no image matches (the search can be skipped).
+    """
+    if not filters or filter_index is None:
+        return False, None
+    ids = filter_index.matching_ids(filters)
+    return True, (make_id_selector(ids) if len(ids) else None)
@@ -0,0 +1,43 @@
+import math
+import numpy as np
+from typing import Awaitable, Callable, Dict, List
+from app.config import GROUP_OVERFETCH, GROUP_MAX_FETCH
+
+
+def best_per_item(results: List[Dict], top_k: int) -> List[Dict]:
+    """
+    The first (best-ranked) hit of each item_id in `results`, which are in rank
+    order, for the top_k items. Each kept hit gets `matched_images`, the number
+    of hits its item had. Works for similarities and distances alike since
+    only the rank order is used.
+    """
+    if not results:
+        return []
+    item_ids = np.array([str(result.get("item_id")) for result in results], dtype=object)
+    _, first, counts = np.unique(item_ids, return_index=True, return_counts=True)
+    order = np.argsort(first, kind="stable")[:top_k]
+    return [dict(results[first[i]], matched_images=int(counts[i])) for i in order.tolist()]
+
+
+async def search_grouped(
+    search_fn: Callable[[int], Awaitable[List[Dict]]],
+    top_k: int,
+    overfetch: int = GROUP_OVERFETCH,
+    max_fetch: int = GROUP_MAX_FETCH,
+) -> List[Dict]:
+    """
+    Top_k distinct items from an image search. `search_fn(n)` returns the top
+    n image hits (result dicts with item_id) in rank order. The first call
+    fetches `overfetch` hits per wanted item; only when that yields fewer than
+    top_k items (and the index had more to give) the scan is widened, sized by
+    the images-per-item ratio seen so far, up to `max_fetch` hits.
+    """
+    fetch = min(top_k * overfetch, max_fetch)
+    while True:
+        results = await search_fn(fetch)
+        items = best_per_item(results, top_k)
+        if len(items) >= top_k or len(results) < fetch or fetch >= max_fetch:
+            return items
+        # Hits needed per item so far, with some slack, and at least double the scan
+        per_item = len(results) / max(len(items), 1)
+        fetch = min(max(fetch * 2, math.ceil(top_k * per_item * 1.5)), max_fetch)
@@ -0,0 +1,160 @@
+import os
+import queue
+import threading
+import time
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import torch
+from PIL import Image
+from app.config import EMBEDDING_BATCH_SIZE, LOADER_WORKERS, LOADER_PREFETCH_BATCHES
+from app.model import get_preprocess
+
+_DONE = object()
+
+
+class StageStats:
+    """
+    Busy time and item count per pipeline stage of an index build.
+    Stages running on several threads add up their busy time, so their rate is per thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds: Dict[str, float] = {}
+        self.items: Dict[str, int] = {}
+        self.started = time.perf_counter()
+
+    def add(self, stage: str, seconds: float, items: int):
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.items[stage] = self.items.get(stage, 0) + items
+
+    def report(self) -> List[str]:
+        wall = time.perf_counter() - self.started
+        lines = []
+        for stage, seconds in self.seconds.items():
+            items = self.items[stage]
+            rate = items / seconds if seconds else 0.0
+            lines.append(f"{stage}: {items} images, {seconds:.2f} s busy, {rate:.1f} images/sec")
+        lines.append(f"wall clock: {wall:.2f} s")
+        return lines
+
+
+class LoadedBatch:
+    """
+    One batch ready for inference.
+    `loaded` holds the (position, record) pairs of the images that decoded fine,
+    in order, and `tensors[model_name]` their stacked preprocessed inputs.
+    """
+
+    def __init__(self, start: int, end: int, loaded: List[Tuple[int, Dict]], tensors: Dict[str, torch.Tensor]):
+        self.start = start
+        self.end = end
+        self.loaded = loaded
+        self.tensors = tensors
+
+
+class PrefetchingImageLoader:
+    """
+    Streams image records through a decode + preprocess thread pool and hands
+    ready batches to the consumer through a bounded queue, so disk reads and
+    JPEG decoding overlap with inference instead of alternating with it.
+
+    Iterate over it to get LoadedBatch objects in record order.
+    """
+
+    def __init__(
+        self,
+        records: Iterable[Dict],
+        images_folder: str,
+        model_names: Tuple[str, ...],
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        num_workers: int = LOADER_WORKERS,
+        max_prefetch_batches: int = LOADER_PREFETCH_BATCHES,
+        stats: Optional[StageStats] = None,
+        start: int = 0,
+    ):
+        self.records = records
+        self.images_folder = images_folder
+        self.preprocessors = {name: get_preprocess(name) for name in model_names}
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.stats = stats or StageStats()
+        self.start = start
+        self._queue = queue.Queue(maxsize=max_prefetch_batches)
+        self._stop = threading.Event()
+
+    def _load_one(self, record: Dict) -> Optional[Dict[str, torch.Tensor]]:
+        started = time.perf_counter()
+        image_file_path = os.path.join(self.images_folder, record["image_path"])
+        tensors = None
+        try:
+            with Image.open(image_file_path) as img:
+                image_rgb = img.convert("RGB")
+            tensors = {name: pp(image_rgb) for name, pp in self.preprocessors.items()}
+        except FileNotFoundError:
+            print(f"Image not found: {image_file_path}")
+        except Exception as e:
+            print(f"Failed to process {record['image_path']}: {e}")
+        self.stats.add("decode+preprocess", time.perf_counter() - started, 1)
+        return tensors
+
+    def _assemble(self, start: int, batch_records: List[Dict], futures) -> LoadedBatch:
+        loaded = []
+        per_model = {name: [] for name in self.preprocessors}
+        for idx, (record, future) in enumerate(zip(batch_records, futures), start=start):
+            tensors = future.result()
+            if tensors is None:
+                continue
+            loaded.append((idx, record))
+            for name, tensor in tensors.items():
+                per_model[name].append(tensor)
+        stacked = {name: torch.stack(tensors) for name, tensors in per_model.items() if tensors}
+        return LoadedBatch(start, start + len(batch_records), loaded, stacked)
+
+    def _put(self, item) -> bool:
+        # Blocks while the queue is full, which is what bounds memory use
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            records = iter(self.records)
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="image-loader") as pool:
+                for batch_start in itertools.count(self.start, self.batch_size):
+                    batch_records = list(itertools.islice(records, self.batch_size))
+                    if not batch_records or self._stop.is_set():
+                        break
+                    # Submit the next batch before waiting on the previous one so the pool never idles
+                    pending.append((batch_start, batch_records, [pool.submit(self._load_one, r) for r in batch_records]))
+                    if len(pending) > 1 and not self._put(self._assemble(*pending.popleft())):
+                        return
+                while pending:
+                    if not self._put(self._assemble(*pending.popleft())):
+                        return
+        except Exception as e:
+            self._put(e)
+        finally:
+            self._put(_DONE)
+
+    def __iter__(self) -> Iterator[LoadedBatch]:
+        producer = threading.Thread(target=self._produce, name="image-loader-producer", daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self._stop.set()
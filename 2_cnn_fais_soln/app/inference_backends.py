@@ -0,0 +1,155 @@
+import os
+import numpy as np
+import torch
+from typing import Callable, Optional
+from app.config import MODEL_CACHE_DIR, ONNX_NUM_THREADS
+
+INFERENCE_BACKENDS = ("eager", "torchscript", "onnx")
+MODEL_PRECISIONS = ("fp32", "int8")
+
+
+class EagerEncoder:
+    """Runs a torch module on a preprocessed batch and returns a float32 numpy matrix."""
+
+    def __init__(self, module: torch.nn.Module, device: torch.device):
+        self.module = module
+        self.device = device
+
+    def __call__(self, x: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return self.module(x.to(self.device)).float().cpu().numpy()
+
+
+class TorchScriptEncoder(EagerEncoder):
+    """Frozen, traced TorchScript module exported by `export_torchscript`."""
+
+    def __init__(self, path: str, device: torch.device):
+        super().__init__(torch.jit.load(path, map_location=device), device)
+
+
+class OnnxEncoder:
+    """ONNX Runtime session for a model exported by `export_onnx` (CPU only)."""
+
+    def __init__(self, path: str):
+        import onnxruntime as ort  # optional dependency, only needed for this backend
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if ONNX_NUM_THREADS:
+            options.intra_op_num_threads = ONNX_NUM_THREADS
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x: torch.Tensor) -> np.ndarray:
+        out = self.session.run(None, {self.input_name: x.cpu().numpy()})[0]
+        return out.astype("float32", copy=False)
+
+
+def _save_atomically(save: Callable[[str], None], path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def export_torchscript(module: torch.nn.Module, example: torch.Tensor, path: str, optimize: bool = True):
+    """Trace `module` on `example`, freeze it and save it for TorchScriptEncoder."""
+    with torch.no_grad():
+        traced = torch.jit.trace(module.eval(), example)
+        frozen = torch.jit.freeze(traced)
+        if optimize:
+            frozen = torch.jit.optimize_for_inference(frozen)
+    _save_atomically(lambda p: torch.jit.save(frozen, p), path)
+
+
+def export_onnx(module: torch.nn.Module, example: torch.Tensor, path: str):
+    """Export `module` to ONNX with a dynamic batch dimension."""
+    with torch.no_grad():
+        _save_atomically(
+            lambda p: torch.onnx.export(
+                module.eval(),
+                (example,),
+                p,
+                input_names=["input"],
+                output_names=["embedding"],
+                dynamic_axes={"input": {0: "batch"}, "embedding": {0: "batch"}},
+                opset_version=17,
+            ),
+            path,
+        )
+
+
+def artifact_path(name: str, backend: str, precision: str = "fp32") -> str:
+    extension = {"torchscript": "torchscript.pt", "onnx": "onnx"}[backend]
+    suffix = "" if precision == "fp32" else f".{precision}"
+    return os.path.join(MODEL_CACHE_DIR, f"{name}{suffix}.{extension}")
+
+
+def _load_int8_encoder(
+    name: str,
+    backend: str,
+    build_module: Callable[[], torch.nn.Module],
+    example: torch.Tensor,
+    quantize: Callable[[torch.nn.Module], torch.nn.Module],
+):
+    """
+    int8 encoders always run on CPU. On the torch backends the quantized module
+    is traced once and cached as TorchScript, so eager and torchscript share it;
+    on onnx the exported fp32 graph gets ONNX Runtime dynamic quantization.
+    """
+    if backend == "onnx":
+        path = artifact_path(name, "onnx", "int8")
+        if not os.path.exists(path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            fp32_path = artifact_path(name, "onnx")
+            if not os.path.exists(fp32_path):
+                export_onnx(build_module().cpu(), example, fp32_path)
+            print(f"Quantizing {fp32_path} to int8...")
+            _save_atomically(lambda p: quantize_dynamic(fp32_path, p, weight_type=QuantType.QInt8), path)
+        return OnnxEncoder(path)
+
+    path = artifact_path(name, "torchscript", "int8")
+    if not os.path.exists(path):
+        print(f"Quantizing {name} to int8...")
+        # Quantized kernels don't go through optimize_for_inference's fusions
+        export_torchscript(quantize(build_module().cpu().eval()), example, path, optimize=False)
+    return TorchScriptEncoder(path, torch.device("cpu"))
+
+
+def load_encoder(
+    name: str,
+    backend: str,
+    build_module: Callable[[], torch.nn.Module],
+    example: torch.Tensor,
+    device: torch.device,
+    precision: str = "fp32",
+    quantize: Optional[Callable[[torch.nn.Module], torch.nn.Module]] = None,
+):
+    """
+    Return an encoder for `name` on `backend`. TorchScript and ONNX artifacts
+    are exported from the eager module the first time and reused afterwards.
+    With precision="int8", `quantize` turns the fp32 module into an int8 one.
+    """
+    if precision not in MODEL_PRECISIONS:
+        raise ValueError(f"Unknown model precision: {precision}")
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend: {backend}")
+
+    if precision == "int8":
+        return _load_int8_encoder(name, backend, build_module, example, quantize)
+
+    if backend == "eager":
+        return EagerEncoder(build_module(), device)
+
+    path = artifact_path(name, backend)
+    if not os.path.exists(path):
+        print(f"Exporting {name} to {backend} at {path}...")
+        if backend == "torchscript":
+            export_torchscript(build_module(), example.to(device), path)
+        else:
+            export_onnx(build_module().cpu(), example, path)
+
+    if backend == "torchscript":
+        return TorchScriptEncoder(path, device)
+    return OnnxEncoder(path)
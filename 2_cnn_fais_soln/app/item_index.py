@@ -0,0 +1,100 @@
+import os
+import json
+import numpy as np
+from typing import Dict, List, Optional, Sequence
+from app.config import ITEM_CANDIDATE_FACTOR
+from app.grouping import best_per_item
+from app.metadata_table import MetadataTable
+from app.search import VectorStore, load_index, open_ids, ids_path, search_batch, vectors_path
+
+
+def item_index_path(index_path: str) -> str:
+    """Item-centroid index built next to an image index."""
+    return index_path + ".items"
+
+
+def _item_ids_path(item_path: str) -> str:
+    return item_path + ".item_ids.json"
+
+
+def save_item_ids(item_path: str, item_ids: List[str], image_count: int):
+    """The item_id of every row of the item index's vectors file, and the size of the image index it was built from."""
+    with open(_item_ids_path(item_path) + ".tmp", "w") as f:
+        json.dump({"item_ids": item_ids, "image_count": image_count}, f)
+    os.replace(_item_ids_path(item_path) + ".tmp", _item_ids_path(item_path))
+
+
+class ItemCentroidIndex:
+    """
+    Two-stage product search. Stage one searches a small index holding one
+    normalized centroid per item_id (the mean of its image vectors) for
+    `candidate_factor * top_k` candidate items; stage two scores every image
+    of those items exactly against the image index's VectorStore and keeps
+    each item's best image. The image index itself is never scanned, and a
+    top_k of items needs no over-fetch of near-duplicate images.
+
+    Only the images of the build are covered: products added later have no
+    centroid and their images aren't in the VectorStore. covers() tells
+    whether the image index still holds exactly the `image_count` images of
+    the build; the search services fall back to the grouped image search
+    (search_grouped) when it doesn't, until the item index is rebuilt.
+    """
+
+    def __init__(
+        self,
+        index,
+        item_ids: Sequence[str],
+        item_faiss_ids: np.ndarray,
+        image_store: VectorStore,
+        metadata: MetadataTable,
+        candidate_factor: int = ITEM_CANDIDATE_FACTOR,
+        image_count: Optional[int] = None,
+    ):
+        self.index = index
+        order = np.argsort(item_faiss_ids, kind="stable")
+        self._sorted_ids = np.asarray(item_faiss_ids, dtype="int64")[order]
+        self._item_ids = np.asarray(item_ids, dtype=object)[order]
+        self.image_store = image_store
+        self.metadata = metadata
+        self.candidate_factor = candidate_factor
+        self.image_count = image_count
+
+    @classmethod
+    def load(cls, index_path: str, metadata: MetadataTable) -> Optional["ItemCentroidIndex"]:
+        """The item index built next to the image index at `index_path`, None when there is none."""
+        item_path = item_index_path(index_path)
+        if not os.path.exists(_item_ids_path(item_path)) or not os.path.exists(vectors_path(index_path)):
+            return None
+        index = load_index(item_path)
+        with open(_item_ids_path(item_path), "r") as f:
+            info = json.load(f)
+        if isinstance(info, list):
+            # Built before image_count was recorded: coverage unknown, never used until rebuilt
+            info = {"item_ids": info, "image_count": None}
+        item_faiss_ids = np.array(open_ids(ids_path(item_path)))
+        print(f"Loaded item index of {index_path} with {len(info['item_ids'])} items")
+        return cls(index, info["item_ids"], item_faiss_ids, VectorStore.open(index_path, index.d), metadata,
+                   image_count=info["image_count"])
+
+    def covers(self, image_index) -> bool:
+        """Whether every image of `image_index` was part of this item index's build."""
+        return self.image_count is not None and image_index.ntotal == self.image_count
+
+    def candidate_items(self, query_emb: np.ndarray, n: int) -> List[str]:
+        """item_ids of the n centroids closest to the query."""
+        ids, _ = search_batch(self.index, query_emb.reshape(1, -1), n)
+        ids = np.asarray(ids[0], dtype="int64")
+        if not len(ids) or not len(self._sorted_ids):
+            return []
+        pos = np.minimum(np.searchsorted(self._sorted_ids, ids), len(self._sorted_ids) - 1)
+        return self._item_ids[pos[self._sorted_ids[pos] == ids]].tolist()
+
+    def search_items(self, query_emb: np.ndarray, top_k: int) -> List[Dict]:
+        """Top_k distinct items (best image each, with matched_images) for a query embedding."""
+        items = self.candidate_items(query_emb, top_k * self.candidate_factor)
+        image_ids = self.metadata.item_image_ids(items)
+        vectors, found = self.image_store.get(image_ids)
+        image_ids = image_ids[found]
+        scores = vectors[found] @ np.asarray(query_emb, dtype="float32").reshape(-1)
+        order = np.argsort(-scores, kind="stable")
+        return best_per_item(self.metadata.resolve(image_ids[order], scores[order]), top_k)
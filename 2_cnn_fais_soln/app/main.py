@@ -2,8 +2,12 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
-from app.config import SHOE_IMAGES_FOLDER, FAISS_INDEX_PATH, CLIP_FAISS_INDEX_PATH, CLIP_FAISS_INDEX_TEXT_PATH, CHROMA_CNN_EMBEDDINGS_COLLECTION
+from app.config import SHOE_IMAGES_FOLDER, FAISS_INDEX_PATH, CLIP_FAISS_INDEX_PATH, CLIP_FAISS_INDEX_TEXT_PATH, CHROMA_CNN_EMBEDDINGS_COLLECTION, MODEL_FAST_START
 from app.model import extract_embedding, extract_clip_embedding, extract_clip_text_embedding
+from app.model import extract_embeddings_batch, extract_clip_embeddings_batch, extract_clip_text_embeddings_batch
+from app.model import preload_models, preload_models_in_background
+from app.batching import MicroBatcher
+from app.executors import shutdown_executors
 from app.search import load_index, load_embedding_metadata, save_index, search, load_product_metadata
 
 # from app.services.cnn_faiss import CNNFaissSearch
@@ -19,6 +23,9 @@ from app.routes import add as add_routes
 from app.db.chroma import ChromaDBClient
 
 app = FastAPI()
+app.add_event_handler("shutdown", shutdown_executors)
+# Load the enabled models up front (in the background in fast-start mode)
+app.add_event_handler("startup", preload_models_in_background if MODEL_FAST_START else preload_models)
 
 app.add_middleware(
     CORSMiddleware,
@@ -37,26 +44,44 @@ chroma_client = ChromaDBClient(persist_directory="../data/chroma_db")
 
 
 # # Load FAISS index and embedding metadata
+# from app.metadata_table import MetadataTable
+# from app.db.mongo import embedding_cnn_faiss_metadata_col, embedding_clip_faiss_metadata_col
+# from app.partitions import PartitionedIndex
+# from app.item_index import ItemCentroidIndex
 # index = load_index(FAISS_INDEX_PATH)
 # clip_index = load_index(CLIP_FAISS_INDEX_PATH)
 # clip_text_index = load_index(CLIP_FAISS_INDEX_TEXT_PATH)
+# cnn_metadata = MetadataTable.from_collection(embedding_cnn_faiss_metadata_col)
+# clip_metadata = MetadataTable.from_collection(embedding_clip_faiss_metadata_col)
+# cnn_partitions = PartitionedIndex.load(FAISS_INDEX_PATH, index)  # None unless built with FAISS_CATEGORY_PARTITIONS=1
+# cnn_items = ItemCentroidIndex.load(FAISS_INDEX_PATH, cnn_metadata)  # None unless built with FAISS_ITEM_CENTROIDS=1
 
 # Mount static files for images
 app.mount("/images", StaticFiles(directory=SHOE_IMAGES_FOLDER), name="images")
 
 # Initialize services and controllers
-# cnn_faiss_service = (index, extract_embedding, search)
+# One micro-batcher per model so concurrent /search/ queries share forward passes
+cnn_batcher = MicroBatcher(extract_embeddings_batch, name="cnn")
+clip_image_batcher = MicroBatcher(extract_clip_embeddings_batch, name="clip_image")
+clip_text_batcher = MicroBatcher(extract_clip_text_embeddings_batch, name="clip_text")
+
+# cnn_faiss_service = CNNFaissSearch(index, extract_embedding, search, metadata=cnn_metadata,
+#                                    partitions=cnn_partitions, route_embedding_func=extract_clip_embedding,
+#                                    item_index=cnn_items, batcher=cnn_batcher)
 
 clip_chroma_search = CLIPChromaSearch(
     chroma_client=chroma_client,
     extract_clip_embedding=extract_clip_embedding,
-    extract_clip_text_embedding=extract_clip_text_embedding
+    extract_clip_text_embedding=extract_clip_text_embedding,
+    image_batcher=clip_image_batcher,
+    text_batcher=clip_text_batcher
 )
 
 cnn_chroma_search = CNNChromaSearch(
     chroma_client=chroma_client,
     collection_name=CHROMA_CNN_EMBEDDINGS_COLLECTION, 
-    extract_embedding_func=extract_embedding  
+    extract_embedding_func=extract_embedding,
+    batcher=cnn_batcher
 )
 
 
@@ -64,7 +89,9 @@ search_controller = SearchController(cnn_chroma_search, clip_chroma_search)
 products_controller = ProductsController()
 # add_controller = AddController(
 #     faiss_cnn_index=index, 
-#     faiss_clip_index = clip_index
+#     faiss_clip_index = clip_index,
+#     cnn_metadata=cnn_metadata,
+#     clip_metadata=clip_metadata,
 # )
 
 
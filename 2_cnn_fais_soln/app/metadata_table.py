@@ -0,0 +1,126 @@
+import threading
+import numpy as np
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+# Columns kept per vector, in the order of a result dict
+METADATA_FIELDS = ("image_id", "item_id", "image_path")
+
+
+class StringPool:
+    """Interned strings addressed by int32 codes; the same string is stored once."""
+
+    def __init__(self):
+        self.strings: List[str] = []
+        self._codes: Dict[str, int] = {}
+
+    def code(self, value) -> int:
+        value = "" if value is None else str(value)
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.strings)
+            self.strings.append(value)
+        return code
+
+    def codes(self, values: Iterable) -> np.ndarray:
+        return np.fromiter((self.code(value) for value in values), dtype="int32")
+
+
+class MetadataTable:
+    """
+    faiss_id -> (image_id, item_id, image_path) of an image index, held in
+    memory as columns: a sorted int64 id array and one int32 code column per
+    field into a shared StringPool (an item_id used by 8 images is stored once).
+
+    `resolve` turns a search result into result dicts with one searchsorted
+    and one fancy index per column instead of a Mongo query per hit.
+    `add` keeps it current when products are added; readers always see a
+    complete snapshot, writers are serialized.
+    """
+
+    def __init__(self):
+        self.pool = StringPool()
+        self._lock = threading.Lock()
+        columns = (np.empty(0, dtype="int64"),) + tuple(np.empty(0, dtype="int32") for _ in METADATA_FIELDS)
+        # (columns, pool strings as an object array) swapped as one attribute,
+        # so a concurrent resolve sees either the old or the new table
+        self._snapshot = (columns, np.empty(0, dtype=object))
+        # (snapshot, row order by item_id code, item_id codes in that order), built on first use
+        self._by_item = None
+
+    @classmethod
+    def from_collection(cls, collection, chunk_size: int = 65536) -> "MetadataTable":
+        """Load every metadata doc of `collection` (one pass, projected to the table's fields)."""
+        table = cls()
+        projection = {"_id": 0, "faiss_id": 1, **{field: 1 for field in METADATA_FIELDS}}
+        chunk = []
+        for doc in collection.find({}, projection).batch_size(chunk_size):
+            chunk.append(doc)
+            if len(chunk) == chunk_size:
+                table.add(chunk)
+                chunk = []
+        if chunk:
+            table.add(chunk)
+        return table
+
+    def __len__(self) -> int:
+        return len(self._snapshot[0][0])
+
+    def add(self, docs: Sequence[Dict]):
+        """Add (or replace, by faiss_id) metadata docs."""
+        docs = [doc for doc in docs if "faiss_id" in doc]
+        if not docs:
+            return
+        with self._lock:
+            new = (np.fromiter((doc["faiss_id"] for doc in docs), dtype="int64"),) + tuple(
+                self.pool.codes(doc.get(field) for doc in docs) for field in METADATA_FIELDS
+            )
+            columns = self._snapshot[0]
+            old = ~np.isin(columns[0], new[0])
+            merged = [np.concatenate([column[old], added]) for column, added in zip(columns, new)]
+            order = np.argsort(merged[0], kind="stable")
+            # Object array over the pool, so a code column turns into strings with one fancy index
+            self._snapshot = (tuple(column[order] for column in merged), np.asarray(self.pool.strings, dtype=object))
+
+    def remove(self, faiss_ids: Iterable[int]):
+        with self._lock:
+            columns, strings = self._snapshot
+            keep = ~np.isin(columns[0], np.fromiter(faiss_ids, dtype="int64"))
+            self._snapshot = (tuple(column[keep] for column in columns), strings)
+
+    def rows(self, faiss_ids: Sequence[int]) -> Tuple[Tuple[Tuple[np.ndarray, ...], np.ndarray], np.ndarray]:
+        """(table snapshot, row of each id in it or -1)."""
+        snapshot = self._snapshot
+        ids = snapshot[0][0]
+        faiss_ids = np.asarray(faiss_ids, dtype="int64")
+        if not len(ids):
+            return snapshot, np.full(len(faiss_ids), -1, dtype="int64")
+        pos = np.minimum(np.searchsorted(ids, faiss_ids), len(ids) - 1)
+        return snapshot, np.where(ids[pos] == faiss_ids, pos, -1)
+
+    def resolve(self, faiss_ids: Sequence[int], scores: Sequence[float]) -> List[Dict]:
+        """Result dicts (image_id, item_id, image_path, score) of a search, ids without metadata skipped."""
+        (columns, strings), rows = self.rows(faiss_ids)
+        found = rows >= 0
+        rows = rows[found]
+        values = [strings[column[rows]] for column in columns[1:]]
+        scores = np.asarray(scores, dtype="float64")[found]
+        return [
+            {"image_id": image_id, "item_id": item_id, "image_path": image_path, "score": score}
+            for image_id, item_id, image_path, score in zip(*values, scores.tolist())
+        ]
+
+    def item_image_ids(self, item_ids: Iterable[str]) -> np.ndarray:
+        """Faiss ids of every image of `item_ids` (unknown items have none)."""
+        snapshot = self._snapshot
+        by_item = self._by_item
+        if by_item is None or by_item[0] is not snapshot:
+            item_codes = snapshot[0][2]
+            order = np.argsort(item_codes, kind="stable")
+            by_item = self._by_item = (snapshot, order, item_codes[order])
+        _, order, sorted_codes = by_item
+        codes = [self.pool._codes.get(str(item_id)) for item_id in item_ids]
+        codes = np.array([code for code in codes if code is not None], dtype="int32")
+        starts = np.searchsorted(sorted_codes, codes, side="left")
+        ends = np.searchsorted(sorted_codes, codes, side="right")
+        rows = np.concatenate([order[start:end] for start, end in zip(starts.tolist(), ends.tolist())] or [np.empty(0, dtype="int64")])
+        return snapshot[0][0][rows]
@@ -1,59 +1,377 @@
+import functools
+import json
+import os
+import random
+import threading
+import time
 from PIL import Image
 import torch
 from torchvision import models, transforms
 import numpy as np
 import clip
+from typing import Callable, Dict, List, Optional, Tuple
+from app.config import (
+    EMBEDDING_BATCH_SIZE,
+    ENABLED_MODELS,
+    MODEL_CACHE_DIR,
+    INFERENCE_BACKEND,
+    MODEL_PRECISION,
+    QUANT_CALIBRATION_IMAGES,
+    IMAGE_PATHS_JSON,
+    SHOE_IMAGES_FOLDER,
+)
+from app.inference_backends import load_encoder
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# Load pretrained ResNet50 without classification head
-model = models.resnet50(pretrained=True)
-model = torch.nn.Sequential(*list(model.children())[:-1]).to(device)
-model.eval()
-
-clip_model, clip_preprocess = clip.load("ViT-B/32", device=device)
-clip_model.eval()
+CNN_EMBEDDING_DIM = 2048
+CLIP_EMBEDDING_DIM = 512
+CLIP_MODEL_NAME = "ViT-B/32"
 
 preprocess = transforms.Compose([
     transforms.Resize((224, 224)),
     transforms.ToTensor(),
     transforms.Normalize(
-        mean=[0.485, 0.456, 0.406], 
+        mean=[0.485, 0.456, 0.406],
         std=[0.229, 0.224, 0.225]
     )
 ])
 
-def extract_embedding(image: Image.Image) -> np.ndarray: 
+
+def _as_rgb(image: Image.Image) -> Image.Image:
+    # convert() always copies, even when the image is already RGB
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def _clip_transform(n_px: int) -> transforms.Compose:
+    """Same preprocessing as the one returned by clip.load."""
+    return transforms.Compose([
+        transforms.Resize(n_px, interpolation=transforms.InterpolationMode.BICUBIC),
+        transforms.CenterCrop(n_px),
+        _as_rgb,
+        transforms.ToTensor(),
+        transforms.Normalize(
+            (0.48145466, 0.4578275, 0.40821073),
+            (0.26862954, 0.26130258, 0.27577711)
+        ),
+    ])
+
+
+CLIP_INPUT_RESOLUTION = 224  # ViT-B/32
+clip_preprocess = _clip_transform(CLIP_INPUT_RESOLUTION)
+
+
+def _cache_path(filename: str) -> str:
+    return os.path.join(MODEL_CACHE_DIR, filename)
+
+
+def _load_cached_module(filename: str, build: Callable[[], torch.nn.Module]) -> torch.nn.Module:
     """
-    Extract a normalized 2048-dim embedding from a PIL image.
+    Load a whole pickled module from the model cache, or build it and cache it.
+    Unpickling skips weight init, state dict copies and any download.
+    """
+    path = _cache_path(filename)
+    if os.path.exists(path):
+        module = torch.load(path, map_location=device, weights_only=False)
+    else:
+        module = build()
+        os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+        tmp_path = path + ".tmp"
+        torch.save(module, tmp_path)
+        os.replace(tmp_path, path)
+    return module.to(device).eval()
+
+
+class LoadedModel:
+    """Preprocessing plus the encoders of one model on one inference backend."""
+
+    def __init__(
+        self,
+        backend: str,
+        precision: str,
+        preprocess: Callable,
+        encode_image: Callable,
+        encode_text: Optional[Callable] = None,
+    ):
+        self.backend = backend
+        self.precision = precision
+        self.preprocess = preprocess
+        self.encode_image = encode_image
+        self.encode_text = encode_text
+
+
+class _ClipImageEncoder(torch.nn.Module):
+    def __init__(self, clip_model):
+        super().__init__()
+        self.clip_model = clip_model
+
+    def forward(self, x):
+        return self.clip_model.encode_image(x).float()
+
+
+class _ClipTextEncoder(torch.nn.Module):
+    def __init__(self, clip_model):
+        super().__init__()
+        self.clip_model = clip_model
+
+    def forward(self, tokens):
+        return self.clip_model.encode_text(tokens).float()
+
+
+def _calibration_batches(transform: Callable, batch_size: int = 16):
+    """Preprocessed batches of catalog images used to calibrate static quantization."""
+    with open(IMAGE_PATHS_JSON, "r") as f:
+        records = json.load(f)
+    random.Random(0).shuffle(records)
+
+    batch = []
+    seen = 0
+    for record in records:
+        path = os.path.join(SHOE_IMAGES_FOLDER, record["image_path"])
+        if not os.path.exists(path):
+            continue
+        with Image.open(path) as img:
+            batch.append(transform(img.convert("RGB")))
+        seen += 1
+        if len(batch) == batch_size or seen == QUANT_CALIBRATION_IMAGES:
+            yield torch.stack(batch)
+            batch = []
+        if seen == QUANT_CALIBRATION_IMAGES:
+            break
+    if batch:
+        yield torch.stack(batch)
+
+
+def _quantize_cnn_static(module: torch.nn.Module) -> torch.nn.Module:
     """
-    # 
-    image = image.convert("RGB")
-    x = preprocess(image).unsqueeze(0).to(device)
+    Post-training static int8 quantization of the ResNet50 backbone (FX graph mode).
+    Dynamic quantization only covers Linear layers, and the backbone is all convs.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    example = torch.randn(2, 3, 224, 224)
+    prepared = prepare_fx(module, get_default_qconfig_mapping("x86"), (example,))
     with torch.no_grad():
-        emb = model(x).squeeze().cpu().numpy()
-    emb /= np.linalg.norm(emb)
-    return emb.astype("float32")
+        for batch in _calibration_batches(preprocess):
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def _quantize_dynamic(module: torch.nn.Module) -> torch.nn.Module:
+    """Dynamic int8 quantization of the Linear layers (the bulk of a ViT)."""
+    return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _load_cnn(backend: str, precision: str) -> LoadedModel:
+    def build():
+        # Load pretrained ResNet50 without classification head
+        resnet = models.resnet50(pretrained=True)
+        return torch.nn.Sequential(*list(resnet.children())[:-1])
+
+    def build_encoder():
+        backbone = _load_cached_module("resnet50_backbone.pt", build)
+        return torch.nn.Sequential(backbone, torch.nn.Flatten(1)).eval()
+
+    example = torch.randn(2, 3, 224, 224)
+    encode_image = load_encoder(
+        "resnet50_backbone", backend, build_encoder, example, device, precision, _quantize_cnn_static
+    )
+    return LoadedModel(backend, precision, preprocess, encode_image)
+
+
+def _load_clip(backend: str, precision: str) -> LoadedModel:
+    def build():
+        clip_model, _ = clip.load(CLIP_MODEL_NAME, device="cpu", download_root=MODEL_CACHE_DIR)
+        return clip_model
+
+    # The eager model is only needed for the eager backend or a first-time export
+    @functools.lru_cache(maxsize=None)
+    def clip_model():
+        return _load_cached_module("clip_vit_b32.pt", build)
+
+    n_px = CLIP_INPUT_RESOLUTION
+    encode_image = load_encoder(
+        "clip_vit_b32_image", backend, lambda: _ClipImageEncoder(clip_model()), torch.randn(2, 3, n_px, n_px), device,
+        precision, _quantize_dynamic
+    )
+    encode_text = load_encoder(
+        "clip_vit_b32_text", backend, lambda: _ClipTextEncoder(clip_model()), clip.tokenize(["a ring", "a gold pendant"]), device,
+        precision, _quantize_dynamic
+    )
+    return LoadedModel(backend, precision, clip_preprocess, encode_image, encode_text)
+
+
+# Registry of the models this app knows how to load
+_model_loaders: Dict[str, Callable[[str, str], LoadedModel]] = {
+    "cnn": _load_cnn,
+    "clip": _load_clip,
+}
+_loaded_models: Dict[str, LoadedModel] = {}
+_load_locks = {name: threading.Lock() for name in _model_loaders}
+
+
+def load_model(name: str, backend: str = INFERENCE_BACKEND, precision: str = MODEL_PRECISION) -> LoadedModel:
+    """Build a fresh LoadedModel, bypassing the registry (used by benchmarks)."""
+    if name not in _model_loaders:
+        raise ValueError(f"Unknown model: {name}")
+    return _model_loaders[name](backend, precision)
+
+
+def get_model(name: str) -> LoadedModel:
+    """
+    Return the LoadedModel for `name` on INFERENCE_BACKEND / MODEL_PRECISION,
+    loading it on first use.
+    """
+    if name not in _loaded_models:
+        if name not in _model_loaders:
+            raise ValueError(f"Unknown model: {name}")
+        with _load_locks[name]:
+            if name not in _loaded_models:
+                start = time.perf_counter()
+                _loaded_models[name] = load_model(name)
+                print(f"Loaded {name} model ({INFERENCE_BACKEND}, {MODEL_PRECISION}) in {time.perf_counter() - start:.2f} seconds")
+    return _loaded_models[name]
+
+
+def preload_models(names: List[str] = ENABLED_MODELS):
+    for name in names:
+        get_model(name)
+
+
+def preload_models_in_background(names: List[str] = ENABLED_MODELS) -> threading.Thread:
+    """
+    Warm the models on a daemon thread. Requests that need a model before it
+    is ready just wait on its load lock.
+    """
+    thread = threading.Thread(target=preload_models, args=(names,), name="model-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def _normalize_rows(embs: np.ndarray) -> np.ndarray:
+    embs /= np.linalg.norm(embs, axis=1, keepdims=True)
+    return embs
+
+
+def extract_embeddings_batch(
+    images: List[Image.Image],
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+    cnn: Optional[LoadedModel] = None,
+) -> np.ndarray:
+    """
+    Extract normalized 2048-dim embeddings for a list of PIL images.
+    Images are run through ResNet50 in chunks of at most `batch_size`.
+    Returns an (N, 2048) float32 matrix, one row per image.
+    """
+    cnn = cnn or get_model("cnn")
+    out = np.empty((len(images), CNN_EMBEDDING_DIM), dtype="float32")
+    for start in range(0, len(images), batch_size):
+        chunk = images[start:start + batch_size]
+        x = torch.stack([cnn.preprocess(_as_rgb(img)) for img in chunk])
+        out[start:start + len(chunk)] = cnn.encode_image(x)
+    return _normalize_rows(out)
+
+
+def extract_clip_embeddings_batch(
+    images: List[Image.Image],
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+    clip_encoders: Optional[LoadedModel] = None,
+) -> np.ndarray:
+    """
+    Extract normalized CLIP image embeddings for a list of PIL images.
+    Returns an (N, 512) float32 matrix, one row per image.
+    """
+    clip_encoders = clip_encoders or get_model("clip")
+    out = np.empty((len(images), CLIP_EMBEDDING_DIM), dtype="float32")
+    for start in range(0, len(images), batch_size):
+        chunk = images[start:start + batch_size]
+        x = torch.stack([clip_encoders.preprocess(_as_rgb(img)) for img in chunk])
+        out[start:start + len(chunk)] = clip_encoders.encode_image(x)
+    return _normalize_rows(out)
+
+
+def extract_clip_text_embeddings_batch(
+    texts: List[str],
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+    clip_encoders: Optional[LoadedModel] = None,
+) -> np.ndarray:
+    """
+    Extract normalized CLIP text embeddings for a list of strings.
+    Returns an (N, 512) float32 matrix, one row per text.
+    """
+    clip_encoders = clip_encoders or get_model("clip")
+    out = np.empty((len(texts), CLIP_EMBEDDING_DIM), dtype="float32")
+    for start in range(0, len(texts), batch_size):
+        chunk = texts[start:start + batch_size]
+        out[start:start + len(chunk)] = clip_encoders.encode_text(clip.tokenize(chunk, truncate=True))
+    return _normalize_rows(out)
+
+
+EMBEDDING_DIMS = {"cnn": CNN_EMBEDDING_DIM, "clip": CLIP_EMBEDDING_DIM}
+_image_batch_extractors = {"cnn": extract_embeddings_batch, "clip": extract_clip_embeddings_batch}
+_image_preprocessors = {"cnn": preprocess, "clip": clip_preprocess}
+
+
+def get_preprocess(name: str) -> Callable[[Image.Image], torch.Tensor]:
+    """Image preprocessing of model `name`; doesn't load any weights, safe to call from loader threads."""
+    return _image_preprocessors[name]
+
+
+# Bump a version when a model's weights or preprocessing change, so that
+# incremental builds re-embed every image instead of mixing old and new vectors
+_MODEL_VERSIONS = {"cnn": "resnet50-imagenet-224", "clip": f"clip-{CLIP_MODEL_NAME}-224"}
+
+
+def model_version(name: str) -> str:
+    """Identifies the embeddings model `name` currently produces (recorded in build manifests)."""
+    return f"{_MODEL_VERSIONS[name]}/{MODEL_PRECISION}"
+
+
+def embed_preprocessed_batch(name: str, x: torch.Tensor, batch_size: int = EMBEDDING_BATCH_SIZE) -> np.ndarray:
+    """
+    Run already preprocessed images (an (N, 3, H, W) tensor from `get_preprocess`)
+    through the image encoder of model `name`. Returns an (N, D) normalized float32 matrix.
+    """
+    encode_image = get_model(name).encode_image
+    out = np.empty((x.shape[0], EMBEDDING_DIMS[name]), dtype="float32")
+    for start in range(0, x.shape[0], batch_size):
+        out[start:start + batch_size] = encode_image(x[start:start + batch_size])
+    return _normalize_rows(out)
+
+
+def extract_multi_embeddings_batch(
+    images: List[Image.Image],
+    model_names: Tuple[str, ...] = ("cnn", "clip"),
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+) -> Dict[str, np.ndarray]:
+    """
+    Embed the same decoded images with several image models in one pass.
+    Each chunk is converted to RGB once and then goes through every model's
+    own preprocessing, so callers decode each file exactly once.
+    Returns {model_name: (N, D) float32 matrix}.
+    """
+    out = {name: np.empty((len(images), EMBEDDING_DIMS[name]), dtype="float32") for name in model_names}
+    for start in range(0, len(images), batch_size):
+        chunk = [_as_rgb(img) for img in images[start:start + batch_size]]
+        for name in model_names:
+            out[name][start:start + len(chunk)] = _image_batch_extractors[name](chunk, batch_size)
+    return out
+
+
+def extract_embedding(image: Image.Image) -> np.ndarray:
+    """
+    Extract a normalized 2048-dim embedding from a PIL image.
+    """
+    return extract_embeddings_batch([image])[0]
 
 
 def extract_clip_embedding(image: Image.Image) -> np.ndarray:
     """
     Extract a normalized embedding from a PIL image using CLIP model.
     """
-    image = image.convert("RGB")
-    # Preprocess image for CLIP
-    x = clip_preprocess(image).unsqueeze(0).to(device)
-    with torch.no_grad():
-        emb = clip_model.encode_image(x)
-    emb = emb.squeeze().cpu().numpy()
-    emb /= np.linalg.norm(emb)
-    return emb.astype("float32")
+    return extract_clip_embeddings_batch([image])[0]
 
 
 def extract_clip_text_embedding(text: str) -> np.ndarray:
-    # print(f"Extracting clip text embedding for '{text}'...")
-    tokens = clip.tokenize([text], truncate=True).to(device)  # tokenize returns a tensor
-    with torch.no_grad():
-        text_emb = clip_model.encode_text(tokens)
-    text_emb = text_emb / text_emb.norm(dim=-1, keepdim=True)  # normalize embeddings
-    return text_emb.squeeze().cpu().numpy().astype("float32")
\ No newline at end of file
+    return extract_clip_text_embeddings_batch([text])[0]
@@ -1,9 +1,11 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional, Literal
+from typing import Dict, List, Optional, Literal
 
 class SearchRequest(BaseModel):
     method: str = Field(description="Search method")
     top_k: int = Field(default=5, ge=1, le=50, description="Number of top results to return")
+    group_by_item: bool = Field(default=False, description="Return top_k distinct items with their best-matching image")
+    filters: Dict[str, List[str]] = Field(default_factory=dict, description="Accepted values per attribute: category, stone, stone_color, price_band")
 
 class SearchResultItem(BaseModel):
     image_id: str
@@ -0,0 +1,175 @@
+import os
+import re
+import json
+import shutil
+import numpy as np
+import faiss
+from typing import Dict, List, Optional, Tuple
+from app.config import CATEGORY_ROUTE_MIN_CONFIDENCE, CATEGORY_ROUTE_MAX_PARTITIONS, FAISS_RERANK_K
+from app.search import RerankedIndex, VectorStore, load_index, save_index, search_batch, vectors_path, _is_compressed
+
+# CLIP's logit scale: prompt similarities * 100 before the softmax
+_CLIP_LOGIT_SCALE = 100.0
+
+
+def partitions_dir(index_path: str) -> str:
+    """Folder next to an index holding its per-category sub-indexes."""
+    return index_path + ".partitions"
+
+
+def _slug(category: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", category.lower()).strip("_") or "none"
+
+
+class CategoryRouter:
+    """
+    Zero-shot CLIP classifier of a query image over the catalog categories:
+    softmax of the query's similarity to one precomputed text prompt embedding
+    per category. Routes to the most likely categories until their probability
+    adds up to `min_confidence` (at most `max_partitions` of them); when that
+    isn't reached the query is left to the global index.
+    """
+
+    def __init__(
+        self,
+        categories: List[str],
+        prompt_embeddings: np.ndarray,
+        min_confidence: float = CATEGORY_ROUTE_MIN_CONFIDENCE,
+        max_partitions: int = CATEGORY_ROUTE_MAX_PARTITIONS,
+    ):
+        self.categories = categories
+        norms = np.maximum(np.linalg.norm(prompt_embeddings, axis=1, keepdims=True), 1e-12)
+        self.prompt_embeddings = (prompt_embeddings / norms).astype("float32")
+        self.min_confidence = min_confidence
+        self.max_partitions = max_partitions
+
+    def probabilities(self, clip_emb: np.ndarray) -> np.ndarray:
+        query = np.asarray(clip_emb, dtype="float32").reshape(-1)
+        logits = _CLIP_LOGIT_SCALE * (self.prompt_embeddings @ (query / max(np.linalg.norm(query), 1e-12)))
+        logits -= logits.max()
+        probs = np.exp(logits)
+        return probs / probs.sum()
+
+    def route(self, clip_emb: np.ndarray) -> Optional[List[str]]:
+        """Categories to search, or None for the global index."""
+        probs = self.probabilities(clip_emb)
+        order = np.argsort(-probs)[:self.max_partitions]
+        covered = np.cumsum(probs[order])
+        enough = np.flatnonzero(covered >= self.min_confidence)
+        if not len(enough):
+            return None
+        return [self.categories[i] for i in order[:enough[0] + 1].tolist()]
+
+
+class PartitionedIndex:
+    """
+    A global index plus one sub-index per category, all using the same faiss
+    ids (so metadata and filters work unchanged). search() scans only the
+    partitions the router picks for the query and falls back to the global
+    index when routing is unsure, a routed category has no sub-index, or the
+    partitions return fewer than top_k hits.
+
+    Products added after the partitions were built (AddController only adds to
+    the global index; new products have no category metadata) are missing from
+    them. So once the global index no longer holds the `image_count` images it
+    had at partition build time, every query goes to the global index until
+    the partitions are rebuilt (build_category_partitions).
+    """
+
+    def __init__(
+        self,
+        global_index: faiss.Index,
+        partitions: Dict[str, faiss.Index],
+        router: CategoryRouter,
+        image_count: Optional[int] = None,
+    ):
+        self.index = global_index
+        self.partitions = partitions
+        self.router = router
+        self.image_count = image_count
+
+    @property
+    def current(self) -> bool:
+        """Whether the partitions still cover the global index (None: unknown, assumed current)."""
+        return self.image_count is None or self.index.ntotal == self.image_count
+
+    @property
+    def d(self) -> int:
+        return self.index.d
+
+    @classmethod
+    def load(cls, index_path: str, global_index: Optional[faiss.Index] = None) -> Optional["PartitionedIndex"]:
+        """The partitions saved next to `index_path`, None when there are none."""
+        folder = partitions_dir(index_path)
+        if not os.path.exists(os.path.join(folder, "partitions.json")):
+            return None
+        with open(os.path.join(folder, "partitions.json"), "r") as f:
+            info = json.load(f)
+        global_index = global_index if global_index is not None else load_index(index_path)
+
+        # Compressed sub-indexes re-rank from the global index's vectors (same ids)
+        store = None
+        if os.path.exists(vectors_path(index_path)):
+            store = VectorStore.open(index_path, global_index.d)
+        partitions = {}
+        for category, file_name in info["files"].items():
+            index = load_index(os.path.join(folder, file_name))
+            if store is not None and _is_compressed(index) and not isinstance(index, RerankedIndex):
+                index = RerankedIndex(index, store, info.get("rerank_k") or FAISS_RERANK_K)
+            partitions[category] = index
+
+        prompts = np.load(os.path.join(folder, "prompts.npy"))
+        print(f"Loaded {len(partitions)} category partitions of {index_path}")
+        index = cls(global_index, partitions, CategoryRouter(info["categories"], prompts), info.get("image_count"))
+        if not index.current:
+            print(f"Warning: {index_path} changed since its partitions were built, searching the global index only.")
+        return index
+
+    def search(
+        self,
+        query_emb: np.ndarray,
+        top_k: int,
+        route_emb: Optional[np.ndarray] = None,
+        **search_kwargs,
+    ) -> Tuple[List[int], List[float]]:
+        """Top-k of one query like app.search.search; `route_emb` is its CLIP image embedding."""
+        categories = self.router.route(route_emb) if route_emb is not None and self.current else None
+        if categories and all(category in self.partitions for category in categories):
+            ids, scores = [], []
+            for category in categories:
+                part_ids, part_scores = search_batch(self.partitions[category], query_emb.reshape(1, -1), top_k, **search_kwargs)
+                ids.extend(part_ids[0])
+                scores.extend(part_scores[0])
+            if len(ids) >= top_k:
+                order = np.argsort(-np.asarray(scores), kind="stable")[:top_k]
+                return [ids[i] for i in order], [scores[i] for i in order]
+        ids, scores = search_batch(self.index, query_emb.reshape(1, -1), top_k, **search_kwargs)
+        return ids[0], scores[0]
+
+
+def save_partitions(
+    index_path: str,
+    partitions: Dict[str, faiss.Index],
+    categories: List[str],
+    prompt_embeddings: np.ndarray,
+    rerank_k: Optional[int] = None,
+    image_count: Optional[int] = None,
+):
+    """
+    Write the sub-indexes, the category list and the prompt embeddings into
+    partitions_dir(index_path), replacing the previous set as a whole.
+    `image_count` is the size of the global index they were built from.
+    """
+    folder = partitions_dir(index_path)
+    tmp_folder = folder + ".tmp"
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+    files = {}
+    for number, (category, index) in enumerate(partitions.items()):
+        files[category] = f"{number}_{_slug(category)}.index"
+        save_index(index, os.path.join(tmp_folder, files[category]))
+    np.save(os.path.join(tmp_folder, "prompts.npy"), np.asarray(prompt_embeddings, dtype="float32"))
+    with open(os.path.join(tmp_folder, "partitions.json"), "w") as f:
+        json.dump({"categories": categories, "files": files, "rerank_k": rerank_k, "image_count": image_count}, f)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp_folder, folder)
@@ -1,6 +1,8 @@
+from typing import Optional
 from fastapi import APIRouter, Form, UploadFile, File, Depends
 from app.models.search_models import SearchRequest, SearchResponse
 from app.controllers.search_controller import SearchController
+from app.filters import parse_filters
 
 router = APIRouter()
 
@@ -9,14 +11,22 @@ search_controller: SearchController = None  # Initialized in main.py
 async def search_image(
     file: UploadFile = File(...),
     method: str = Form("cnn_faiss", description="Search method: cnn_faiss or clip_faiss"),
-    top_k: int = Form(5, ge=1, le=50, description="Number of top results to return")
+    top_k: int = Form(5, ge=1, le=50, description="Number of top results to return"),
+    group_by_item: bool = Form(False, description="Return top_k distinct items with their best-matching image"),
+    category: Optional[str] = Form(None, description="Only these categories (comma-separated)"),
+    stone: Optional[str] = Form(None, description="Only these stones (comma-separated)"),
+    stone_color: Optional[str] = Form(None, description="Only these stone colors (comma-separated)"),
+    price_band: Optional[str] = Form(None, description="Only these price bands, e.g. 100-250,1000+ (comma-separated)"),
 ):
-    print(f"Received search request: method={method}, top_k={top_k}")
+    filters = parse_filters({"category": category, "stone": stone, "stone_color": stone_color, "price_band": price_band})
+    print(f"Received search request: method={method}, top_k={top_k}, group_by_item={group_by_item}, filters={filters}")
     class Params:
-        def __init__(self, method, top_k):
+        def __init__(self, method, top_k, group_by_item, filters):
             self.method = method
             self.top_k = top_k
+            self.group_by_item = group_by_item
+            self.filters = filters
 
-    params = Params(method, top_k)
+    params = Params(method, top_k, group_by_item, filters)
     results = await search_controller.search(file, params)
     return SearchResponse(results=results)
\ No newline at end of file
@@ -1,18 +1,349 @@
+import os
+import re
 import faiss
 import json
+import time
+import hashlib
+import tempfile
 import numpy as np
-from typing import List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from app.config import (
+    FAISS_INDEX_SPEC,
+    FAISS_HNSW_EF_CONSTRUCTION,
+    FAISS_TRAIN_SIZE,
+    FAISS_NPROBE,
+    FAISS_EF_SEARCH,
+    FAISS_RERANK_K,
+    FAISS_MMAP,
+)
 
-def load_index(index_path: str) -> faiss.IndexFlatIP:
-    return faiss.read_index(index_path)
+def faiss_id(key) -> int:
+    """
+    Stable 63-bit FAISS id of an image_id (or item_id): the same key gets the
+    same id in every build and process, so ids never depend on insertion order.
+    """
+    digest = hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & ((1 << 63) - 1)
+
+def faiss_ids(keys: Iterable) -> np.ndarray:
+    return np.fromiter((faiss_id(key) for key in keys), dtype="int64")
+
+def _params_path(index_path: str) -> str:
+    """JSON sidecar with the query-time knobs (nprobe / efSearch) of an index."""
+    return index_path + ".params.json"
+
+class VectorStore:
+    """
+    The float32 vectors of an index, memory-mapped from `vectors_path(index_path)`,
+    with the faiss id of each row from `ids_path(index_path)` (without an ids
+    file the row number is the id). Works the same for every index type, since
+    it never asks the index for its vectors.
+    """
+
+    def __init__(self, vectors: np.ndarray, ids: Optional[np.ndarray] = None):
+        self.vectors = vectors
+        if ids is not None and len(ids):
+            self._order = np.argsort(ids, kind="stable")
+            self._sorted_ids = np.asarray(ids)[self._order]
+        else:
+            self._order = self._sorted_ids = None
+
+    @classmethod
+    def open(cls, index_path: str, dim: int) -> "VectorStore":
+        ids = open_ids(ids_path(index_path)) if os.path.exists(ids_path(index_path)) else None
+        return cls(open_vectors(vectors_path(index_path), dim), ids)
+
+    @staticmethod
+    def save(index_path: str, ids: np.ndarray, vectors: np.ndarray):
+        """Write the vectors and ids files of an index built in memory (atomic, like save_index)."""
+        for path, array in ((vectors_path(index_path), np.asarray(vectors, dtype="float32")),
+                            (ids_path(index_path), np.asarray(ids, dtype="int64"))):
+            array.tofile(path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    def rows(self, ids: Iterable[int]) -> np.ndarray:
+        """Row of each id, -1 for ids that aren't stored."""
+        ids = np.asarray(ids, dtype="int64")
+        if self._sorted_ids is None:
+            return np.where((ids >= 0) & (ids < len(self)), ids, -1)
+        pos = np.minimum(np.searchsorted(self._sorted_ids, ids), len(self._sorted_ids) - 1)
+        return np.where(self._sorted_ids[pos] == ids, self._order[pos], -1)
+
+    def get(self, ids: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (len(ids), dim) matrix of the vectors of `ids` and a mask of the ids that
+        were found (rows of missing ids are zero). Rows are read with one sorted
+        fancy index, so the memmap is read in file order.
+        """
+        rows = self.rows(ids)
+        found = rows >= 0
+        out = np.zeros((len(rows), self.dim), dtype="float32")
+        wanted = np.flatnonzero(found)
+        wanted = wanted[np.argsort(rows[wanted], kind="stable")]
+        out[wanted] = self.vectors[rows[wanted]]
+        return out, found
+
+
+class RerankedIndex:
+    """
+    A compressed (PQ) index together with its VectorStore on disk.
+    search() takes the top `rerank_k` candidates from the compressed index and
+    re-scores them exactly (inner product) against the memory-mapped vectors,
+    so returned scores are the ones an IndexFlatIP would give. Candidates
+    added after the vectors file was written keep their compressed score.
+    Anything else is delegated to the wrapped faiss index.
+    """
+
+    def __init__(self, index: faiss.Index, store: VectorStore, rerank_k: int = FAISS_RERANK_K):
+        self.index = index
+        self.store = store
+        self.rerank_k = rerank_k
 
-def save_index(index: faiss.IndexFlatIP, index_path: str):
-    faiss.write_index(index, index_path)
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def search(self, x: np.ndarray, k: int, params=None) -> Tuple[np.ndarray, np.ndarray]:
+        x = np.ascontiguousarray(x, dtype="float32")
+        if params is None:
+            approx, candidates = self.index.search(x, max(k, self.rerank_k))
+        else:
+            approx, candidates = self.index.search(x, max(k, self.rerank_k), params=params)
+
+        D = np.full((x.shape[0], k), -np.inf, dtype="float32")
+        I = np.full((x.shape[0], k), -1, dtype="int64")
+        for q in range(x.shape[0]):
+            found = candidates[q] >= 0
+            ids, scores = candidates[q][found], approx[q][found].copy()
+            vectors, stored = self.store.get(ids)
+            scores[stored] = vectors[stored] @ x[q]
+            top = np.argsort(-scores)[:k]
+            D[q, :len(top)] = scores[top]
+            I[q, :len(top)] = ids[top]
+        return D, I
+
+def _is_compressed(index: faiss.Index) -> bool:
+    return isinstance(_base_index(index), (faiss.IndexPQ, faiss.IndexIVFPQ))
+
+def _base_index(index: faiss.Index) -> faiss.Index:
+    """The index doing the actual search, under IDMap / pre-transform / refine / re-rank wrappers."""
+    if isinstance(index, RerankedIndex):
+        index = index.index
+    index = faiss.downcast_index(index)
+    while isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2, faiss.IndexPreTransform, faiss.IndexRefine)):
+        index = faiss.downcast_index(index.base_index if isinstance(index, faiss.IndexRefine) else index.index)
+    return index
+
+def get_search_params(index: faiss.Index) -> Dict[str, int]:
+    """Current query-time knobs of `index`: nprobe for IVF, efSearch for HNSW, none for Flat."""
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexIVF):
+        return {"nprobe": base.nprobe}
+    if isinstance(base, faiss.IndexHNSW):
+        return {"efSearch": base.hnsw.efSearch}
+    return {}
+
+def set_search_params(index: faiss.Index, params: Dict[str, int]):
+    """Set nprobe / efSearch on `index` (and the wrapped index); unknown knobs are ignored."""
+    base = _base_index(index)
+    if "nprobe" in params and isinstance(base, faiss.IndexIVF):
+        base.nprobe = int(params["nprobe"])
+    if "efSearch" in params and isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = int(params["efSearch"])
+
+def _read_flags(mmap: bool, ivf: bool) -> int:
+    # On-disk IVF lists are looked up next to the index file, wherever it was written
+    flags = faiss.IO_FLAG_ONDISK_SAME_DIR
+    if mmap:
+        flags |= faiss.IO_FLAG_READ_ONLY
+    if mmap and not ivf:
+        # faiss >= 1.8 maps Flat / PQ code arrays straight from the file (IO_FLAG_MMAP_IFC);
+        # older versions only honour IO_FLAG_MMAP for inverted lists. IVF lists saved by
+        # save_index are mapped from their ivfdata file anyway, and faiss refuses to
+        # resolve that file when the index itself is read through a mapping.
+        flags |= getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    return flags
+
+def _ondisk_invlists(index: faiss.Index) -> Optional[faiss.OnDiskInvertedLists]:
+    base = _base_index(index)
+    if not isinstance(base, faiss.IndexIVF):
+        return None
+    invlists = faiss.downcast_InvertedLists(base.invlists)
+    return invlists if isinstance(invlists, faiss.OnDiskInvertedLists) else None
+
+def _save_ivf_ondisk(index: faiss.Index, index_path: str):
+    """
+    Move the inverted lists of an IVF index into a new "<index>.<n>.ivfdata" file
+    that readers mmap. The file name is new on every save, so workers still
+    mapping the previous file are unaffected; older files are removed once the
+    new index is published (open mappings keep their data alive). Lists that
+    are already on disk are copied too: their file is the one readers map now.
+    """
+    ivf = _base_index(index)
+    ivfdata_path = f"{index_path}.{time.time_ns()}.ivfdata"
+    ondisk = faiss.OnDiskInvertedLists(ivf.nlist, ivf.code_size, ivfdata_path)
+    lists = faiss.InvertedListsPtrVector()
+    lists.push_back(ivf.invlists)
+    if hasattr(ondisk, "merge_from_multiple"):
+        ondisk.merge_from_multiple(lists.data(), lists.size(), False)
+    else:
+        ondisk.merge_from(lists.data(), lists.size())
+    ivf.replace_invlists(ondisk, True)
+    ondisk.this.disown()
+
+def _load_ivf_in_memory(index: faiss.Index):
+    """
+    Copy on-disk IVF lists into RAM, so adds to an index loaded without mmap
+    never write into the ivfdata file other workers have mapped.
+    """
+    ondisk = _ondisk_invlists(index)
+    if ondisk is None:
+        return
+    ivf = _base_index(index)
+    invlists = faiss.ArrayInvertedLists(ivf.nlist, ivf.code_size)
+    for list_no in range(ivf.nlist):
+        size = ondisk.list_size(list_no)
+        if size:
+            invlists.add_entries(list_no, size, ondisk.get_ids(list_no), ondisk.get_codes(list_no))
+    ivf.replace_invlists(invlists, True)
+    invlists.this.disown()
+
+def _remove_stale_ivfdata(index_path: str, index: faiss.Index):
+    invlists = _ondisk_invlists(index)
+    current = os.path.basename(invlists.filename) if invlists is not None else None
+    folder = os.path.dirname(index_path) or "."
+    prefix = os.path.basename(index_path) + "."
+    for name in os.listdir(folder):
+        if name.startswith(prefix) and name.endswith(".ivfdata") and name != current:
+            os.remove(os.path.join(folder, name))
+
+def load_index(index_path: str, mmap: bool = FAISS_MMAP) -> faiss.Index:
+    """
+    Read an index saved by save_index and restore its query-time knobs.
+    With `mmap` the index is mapped read-only (shared between processes, no
+    full read at startup) and can't be added to; without it IVF lists are read
+    into RAM and the next save_index writes them to a new ivfdata file.
+    Compressed indexes come back as a RerankedIndex over the index's
+    VectorStore when its vectors file is there.
+    """
+    params = None
+    if os.path.exists(_params_path(index_path)):
+        with open(_params_path(index_path), "r") as f:
+            params = json.load(f)
+    ivf = params is not None and params["type"].startswith("IndexIVF")
+
+    index = faiss.read_index(index_path, _read_flags(mmap, ivf))
+    if not mmap:
+        _load_ivf_in_memory(index)
+    if mmap and not hasattr(faiss, "IO_FLAG_MMAP_IFC") and not isinstance(_base_index(index), faiss.IndexIVF):
+        print(f"Warning: this faiss has no IO_FLAG_MMAP_IFC, {index_path} was read into RAM "
+              f"(FAISS_MMAP only maps IVF inverted lists here, not shared between workers).")
+    if params is None:
+        return index
+
+    # faiss doesn't serialize every query-time knob (e.g. nprobe); restore them from the sidecar
+    set_search_params(index, params["search_params"])
+
+    if params.get("rerank_k") and os.path.exists(vectors_path(index_path)):
+        return RerankedIndex(index, VectorStore.open(index_path, index.d), params["rerank_k"])
+    if params.get("rerank_k"):
+        print(f"Warning: {vectors_path(index_path)} not found, searching {index_path} without exact re-ranking.")
+    return index
+
+def _temp_path(path: str) -> str:
+    """New empty file next to `path` (same filesystem, so os.replace is atomic)."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+    os.chmod(tmp_path, 0o644)  # mkstemp creates 0600; the published file must stay readable by other workers
+    return tmp_path
+
+def save_index(index: faiss.Index, index_path: str, mmap: bool = FAISS_MMAP):
+    """
+    Save `index` and its params sidecar. With `mmap`, IVF indexes are written
+    in the on-disk format (lists in a separate ivfdata file) that load_index maps.
+    """
+    raw_index = index.index if isinstance(index, RerankedIndex) else index
+    if mmap and isinstance(_base_index(raw_index), faiss.IndexIVF):
+        _save_ivf_ondisk(raw_index, index_path)
+
+    # Write next to the target and rename, so readers never see a half-written index;
+    # the temp names are unique so overlapping saves can't write into the same file
+    tmp_path = _temp_path(index_path)
+    params_tmp_path = _temp_path(_params_path(index_path))
+    try:
+        faiss.write_index(raw_index, tmp_path)
+        params = {"type": type(_base_index(index)).__name__, "search_params": get_search_params(index)}
+        if _is_compressed(index):
+            params["rerank_k"] = index.rerank_k if isinstance(index, RerankedIndex) else FAISS_RERANK_K
+        with open(params_tmp_path, "w") as f:
+            json.dump(params, f)
+        os.replace(params_tmp_path, _params_path(index_path))
+        os.replace(tmp_path, index_path)
+    finally:
+        for path in (tmp_path, params_tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+    _remove_stale_ivfdata(index_path, raw_index)
 
 def load_image_paths(json_path: str) -> List[str]:
     with open(json_path, "r") as f:
         return json.load(f)
 
+_JSON_ARRAY_SEPARATORS = re.compile(r"[\s,]*")
+# Characters that may follow a complete array element
+_JSON_ELEMENT_ENDS = frozenset(",] \t\r\n")
+
+
+def iter_json_array(json_path: str, chunk_size: int = 1 << 16) -> Iterator:
+    """
+    Yield the elements of a file holding one top-level JSON array, reading it
+    in chunks instead of json.load-ing the whole list into memory.
+    """
+    decoder = json.JSONDecoder()
+    with open(json_path, "r") as f:
+        # Leading whitespace may be longer than a chunk
+        buf = ""
+        while not buf:
+            more = f.read(chunk_size)
+            if not more:
+                break
+            buf = more.lstrip()
+        if not buf.startswith("["):
+            raise ValueError(f"{json_path} does not contain a JSON array")
+        pos = 1
+        while True:
+            pos = _JSON_ARRAY_SEPARATORS.match(buf, pos).end()
+            if pos == len(buf):
+                more = f.read(chunk_size)
+                if not more:
+                    raise ValueError(f"{json_path}: unterminated JSON array")
+                buf, pos = more, 0
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                item, end = None, None
+            # Complete only when followed by a separator: a number cut inside the
+            # chunk ("2." of "2.5", "1.5" of "1.5e10") still decodes as a shorter prefix
+            if end is None or end == len(buf) or buf[end] not in _JSON_ELEMENT_ENDS:
+                more = f.read(chunk_size)
+                if more:
+                    buf, pos = buf[pos:] + more, 0
+                    continue
+                if end is None or (end < len(buf) and buf[end] not in _JSON_ELEMENT_ENDS):
+                    raise ValueError(f"{json_path}: invalid JSON array")
+            yield item
+            pos = end
+
+
 def load_embedding_metadata(json_path: str) -> List[str]:
     with open(json_path, "r") as f:
         return json.load(f)
@@ -25,27 +356,165 @@ def save_image_paths(paths: List[str], json_path: str):
     with open(json_path, "w") as f:
         json.dump(paths, f, indent=2)
 
-def build_faiss_index(embeddings: np.ndarray) -> faiss.IndexFlatIP:
+def _training_sample(embeddings: np.ndarray, train_size: int) -> np.ndarray:
+    if embeddings.shape[0] <= train_size:
+        return np.ascontiguousarray(embeddings, dtype="float32")
+    # Sorted rows so a memory-mapped matrix is read front to back
+    rows = np.sort(np.random.default_rng(0).choice(embeddings.shape[0], train_size, replace=False))
+    return np.ascontiguousarray(embeddings[rows], dtype="float32")
+
+def build_faiss_index(
+    embeddings: np.ndarray,
+    chunk_size: int = 65536,
+    spec: str = FAISS_INDEX_SPEC,
+    search_params: Optional[Dict[str, int]] = None,
+    ids: Optional[np.ndarray] = None,
+) -> faiss.Index:
+    """
+    Build an inner-product index of type `spec` (a faiss.index_factory string,
+    FAISS_INDEX_SPEC by default) over `embeddings`. IVF quantizers are trained
+    on a sample of FAISS_TRAIN_SIZE rows; HNSW uses FAISS_HNSW_EF_CONSTRUCTION.
+    `search_params` (nprobe / efSearch) default to FAISS_NPROBE / FAISS_EF_SEARCH
+    and are saved with the index by save_index.
+    With `ids` (one int64 per row, see faiss_ids) the index is an IndexIDMap2
+    that returns those ids and supports add / remove / update by id;
+    without, results are row numbers.
+    """
     dimension = embeddings.shape[1]
-    index = faiss.IndexFlatIP(dimension)
-    index.add(embeddings)
+    if spec == "Flat":
+        index = faiss.IndexFlatIP(dimension)
+    else:
+        index = faiss.index_factory(dimension, spec, faiss.METRIC_INNER_PRODUCT)
+
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexIVF) and embeddings.shape[0] < base.nlist:
+        # e.g. the small CLIP text index with a spec sized for the image catalog
+        print(f"Only {embeddings.shape[0]} vectors for {base.nlist} IVF lists, building a Flat index instead.")
+        return build_faiss_index(embeddings, chunk_size, "Flat", search_params, ids)
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efConstruction = FAISS_HNSW_EF_CONSTRUCTION
+    if not index.is_trained:
+        print(f"Training {spec} index on {min(FAISS_TRAIN_SIZE, embeddings.shape[0])} vectors...")
+        index.train(_training_sample(embeddings, FAISS_TRAIN_SIZE))
+
+    if ids is not None:
+        index = faiss.IndexIDMap2(index)
+        ids = np.ascontiguousarray(ids, dtype="int64")
+
+    # Add in chunks, so a memory-mapped matrix is paged in piece by piece
+    # instead of being read into RAM as a whole next to the index's own copy
+    for start in range(0, embeddings.shape[0], chunk_size):
+        chunk = np.ascontiguousarray(embeddings[start:start + chunk_size], dtype="float32")
+        if ids is None:
+            index.add(chunk)
+        else:
+            index.add_with_ids(chunk, ids[start:start + chunk_size])
+
+    set_search_params(index, search_params or {"nprobe": FAISS_NPROBE, "efSearch": FAISS_EF_SEARCH})
     return index
 
-def search(index: faiss.IndexFlatIP, query_emb: np.ndarray, top_k: int = 5) -> Tuple[List[int], List[float]]:
-    D, I = index.search(query_emb.reshape(1, -1), top_k)
-    return I[0].tolist(), D[0].tolist()
+def vectors_path(index_path: str) -> str:
+    """Raw float32 (ntotal, dim) matrix kept next to an index by the builders, rows in build order."""
+    return index_path + ".vectors.f32"
+
+def ids_path(index_path: str) -> str:
+    """Raw int64 file next to `vectors_path(index_path)`: the faiss id of each of its rows."""
+    return index_path + ".vectors.ids"
+
+def open_vectors(path: str, dim: int, mode: str = "r") -> np.memmap:
+    rows = os.path.getsize(path) // (dim * 4)
+    return np.memmap(path, dtype="float32", mode=mode, shape=(rows, dim))
+
+def open_ids(path: str, mode: str = "r") -> np.memmap:
+    return np.memmap(path, dtype="int64", mode=mode, shape=(os.path.getsize(path) // 8,))
 
-def get_embeddings_by_indices(index: faiss.IndexFlatIP, indices: List[int]) -> np.ndarray:
+def _id_mapped(index: faiss.Index) -> faiss.Index:
+    """The IndexIDMap(2) of `index` (under a RerankedIndex); positional indexes can't be changed by id."""
+    raw = faiss.downcast_index(index.index if isinstance(index, RerankedIndex) else index)
+    if not isinstance(raw, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        raise ValueError("Index has positional ids, rebuild it to add / remove / update by id.")
+    return raw
+
+def add_vectors(index: faiss.Index, ids: np.ndarray, vectors: np.ndarray):
+    """Add `vectors` under `ids` (see faiss_ids). Ids already in the index are duplicated, use update_vectors."""
+    vectors = np.ascontiguousarray(vectors.reshape(-1, index.d), dtype="float32")
+    _id_mapped(index).add_with_ids(vectors, np.ascontiguousarray(ids, dtype="int64"))
+
+def remove_vectors(index: faiss.Index, ids: Iterable[int]) -> int:
     """
-    Retrieves original embeddings from FAISS index for the given indices.
+    Remove the vectors of `ids`, returns how many were removed.
+    Flat and IVF indexes support it, HNSW doesn't (faiss raises).
     """
-    if not hasattr(index, 'xb'):
-        raise ValueError("This FAISS index does not store embeddings directly.")
+    return _id_mapped(index).remove_ids(make_id_selector(ids))
+
+def update_vectors(index: faiss.Index, ids: np.ndarray, vectors: np.ndarray):
+    """Replace the vectors stored under `ids` (adding those that aren't there yet)."""
+    remove_vectors(index, ids)
+    add_vectors(index, ids, vectors)
 
-    total = index.ntotal
-    valid_indices = [i for i in indices if 0 <= i < total]
+def _search_parameters(
+    index: faiss.Index,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    id_selector: Optional[faiss.IDSelector] = None,
+):
+    """
+    Per-call faiss.SearchParameters, so one query's knobs don't change the shared index.
+    Knobs that aren't given keep the index's own values (a SearchParameters
+    object would otherwise reset them to the faiss defaults).
+    """
+    if nprobe is None and ef_search is None and id_selector is None:
+        return None
+    base = _base_index(index)
+    kwargs = {} if id_selector is None else {"sel": id_selector}
+    if isinstance(base, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe=nprobe or base.nprobe, **kwargs)
+    if isinstance(base, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=ef_search or base.hnsw.efSearch, **kwargs)
+    return faiss.SearchParameters(**kwargs) if kwargs else None
+
+def make_id_selector(ids: Iterable[int]) -> faiss.IDSelector:
+    """IDSelector restricting a search to `ids` (the ids the index returns)."""
+    ids = np.ascontiguousarray(np.fromiter(ids, dtype="int64"))
+    return faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))
+
+def search_batch(
+    index: faiss.Index,
+    query_embs: np.ndarray,
+    top_k: int = 5,
+    id_selector: Optional[faiss.IDSelector] = None,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+) -> Tuple[List[List[int]], List[List[float]]]:
+    """
+    Top-k of M queries in one call: `query_embs` is an (M, D) matrix, searched
+    as one GEMM-backed batch instead of M single-row scans. Returns per-query
+    id and score lists; padding ids (-1, when fewer than top_k vectors match,
+    e.g. with an `id_selector`) are left out.
+    `nprobe` / `ef_search` override the index's stored knobs for this call only.
+    """
+    queries = np.ascontiguousarray(query_embs.reshape(-1, index.d), dtype="float32")
+    params = _search_parameters(index, nprobe, ef_search, id_selector)
+    if params is None:
+        D, I = index.search(queries, top_k)
+    else:
+        D, I = index.search(queries, top_k, params=params)
 
-    if len(valid_indices) != len(indices):
-        print("Warning: Some indices were out of bounds and have been ignored.")
+    ids, scores = [], []
+    for row_ids, row_scores in zip(I, D):
+        found = row_ids >= 0
+        ids.append(row_ids[found].tolist())
+        scores.append(row_scores[found].tolist())
+    return ids, scores
 
-    return np.array([index.xb[i] for i in valid_indices])
+def search(
+    index: faiss.Index,
+    query_emb: np.ndarray,
+    top_k: int = 5,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    id_selector: Optional[faiss.IDSelector] = None,
+) -> Tuple[List[int], List[float]]:
+    """Top-k of one query, see search_batch."""
+    ids, scores = search_batch(index, query_emb.reshape(1, -1), top_k, id_selector, nprobe, ef_search)
+    return ids[0], scores[0]
@@ -1,30 +1,73 @@
 from app.db.chroma import ChromaDBClient
+import threading
 import numpy as np
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 from app.db.mongo import embedding_cnn_faiss_metadata_col
 from app.models.search_models import SearchResultItem
-from app.search import get_embeddings_by_indices  # Adjust if needed
-from app.config import CHROMA_CLIP_IMAGE_EMBEDDINGS_COLLECTION, CHROMA_CLIP_ITEM_EMBEDDINGS_COLLECTION
+from app.config import CHROMA_CLIP_IMAGE_EMBEDDINGS_COLLECTION, CHROMA_CLIP_ITEM_EMBEDDINGS_COLLECTION, HYBRID_CANDIDATE_K
+from app.batching import MicroBatcher
+from app.executors import run_in_stage
+from app.grouping import search_grouped, best_per_item
+from app.filters import chroma_where
 
 class CLIPChromaSearch:
-    def __init__(self, chroma_client: ChromaDBClient, extract_clip_embedding, extract_clip_text_embedding):
+    def __init__(
+        self,
+        chroma_client: ChromaDBClient,
+        extract_clip_embedding,
+        extract_clip_text_embedding,
+        image_batcher: Optional[MicroBatcher] = None,
+        text_batcher: Optional[MicroBatcher] = None,
+    ):
         self.chroma_client = chroma_client
         self.extract_clip_embedding = extract_clip_embedding
         self.extract_clip_text_embedding = extract_clip_text_embedding
-
-    async def search_image(self, image, top_k: int) -> List[object]:
-        # Extract image embedding
-        emb = self.extract_clip_embedding(image)
-        emb = emb.reshape(1, -1).astype("float32") 
-        
-        results = self.chroma_client.search_embeddings(
+        self.image_batcher = image_batcher
+        self.text_batcher = text_batcher
+        # item_id -> row of the normalized item text matrix, loaded on first image+text search
+        self._item_rows: Optional[Dict[str, int]] = None
+        self._item_text_matrix: Optional[np.ndarray] = None
+        self._item_lock = threading.Lock()
+
+    def _item_text_vectors(self) -> Tuple[Dict[str, int], np.ndarray]:
+        """
+        The CLIP text vector of every item, L2-normalized, as one in-memory
+        matrix aligned with an item_id -> row dict. Read from Chroma once.
+        """
+        with self._item_lock:
+            if self._item_text_matrix is None:
+                item_ids, matrix = self.chroma_client.get_all_embeddings(CHROMA_CLIP_ITEM_EMBEDDINGS_COLLECTION)
+                if len(item_ids):
+                    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+                self._item_rows = {item_id: row for row, item_id in enumerate(item_ids)}
+                self._item_text_matrix = matrix
+                print(f"Loaded {len(item_ids)} item text vectors for image+text search")
+            return self._item_rows, self._item_text_matrix
+
+    async def _embed_image(self, image) -> np.ndarray:
+        # Concurrent queries share one forward pass when a batcher is configured
+        if self.image_batcher is not None:
+            return await self.image_batcher.submit(image)
+        return await run_in_stage("inference", self.extract_clip_embedding, image)
+
+    async def _embed_text(self, text: str) -> np.ndarray:
+        if self.text_batcher is not None:
+            return await self.text_batcher.submit(text)
+        return await run_in_stage("inference", self.extract_clip_text_embedding, text)
+
+    async def _search_embedding(self, emb, top_k: int, filters: Optional[Dict[str, List[str]]] = None) -> List[object]:
+        results = await run_in_stage(
+            "db",
+            self.chroma_client.search_embeddings,
             collection_name=CHROMA_CLIP_IMAGE_EMBEDDINGS_COLLECTION,
             query_embedding=emb[0],
-            top_k=top_k
+            top_k=top_k,
+            where=chroma_where(filters)
         )
 
-        image_results = results['metadatas']
-        distances = results['distances']
+        # One query, so the first list of each field
+        image_results = results['metadatas'][0]
+        distances = results['distances'][0]
 
         results = []
         for i, metadata in enumerate(image_results):
@@ -40,6 +83,17 @@ class CLIPChromaSearch:
             })
         
         return results
+
+    async def search_image(self, image, top_k: int, filters: Optional[Dict[str, List[str]]] = None) -> List[object]:
+        # Extract image embedding
+        emb = await self._embed_image(image)
+        emb = emb.reshape(1, -1).astype("float32") 
+        return await self._search_embedding(emb, top_k, filters)
+
+    async def search_items(self, image, top_k: int, filters: Optional[Dict[str, List[str]]] = None) -> List[object]:
+        """Top_k distinct items, each with its best-matching image (embedded once, scan widened as needed)."""
+        emb = (await self._embed_image(image)).reshape(1, -1).astype("float32")
+        return await search_grouped(lambda n: self._search_embedding(emb, n, filters), top_k)
     
     async def search_image_and_text(
         self,
@@ -48,73 +102,70 @@ class CLIPChromaSearch:
         top_k: int,
         text_weight: float = 0.4,
         image_weight: float = 0.6,
+        group_by_item: bool = False,
+        filters: Optional[Dict[str, List[str]]] = None,
     ) -> List[SearchResultItem]:
-        # Extract image embedding
-        image_emb = self.extract_clip_embedding(image).reshape(1, -1).astype("float32")
-        
-        # Search image embeddings
-        image_results = self.chroma_client.search_embeddings(
+        # Encode the image and (once) the query text
+        image_emb = (await self._embed_image(image)).reshape(1, -1).astype("float32")
+        query_text_emb = await self._embed_text(query_text) if query_text else None
+
+        # Over-fetch image candidates, re-ranking them with text scores is one matvec
+        image_results = await run_in_stage(
+            "db",
+            self.chroma_client.search_embeddings,
             collection_name=CHROMA_CLIP_IMAGE_EMBEDDINGS_COLLECTION,
             query_embedding=image_emb[0],
-            top_k=top_k
-        )   
-
-        # print(f"image results {image_results}")
-        
-        # Extract item_ids from image results
-        item_ids = list({result.get("item_id") for result in image_results['metadatas'][0]})
-
-
-        # Fetch corresponding text embeddings for the items
-        text_results = self.chroma_client.get_item_embeddings(
-            item_ids=item_ids,
-            collection_name=CHROMA_CLIP_ITEM_EMBEDDINGS_COLLECTION
+            top_k=max(top_k, HYBRID_CANDIDATE_K),
+            where=chroma_where(filters)
         )
-        print(" ")
-        print(f"text results: {text_results}")
-        print(" ")
-        text_embeddings = {}
-        for idx, item_id in enumerate(text_results['ids']):
-            text_embeddings[item_id] = text_results['embeddings'][idx]
-
-
-        combined_results = []
-        for idx, image_metadata in enumerate(image_results['metadatas'][0]):
-            # print(f"image metadata: {image_metadata}")
-            item_id = image_metadata.get("item_id")
-            image_id = image_metadata.get("image_id")
-            image_path = image_metadata.get("image_path")
-            img_score = 1.0 - image_results['distances'][0][idx]  # convert distance to similarity
-            
-            # Get the corresponding text embedding
-            text_emb = text_embeddings.get(item_id)
-            text_score = 0.0
-            if text_emb is not None:
-                text_score = self._cosine_similarity(self.extract_clip_text_embedding(query_text), text_emb)
-            
-            # Compute the weighted sum of scores
-            combined_score = (image_weight * img_score) + (text_weight * text_score)
-            
-            combined_results.append({
-                "image_id": str(image_id),
-                "item_id": item_id,
-                "image_path": image_path,
-                "image_score": float(img_score),
-                "text_score": float(text_score),
-                "combined_score": float(combined_score)
+        candidates = image_results['metadatas'][0]
+        if not candidates:
+            return []
+        img_scores = 1.0 - np.asarray(image_results['distances'][0], dtype="float32")  # convert distance to similarity
+
+        # Text score of each candidate's item: rows of the item matrix times the normalized query
+        text_scores = np.zeros(len(candidates), dtype="float32")
+        if query_text_emb is not None:
+            item_rows, item_matrix = await run_in_stage("db", self._item_text_vectors)
+            rows = np.array([item_rows.get(meta.get("item_id"), -1) for meta in candidates], dtype="int64")
+            has_text = rows >= 0
+            if has_text.any():
+                query = np.asarray(query_text_emb, dtype="float32").reshape(-1)
+                query = query / max(np.linalg.norm(query), 1e-12)
+                text_scores[has_text] = item_matrix[rows[has_text]] @ query
+
+        # Weighted sum of both scores, top_k by argpartition then sorted
+        # (grouped by item: every candidate in combined order, then the best per item)
+        combined = image_weight * img_scores + text_weight * text_scores
+        if group_by_item:
+            top = np.argsort(-combined, kind="stable")
+        else:
+            k = min(top_k, len(combined))
+            top = np.argpartition(-combined, k - 1)[:k]
+            top = top[np.argsort(-combined[top])]
+
+        top_k_results = []
+        for idx in top.tolist():
+            image_metadata = candidates[idx]
+            top_k_results.append({
+                "image_id": str(image_metadata.get("image_id")),
+                "item_id": image_metadata.get("item_id"),
+                "image_path": image_metadata.get("image_path"),
+                "image_score": float(img_scores[idx]),
+                "text_score": float(text_scores[idx]),
+                "combined_score": float(combined[idx])
             })
+        if group_by_item:
+            top_k_results = best_per_item(top_k_results, top_k)
 
-        # Sort by combined score
-        combined_results.sort(key=lambda x: x['combined_score'], reverse=True)
-
-        top_k_results = combined_results[:top_k]
         top_k_image_ids = [int(result["image_id"]) for result in top_k_results]
         
         print(f"top_k_image_ids: {top_k_image_ids}")
 
         # Fetch metadata for top_k_image_ids
-        metadata_docs = list(
-            embedding_cnn_faiss_metadata_col.find({"image_id": {"$in": top_k_image_ids}})
+        metadata_docs = await run_in_stage(
+            "db",
+            lambda: list(embedding_cnn_faiss_metadata_col.find({"image_id": {"$in": top_k_image_ids}}))
         )
 
         image_path_map = {
@@ -128,7 +179,3 @@ class CLIPChromaSearch:
         print(f"top_k_results: {top_k_results}")
 
         return top_k_results
-    
-    def _cosine_similarity(self, emb1: np.ndarray, emb2: np.ndarray) -> float:
-        """Compute cosine similarity between two embeddings"""
-        return np.dot(emb1, emb2) / (np.linalg.norm(emb1) * np.linalg.norm(emb2))
@@ -1,54 +1,87 @@
 from PIL import Image
-from typing import List, Optional
+from typing import Dict, List, Optional
 from app.models.search_models import SearchResultItem
-from app.db.mongo import embedding_clip_faiss_metadata_col, embedding_clip_faiss_text_metadata_col
+from app.db.mongo import embedding_clip_faiss_metadata_col, products_col
 import numpy as np
-from app.search import get_embeddings_by_indices
+from app.search import VectorStore, faiss_ids
+from app.metadata_table import MetadataTable
+from app.grouping import search_grouped
+from app.filters import FilterIndex, filtered_selector
+from app.partitions import PartitionedIndex
+from app.item_index import ItemCentroidIndex
+from app.batching import MicroBatcher
+from app.executors import run_in_stage
+from app.config import CLIP_FAISS_INDEX_TEXT_PATH
 
 class CLIPFaissSearch:
-    def __init__(self, index, text_index, extract_clip_embedding, extract_clip_text_embedding, search_func):
+    def __init__(self, index, text_index, extract_clip_embedding, extract_clip_text_embedding, search_func, metadata: MetadataTable = None, text_vectors: VectorStore = None, filter_index: FilterIndex = None, partitions: PartitionedIndex = None, item_index: ItemCentroidIndex = None,
+                 image_batcher: Optional[MicroBatcher] = None, text_batcher: Optional[MicroBatcher] = None):
         self.index = index
         self.text_index = text_index
         self.extract_embedding = extract_clip_embedding
         self.extract_text_embedding = extract_clip_text_embedding
         self.search = search_func
-
-    async def search_image(self, image: Image.Image, top_k: int) -> List[SearchResultItem]:
-        # Extract embedding (assumed synchronous)
-        emb = self.extract_embedding(image)  # numpy array shape (dim,)
-        emb = emb.reshape(1, -1).astype('float32')  # FAISS expects 2D array
-
-        print("inside the search image clip method")
-
-        # Perform FAISS search: FAISS returns (scores, indices)
-        indices, scores = self.search(self.index, emb, top_k)
-        print("the scores and indices", scores, indices)
-
-        results: List[SearchResultItem] = []
-
-        # Iterate over the first query's results (assuming single query)
-        for idx, score in zip(indices, scores):
-            # Skip invalid indices
-            if idx == -1:
-                continue
-
-            embedding_doc = embedding_clip_faiss_metadata_col.find_one({"faiss_index": int(idx)})
-            if not embedding_doc:
-                continue
-
-            image_id = embedding_doc.get("image_id")
-            image_path = embedding_doc.get("image_path")
-            item_id = embedding_doc.get("item_id")
-
-            results.append({
-                "image_id": str(image_id),
-                "item_id": item_id,
-                "image_path": image_path,
-                "score": float(score)
-            })
-
-        return results
+        # faiss_id -> image metadata, in memory; share it with AddController so adds show up
+        self.metadata = metadata if metadata is not None else MetadataTable.from_collection(embedding_clip_faiss_metadata_col)
+        # Text vector of every item, memory-mapped and keyed by faiss_id(item_id)
+        self.text_vectors = text_vectors if text_vectors is not None else VectorStore.open(CLIP_FAISS_INDEX_TEXT_PATH, text_index.d)
+        # Attribute bitmaps over the index's ids, applied inside the search as an IDSelector
+        self.filter_index = filter_index if filter_index is not None else FilterIndex.from_collections(embedding_clip_faiss_metadata_col, products_col)
+        # Optional per-category sub-indexes, routed with the query's own CLIP embedding
+        self.partitions = partitions
+        # Optional item-centroid index: unfiltered item searches rank candidate items, then only their images
+        # (while it covers every image of the index)
+        self.item_index = item_index
+        self.image_batcher = image_batcher
+        self.text_batcher = text_batcher
+
+    async def _embed_image(self, image: Image.Image):
+        # Concurrent queries share one forward pass when a batcher is configured
+        if self.image_batcher is not None:
+            emb = await self.image_batcher.submit(image)
+        else:
+            emb = await run_in_stage("inference", self.extract_embedding, image)
+        return emb.reshape(1, -1).astype("float32")  # FAISS expects 2D array
+
+    async def _embed_text(self, text: str):
+        if self.text_batcher is not None:
+            return await self.text_batcher.submit(text)
+        return await run_in_stage("inference", self.extract_text_embedding, text)
+
+    def _search_hits(self, emb, top_k: int, filters: Optional[Dict[str, List[str]]] = None, route_emb=None) -> List[SearchResultItem]:
+        applies, selector = filtered_selector(self.filter_index, filters)
+        if applies and selector is None:
+            return []  # nothing passes the filters
+        if self.partitions is not None:
+            # Only the category partitions the query is routed to (global index when unsure)
+            indices, scores = self.partitions.search(emb, top_k, route_emb, id_selector=selector)
+        else:
+            indices, scores = self.search(self.index, emb, top_k, id_selector=selector)
+        return self.metadata.resolve(indices, scores)
+
+    async def search_image(self, image: Image.Image, top_k: int, filters: Optional[Dict[str, List[str]]] = None) -> List[SearchResultItem]:
+        emb = await self._embed_image(image)
+
+        # Perform FAISS search (only over images passing `filters`) on the search stage
+        return await run_in_stage("search", self._search_hits, emb, top_k, filters, emb)
+
+    async def search_items(self, image: Image.Image, top_k: int, filters: Optional[Dict[str, List[str]]] = None) -> List[SearchResultItem]:
+        """Top_k distinct items, each with its best-matching image (embedded once, scan widened as needed)."""
+        emb = await self._embed_image(image)
+        # The item index covers only the images of its build; after adds, use the grouped image search
+        if self.item_index is not None and not filters and self.item_index.covers(self.index):
+            return await run_in_stage("search", self.item_index.search_items, emb, top_k)
+
+        async def fetch(n):
+            return await run_in_stage("search", self._search_hits, emb, n, filters, emb)
+
+        return await search_grouped(fetch, top_k)
     
+    def _text_similarities(self, image_hits: List[SearchResultItem], query_text_emb) -> np.ndarray:
+        # Text vectors of the hits' items in one fancy-indexed read (text ids are faiss_id(item_id))
+        text_embeddings, has_text = self.text_vectors.get(faiss_ids(hit["item_id"] for hit in image_hits))
+        return np.where(has_text, text_embeddings @ np.asarray(query_text_emb, dtype="float32").reshape(-1), 0.0)
+
     async def search_image_text(
         self,
         image: Image.Image,
@@ -56,74 +89,38 @@ class CLIPFaissSearch:
         top_k: int,
         text_weight: float = 0.4,
         image_weight: float = 0.6,
+        filters: Optional[Dict[str, List[str]]] = None,
     ) -> List[SearchResultItem]:
 
         # Extract image embedding
-        image_emb = self.extract_embedding(image).reshape(1, -1).astype("float32")
+        image_emb = await self._embed_image(image)
 
-        # Search image embedding against image index
-        indices, distances = self.search(self.index, image_emb, 1000)
-        valid_indices = [idx for idx in indices if idx != -1]
+        # Search image embedding against image index (only images passing `filters`),
+        # with metadata from the in-memory table
+        image_hits = await run_in_stage("search", self._search_hits, image_emb, 1000, filters, image_emb)
 
         if not query_text:
-            return self._build_results(valid_indices, distances)
+            return image_hits[:top_k]
 
         # Extract text embedding for query
-        query_text_emb = self.extract_text_embedding(query_text)
-
-        # Fetch image metadata for valid indices
-        metadata_docs = list(
-            embedding_clip_faiss_metadata_col.find({"faiss_index": {"$in": valid_indices}})
-        )
-        faiss_index_to_meta = {doc["faiss_index"]: doc for doc in metadata_docs}
-
-        # Get item_ids from image metadata
-        item_ids = [doc["item_id"] for doc in metadata_docs]
-
-        # Fetch corresponding text metadata for item_ids
-        text_docs = list(
-            embedding_clip_faiss_text_metadata_col.find({"item_id": {"$in": item_ids}})
-        )
-        item_id_to_text_faiss_index = {
-            doc["item_id"]: doc["faiss_index"] for doc in text_docs if "faiss_index" in doc
-        }
-
-        # Batch load text embeddings
-        text_faiss_indices = list(item_id_to_text_faiss_index.values())
-        text_embeddings_batch = get_embeddings_by_indices(self.text_index, text_faiss_indices)
-
-        # Map text faiss_index -> embedding
-        text_index_to_emb = {
-            idx: emb for idx, emb in zip(text_faiss_indices, text_embeddings_batch)
-        }
+        query_text_emb = await self._embed_text(query_text)
+
+        # Text similarities of the hits' items, read from the memory-mapped text vectors off the event loop
+        text_sims = await run_in_stage("search", self._text_similarities, image_hits, query_text_emb)
 
         # Compute combined scores
         combined_results = []
 
-        for idx, dist in zip(indices, distances):
-            if idx == -1:
-                continue
-
-            meta_doc = faiss_index_to_meta.get(idx)
-            if not meta_doc:
-                continue
-
-            item_id = meta_doc["item_id"]
-            image_id = meta_doc["image_id"]
-            image_path = meta_doc["image_path"]
-
-            text_faiss_idx = item_id_to_text_faiss_index.get(item_id)
-            text_emb = text_index_to_emb.get(text_faiss_idx)
-
-            text_sim = self._cosine_similarity(query_text_emb, text_emb) if text_emb is not None else 0.0
-            img_sim = 1.0 - dist  # distance to similarity
+        for hit, text_sim in zip(image_hits, text_sims.tolist()):
+            # Inner product of normalized vectors, already a similarity
+            img_sim = hit["score"]
 
             combined_score = image_weight * img_sim + text_weight * text_sim
 
             combined_results.append({
-                "image_id": str(image_id),
-                "item_id": item_id,
-                "image_path": image_path,
+                "image_id": str(hit["image_id"]),
+                "item_id": hit["item_id"],
+                "image_path": hit["image_path"],
                 "image_score": float(img_sim),
                 "text_score": float(text_sim),
                 "combined_score": float(combined_score),
@@ -132,4 +129,4 @@ class CLIPFaissSearch:
         # Sort by combined score
         combined_results.sort(key=lambda x: x["combined_score"], reverse=True)
 
-        return combined_results[:top_k]
\ No newline at end of file
+        return combined_results[:top_k]
@@ -1,30 +1,40 @@
 from PIL import Image
-from typing import List
+from typing import Dict, List, Optional
 from app.models.search_models import SearchResultItem
 from app.db.chroma import ChromaDBClient
+from app.batching import MicroBatcher
+from app.executors import run_in_stage
+from app.grouping import search_grouped
+from app.filters import chroma_where
 
 class CNNChromaSearch:
-    def __init__(self, chroma_client: ChromaDBClient, collection_name: str, extract_embedding_func):
+    def __init__(self, chroma_client: ChromaDBClient, collection_name: str, extract_embedding_func, batcher: Optional[MicroBatcher] = None):
         self.chroma = chroma_client
         self.collection_name = collection_name
         self.extract_embedding = extract_embedding_func
+        self.batcher = batcher
 
-    async def search_image(self, image: Image.Image, top_k: int) -> List[SearchResultItem]:
-        # Extract the embedding for the image
-        emb = self.extract_embedding(image).reshape(1, -1).astype('float32')
+    async def _embed(self, image: Image.Image):
+        # Concurrent queries share one forward pass when a batcher is configured
+        if self.batcher is not None:
+            return await self.batcher.submit(image)
+        return await run_in_stage("inference", self.extract_embedding, image)
 
-        # Search the Chroma collection for the most similar embeddings
-        results = self.chroma.search_embeddings(
+    async def _search_embedding(self, emb, top_k: int, filters: Optional[Dict[str, List[str]]] = None) -> List[SearchResultItem]:
+        # Search the Chroma collection for the most similar embeddings (among those passing `filters`)
+        results = await run_in_stage(
+            "db",
+            self.chroma.search_embeddings,
             collection_name=self.collection_name,
             query_embedding=emb[0],
-            top_k=top_k
+            top_k=top_k,
+            where=chroma_where(filters)
         )
 
         search_results: List[SearchResultItem] = []
 
-        # Extract results from ChromaDB
-        for idx, score in zip(results['metadatas'], results['distances']):
-            image_metadata = idx  # This contains the metadata associated with the image
+        # Extract results from ChromaDB (one query, so the first list of each field)
+        for image_metadata, score in zip(results['metadatas'][0], results['distances'][0]):
             item_id = image_metadata.get("item_id")
             image_id = image_metadata.get("image_id")
             image_path = image_metadata.get("image_path")
@@ -37,3 +47,13 @@ class CNNChromaSearch:
             })
 
         return search_results
+
+    async def search_image(self, image: Image.Image, top_k: int, filters: Optional[Dict[str, List[str]]] = None) -> List[SearchResultItem]:
+        # Extract the embedding for the image
+        emb = (await self._embed(image)).reshape(1, -1).astype('float32')
+        return await self._search_embedding(emb, top_k, filters)
+
+    async def search_items(self, image: Image.Image, top_k: int, filters: Optional[Dict[str, List[str]]] = None) -> List[SearchResultItem]:
+        """Top_k distinct items, each with its best-matching image (embedded once, scan widened as needed)."""
+        emb = (await self._embed(image)).reshape(1, -1).astype('float32')
+        return await search_grouped(lambda n: self._search_embedding(emb, n, filters), top_k)
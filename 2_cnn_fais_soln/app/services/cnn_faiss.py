@@ -1,32 +1,71 @@
 from PIL import Image
-from typing import List
+from typing import Dict, List, Optional
 from app.models.search_models import SearchResultItem
-from app.db.mongo import embedding_cnn_faiss_metadata_col
+from app.db.mongo import embedding_cnn_faiss_metadata_col, products_col
+from app.metadata_table import MetadataTable
+from app.grouping import search_grouped
+from app.filters import FilterIndex, filtered_selector
+from app.partitions import PartitionedIndex
+from app.item_index import ItemCentroidIndex
+from app.batching import MicroBatcher
+from app.executors import run_in_stage
 
 class CNNFaissSearch:
-    def __init__(self, index,  extract_embedding_func, search_func):
+    def __init__(self, index,  extract_embedding_func, search_func, metadata: MetadataTable = None, filter_index: FilterIndex = None,
+                 partitions: PartitionedIndex = None, route_embedding_func=None, item_index: ItemCentroidIndex = None,
+                 batcher: Optional[MicroBatcher] = None):
         self.index = index
         self.extract_embedding = extract_embedding_func
         self.search = search_func
+        # faiss_id -> image metadata, in memory; share it with AddController so adds show up
+        self.metadata = metadata if metadata is not None else MetadataTable.from_collection(embedding_cnn_faiss_metadata_col)
+        # Attribute bitmaps over the index's ids, applied inside the search as an IDSelector
+        self.filter_index = filter_index if filter_index is not None else FilterIndex.from_collections(embedding_cnn_faiss_metadata_col, products_col)
+        # Optional per-category sub-indexes; routing needs the CLIP image embedding of the query
+        self.partitions = partitions
+        self.route_embedding = route_embedding_func
+        # Optional item-centroid index: unfiltered item searches rank candidate items, then only their images
+        # (while it covers every image of the index)
+        self.item_index = item_index
+        self.batcher = batcher
 
-    async def search_image(self, image: Image.Image, top_k: int) -> List[SearchResultItem]:
-        emb = self.extract_embedding(image)
-        indices, scores = self.search(self.index, emb, top_k)
-        results = []
-        for idx, score in zip(indices, scores):
-            # Query embedding metadata by index or image_id
-            embedding_doc = embedding_cnn_faiss_metadata_col.find_one({"faiss_index": idx})
-            if not embedding_doc:
-                continue
-            image_id = embedding_doc["image_id"]
-            image_path = embedding_doc["image_path"]
-            item_id = embedding_doc.get("item_id")
-
-            results.append({
-                "image_id": str(image_id),
-                "item_id": item_id,
-                "image_path": image_path,
-                "score": float(score)
-            })
-
-        return results
+    async def _embed(self, image: Image.Image):
+        # Concurrent queries share one forward pass when a batcher is configured
+        if self.batcher is not None:
+            return await self.batcher.submit(image)
+        return await run_in_stage("inference", self.extract_embedding, image)
+
+    async def _route_embedding(self, image: Image.Image):
+        if self.partitions is None or self.route_embedding is None:
+            return None
+        return await run_in_stage("inference", self.route_embedding, image)
+
+    def _search_hits(self, emb, top_k: int, filters: Optional[Dict[str, List[str]]] = None, route_emb=None) -> List[SearchResultItem]:
+        applies, selector = filtered_selector(self.filter_index, filters)
+        if applies and selector is None:
+            return []  # nothing passes the filters
+        if self.partitions is not None:
+            # Only the category partitions the query is routed to (global index when unsure)
+            indices, scores = self.partitions.search(emb, top_k, route_emb, id_selector=selector)
+        else:
+            indices, scores = self.search(self.index, emb, top_k, id_selector=selector)
+        return self.metadata.resolve(indices, scores)
+
+    async def search_image(self, image: Image.Image, top_k: int, filters: Optional[Dict[str, List[str]]] = None) -> List[SearchResultItem]:
+        emb = await self._embed(image)
+        route_emb = await self._route_embedding(image)
+        # FAISS scan (or the routed partitions) and metadata lookup on the search stage, off the event loop
+        return await run_in_stage("search", self._search_hits, emb, top_k, filters, route_emb)
+
+    async def search_items(self, image: Image.Image, top_k: int, filters: Optional[Dict[str, List[str]]] = None) -> List[SearchResultItem]:
+        """Top_k distinct items, each with its best-matching image (embedded once, scan widened as needed)."""
+        emb = await self._embed(image)
+        # The item index covers only the images of its build; after adds, use the grouped image search
+        if self.item_index is not None and not filters and self.item_index.covers(self.index):
+            return await run_in_stage("search", self.item_index.search_items, emb, top_k)
+        route_emb = await self._route_embedding(image)
+
+        async def fetch(n):
+            return await run_in_stage("search", self._search_hits, emb, n, filters, route_emb)
+
+        return await search_grouped(fetch, top_k)
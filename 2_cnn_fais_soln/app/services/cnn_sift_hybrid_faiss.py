@@ -1,45 +1,46 @@
 import numpy as np
-import cv2
+from PIL import Image
+from typing import List
+from app.models.search_models import SearchResultItem
+from app.db.mongo import embedding_cnn_faiss_metadata_col
+from app.metadata_table import MetadataTable
+from app.executors import run_in_stage
+from app.config import SIFT_MAX_DESCRIPTORS
+from app.sift import SiftCodebook, SiftReranker, detect, gray_image
 
 class CNNSIFTHybridSearch:
-    def __init__(self, index, embedding_metadata, extract_cnn_func, kmeans_model, search_func):
+    def __init__(self, index, extract_cnn_func, search_func, metadata: MetadataTable = None, reranker: SiftReranker = None,
+                 codebook: SiftCodebook = None):
         self.index = index
-        self.embedding_metadata = embedding_metadata
         self.extract_cnn = extract_cnn_func
-        self.kmeans_model = kmeans_model
         self.search = search_func
+        # faiss_id -> image metadata of the CNN index, in memory
+        self.metadata = metadata if metadata is not None else MetadataTable.from_collection(embedding_cnn_faiss_metadata_col)
+        # SIFT geometric verification of the top CNN candidates (SiftReranker.load(FAISS_INDEX_PATH)),
+        # skipped when no SIFT cache was built
+        self.reranker = reranker
+        # With the CNN+SIFT hybrid index (build_cnn_sift_hybrid_index) queries also need
+        # their visual word histogram: SiftCodebook.load(KMEANS_MODEL_PATH)
+        self.codebook = codebook
 
-    def extract_sift(self, image):
-        gray = np.array(image.convert("L"))
-        sift = cv2.SIFT_create()
-        _, descriptors = sift.detectAndCompute(gray, None)
-        if descriptors is None:
-            return np.zeros((1, 128), dtype=np.float32)
-        return descriptors
+    async def _query_vector(self, image: Image.Image) -> np.ndarray:
+        emb = await run_in_stage("inference", self.extract_cnn, image)
+        if self.codebook is None:
+            return emb
+        gray = await run_in_stage("decode", gray_image, image)
+        _, descriptors = await run_in_stage("sift", detect, gray, SIFT_MAX_DESCRIPTORS)
+        histogram = await run_in_stage("search", self.codebook.histogram, descriptors)
+        return np.concatenate([np.asarray(emb, dtype="float32").reshape(-1), histogram])
 
-    def aggregate_sift(self, descriptors, k=64):
-        words = self.kmeans_model.predict(descriptors)
-        hist, _ = np.histogram(words, bins=np.arange(k+1))
-        hist = hist.astype(np.float32)
-        hist /= (hist.sum() + 1e-7)
-        return hist
+    def _search_hits(self, emb: np.ndarray, top_k: int) -> List[SearchResultItem]:
+        indices, scores = self.search(self.index, emb, top_k)
+        return self.metadata.resolve(indices, scores)
 
-    def extract_hybrid(self, image, k=64):
-        cnn_feat = self.extract_cnn(image)
-        sift_desc = self.extract_sift(image)
-        sift_hist = self.aggregate_sift(sift_desc, k)
-        return np.concatenate([cnn_feat, sift_hist])
-
-    async def search_image(self, image, top_k=5):
-        hybrid_feat = self.extract_hybrid(image)
-        indices, scores = self.search(self.index, hybrid_feat, top_k)
-        results = []
-        for idx, score in zip(indices, scores):
-            meta = self.embedding_metadata[idx]
-            results.append({
-                "image_id": meta["image_id"],
-                "item_id": meta.get("item_id"),
-                "image_path": meta["image_path"],
-                "score": float(score),
-            })
-        return results
+    async def search_image(self, image: Image.Image, top_k: int = 5) -> List[SearchResultItem]:
+        emb = await self._query_vector(image)
+        fetch = max(top_k, self.reranker.top_n) if self.reranker is not None else top_k
+        # FAISS scan and metadata lookup on the search stage, off the event loop
+        hits = await run_in_stage("search", self._search_hits, emb, fetch)
+        if self.reranker is not None:
+            hits = await self.reranker.rerank(image, hits)
+        return hits[:top_k]
@@ -1,6 +1,7 @@
 from google import genai
 from google.genai.types import Blob, Part, Content, GenerateContentConfig
 from typing import Optional
+from app.executors import run_in_stage
 
 class GeminiDescriptionService:
     def __init__(self, gemini_api_key: Optional[str] = None):
@@ -34,7 +35,9 @@ class GeminiDescriptionService:
             content = Content(parts=parts)
             
 
-            response = self.client.models.generate_content(
+            response = await run_in_stage(
+                "io",
+                self.client.models.generate_content,
                 model = self.model_name,
                 contents=[content]
             )
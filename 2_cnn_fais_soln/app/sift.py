@@ -0,0 +1,349 @@
+import os
+import time
+import asyncio
+import itertools
+import collections
+import cv2
+import faiss
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from PIL import Image
+from app.config import (
+    SIFT_RERANK_TOP_N,
+    SIFT_RERANK_BUDGET_MS,
+    SIFT_MAX_DESCRIPTORS,
+    SIFT_MAX_IMAGE_SIDE,
+    SIFT_RATIO,
+    SIFT_RERANK_WEIGHT,
+    SIFT_BUILD_WORKERS,
+    SIFT_CODEBOOK_K,
+    SIFT_CODEBOOK_TRAIN_SIZE,
+    SIFT_KMEANS_NITER,
+)
+from app.executors import run_in_stage
+from app.search import faiss_ids
+
+# RANSAC reprojection threshold (pixels at SIFT_MAX_IMAGE_SIDE) and the fewest
+# ratio-test matches worth fitting a homography to
+_RANSAC_THRESHOLD = 5.0
+_MIN_MATCHES = 4
+
+# One detector / matcher per process, created on first use
+_detectors: Dict[int, "cv2.SIFT"] = {}
+_matcher = None
+
+
+def sift_features_path(index_path: str) -> str:
+    """Base path of the SIFT feature cache built for an image index."""
+    return index_path + ".sift"
+
+
+def gray_image(image: Image.Image, max_side: int = SIFT_MAX_IMAGE_SIDE) -> np.ndarray:
+    """uint8 grayscale of `image`, scaled down to fit max_side (same for queries and the cache)."""
+    gray = image.convert("L")
+    if max(gray.size) > max_side:
+        gray.thumbnail((max_side, max_side))
+    return np.asarray(gray)
+
+
+def detect(gray: np.ndarray, max_descriptors: int = SIFT_MAX_DESCRIPTORS) -> Tuple[np.ndarray, np.ndarray]:
+    """(keypoint xy float32 (n, 2), descriptors uint8 (n, 128)) of the strongest max_descriptors keypoints."""
+    detector = _detectors.get(max_descriptors)
+    if detector is None:
+        detector = _detectors[max_descriptors] = cv2.SIFT_create(nfeatures=max_descriptors)
+    keypoints, descriptors = detector.detectAndCompute(gray, None)
+    if descriptors is None:
+        return np.empty((0, 2), dtype="float32"), np.empty((0, 128), dtype="uint8")
+    points = np.array([keypoint.pt for keypoint in keypoints[:max_descriptors]], dtype="float32").reshape(-1, 2)
+    # SIFT descriptor components are clipped to 0..255, so uint8 loses nothing
+    return points, np.clip(descriptors[:max_descriptors], 0, 255).astype("uint8")
+
+
+def file_features(path: str, max_descriptors: int = SIFT_MAX_DESCRIPTORS) -> Tuple[np.ndarray, np.ndarray]:
+    """SIFT features of an image file; no keypoints when it can't be read."""
+    try:
+        with Image.open(path) as image:
+            return detect(gray_image(image), max_descriptors)
+    except (OSError, ValueError):
+        return np.empty((0, 2), dtype="float32"), np.empty((0, 128), dtype="uint8")
+
+
+def _chunk_features(paths: List[str], max_descriptors: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    return [file_features(path, max_descriptors) for path in paths]
+
+
+def extract_files(
+    paths: Iterable[str],
+    max_descriptors: int = SIFT_MAX_DESCRIPTORS,
+    workers: int = SIFT_BUILD_WORKERS,
+    chunksize: int = 16,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    SIFT features of every path, in order, extracted by a pool of `workers`
+    processes. Only 2 * workers chunks of `chunksize` paths are in flight at a
+    time (Executor.map would submit the whole catalog up front), and a new
+    chunk is submitted as each finished one is consumed.
+    """
+    paths = iter(paths)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+        pending = collections.deque()
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(itertools.islice(paths, chunksize))
+                if not chunk:
+                    break
+                pending.append(pool.submit(_chunk_features, chunk, max_descriptors))
+            if not pending:
+                return
+            yield from pending.popleft().result()
+
+
+def _inliers(query_points, query_descriptors, points, descriptors, ratio: float) -> int:
+    """RANSAC homography inliers among the ratio-test matches of a query and one candidate."""
+    global _matcher
+    if len(descriptors) < 2:
+        return 0
+    if _matcher is None:
+        _matcher = cv2.BFMatcher(cv2.NORM_L2)
+    pairs = _matcher.knnMatch(query_descriptors, descriptors.astype("float32"), k=2)
+    good = [pair[0] for pair in pairs if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance]
+    if len(good) < _MIN_MATCHES:
+        return 0
+    src = query_points[[match.queryIdx for match in good]]
+    dst = points[[match.trainIdx for match in good]]
+    _, mask = cv2.findHomography(src, dst, cv2.RANSAC, _RANSAC_THRESHOLD)
+    return int(mask.sum()) if mask is not None else 0
+
+
+def match_candidates(
+    gray: np.ndarray,
+    candidates: Sequence[Optional[Tuple[np.ndarray, np.ndarray]]],
+    max_descriptors: int,
+    ratio: float,
+    deadline: float,
+) -> Tuple[int, List[int]]:
+    """
+    (query keypoint count, inliers per candidate) for a query image; runs in a
+    worker process. Candidates without cached features, and those not reached
+    before `deadline` (time.time()), get -1.
+    """
+    query_points, query_descriptors = detect(gray, max_descriptors)
+    inliers = [-1] * len(candidates)
+    if len(query_descriptors) < 2:
+        return len(query_descriptors), inliers
+    query_descriptors = query_descriptors.astype("float32")
+    for i, candidate in enumerate(candidates):
+        if time.time() >= deadline:
+            break
+        if candidate is not None:
+            inliers[i] = _inliers(query_points, query_descriptors, candidate[0], candidate[1], ratio)
+    return len(query_descriptors), inliers
+
+
+class SiftFeatureStore:
+    """
+    SIFT keypoints and descriptors of every image of an index, cached on disk
+    at build time and memory-mapped: `<base>.desc` (uint8, 128 per keypoint),
+    `<base>.pts` (float32 xy per keypoint), `<base>.offsets.npy` (first
+    keypoint of each image, plus the total) and `<base>.ids.npy` (faiss id of
+    each image).
+    """
+
+    def __init__(self, ids: np.ndarray, offsets: np.ndarray, points: np.ndarray, descriptors: np.ndarray):
+        self.ids = np.asarray(ids, dtype="int64")
+        self._order = np.argsort(ids, kind="stable")
+        self._sorted_ids = self.ids[self._order]
+        self.offsets = offsets
+        self.points = points
+        self.descriptors = descriptors
+
+    def __len__(self) -> int:
+        return len(self._sorted_ids)
+
+    @classmethod
+    def open(cls, base: str) -> Optional["SiftFeatureStore"]:
+        """The cache at `base`, None when it wasn't built."""
+        if not os.path.exists(base + ".ids.npy"):
+            return None
+        offsets = np.load(base + ".offsets.npy")
+        total = int(offsets[-1])
+        if total:
+            points = np.memmap(base + ".pts", dtype="float32", mode="r", shape=(total, 2))
+            descriptors = np.memmap(base + ".desc", dtype="uint8", mode="r", shape=(total, 128))
+        else:
+            points, descriptors = np.empty((0, 2), dtype="float32"), np.empty((0, 128), dtype="uint8")
+        return cls(np.load(base + ".ids.npy"), offsets, points, descriptors)
+
+    @staticmethod
+    def write(base: str, records: Iterable[Tuple[int, np.ndarray, np.ndarray]]) -> int:
+        """Stream (faiss id, points, descriptors) records into the cache at `base`; returns the image count."""
+        ids, offsets = [], [0]
+        with open(base + ".tmp.pts", "wb") as points_file, open(base + ".tmp.desc", "wb") as descriptors_file:
+            for image_id, points, descriptors in records:
+                points_file.write(np.ascontiguousarray(points, dtype="float32").tobytes())
+                descriptors_file.write(np.ascontiguousarray(descriptors, dtype="uint8").tobytes())
+                ids.append(image_id)
+                offsets.append(offsets[-1] + len(descriptors))
+        np.save(base + ".tmp.offsets.npy", np.array(offsets, dtype="int64"))
+        np.save(base + ".tmp.ids.npy", np.array(ids, dtype="int64"))
+        # ids last: open() only sees a cache once all of its files are in place
+        for suffix in (".pts", ".desc", ".offsets.npy", ".ids.npy"):
+            os.replace(base + ".tmp" + suffix, base + suffix)
+        return len(ids)
+
+    def get(self, ids: Iterable[int]) -> List[Optional[Tuple[np.ndarray, np.ndarray]]]:
+        """(points, descriptors) of each id, None for ids without cached features."""
+        ids = np.asarray(ids, dtype="int64")
+        if not len(self._sorted_ids):
+            return [None] * len(ids)
+        pos = np.minimum(np.searchsorted(self._sorted_ids, ids), len(self._sorted_ids) - 1)
+        rows = np.where(self._sorted_ids[pos] == ids, self._order[pos], -1)
+        features = []
+        for row in rows.tolist():
+            if row < 0:
+                features.append(None)
+                continue
+            start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+            features.append((np.array(self.points[start:end]), np.array(self.descriptors[start:end])))
+        return features
+
+
+def reservoir_sample(store: SiftFeatureStore, size: int = SIFT_CODEBOOK_TRAIN_SIZE, chunk_images: int = 1024, seed: int = 0) -> np.ndarray:
+    """
+    Uniform sample of `size` descriptors of the whole cache (float32), in one
+    pass over the memory-mapped descriptors with reservoir sampling, so RAM
+    holds the sample and one chunk instead of every descriptor of the catalog.
+    """
+    rng = np.random.default_rng(seed)
+    total = int(store.offsets[-1])
+    sample = np.empty((min(size, total), 128), dtype="uint8")
+    seen = 0
+    for start in range(0, len(store.ids), chunk_images):
+        block = store.descriptors[int(store.offsets[start]):int(store.offsets[min(start + chunk_images, len(store.ids))])]
+        # Fill the reservoir first, then descriptor number i replaces a random slot with probability size / (i + 1)
+        fill = max(min(len(sample) - seen, len(block)), 0)
+        sample[seen:seen + fill] = block[:fill]
+        positions = np.arange(seen + fill, seen + len(block))
+        slots = rng.integers(0, positions + 1) if len(positions) else positions
+        keep = slots < len(sample)
+        sample[slots[keep]] = block[fill:][keep]
+        seen += len(block)
+    return sample.astype("float32")
+
+
+class SiftCodebook:
+    """
+    Visual words of the CNN+SIFT hybrid index: k-means centroids of SIFT
+    descriptors, trained with faiss.Kmeans and searched with an IndexFlatL2,
+    so assigning a batch of descriptors is one nearest-centroid search.
+    """
+
+    def __init__(self, centroids: np.ndarray):
+        self.centroids = np.ascontiguousarray(centroids, dtype="float32")
+        self.index = faiss.IndexFlatL2(self.centroids.shape[1])
+        self.index.add(self.centroids)
+
+    @property
+    def k(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def train(cls, sample: np.ndarray, k: int = SIFT_CODEBOOK_K, niter: int = SIFT_KMEANS_NITER, seed: int = 0) -> "SiftCodebook":
+        kmeans = faiss.Kmeans(sample.shape[1], k, niter=niter, seed=seed, verbose=True)
+        kmeans.train(np.ascontiguousarray(sample, dtype="float32"))
+        return cls(kmeans.centroids)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["SiftCodebook"]:
+        if not path or not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return cls(np.load(f))
+
+    def save(self, path: str):
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, self.centroids)
+        os.replace(path + ".tmp", path)
+
+    def histograms(self, descriptors: np.ndarray, counts: Sequence[int]) -> np.ndarray:
+        """
+        (len(counts), k) L1-normalized visual word histograms of consecutive
+        images, `counts[i]` descriptors each, stacked in `descriptors`.
+        """
+        counts = np.asarray(counts, dtype="int64")
+        hists = np.zeros((len(counts), self.k), dtype="float32")
+        if len(descriptors):
+            _, words = self.index.search(np.ascontiguousarray(descriptors, dtype="float32"), 1)
+            owners = np.repeat(np.arange(len(counts)), counts)
+            hists = np.bincount(owners * self.k + words[:, 0], minlength=len(counts) * self.k)
+            hists = hists.reshape(len(counts), self.k).astype("float32")
+        return hists / (hists.sum(axis=1, keepdims=True) + 1e-7)
+
+    def histogram(self, descriptors: np.ndarray) -> np.ndarray:
+        return self.histograms(descriptors, [len(descriptors)])[0]
+
+
+class SiftReranker:
+    """
+    Geometric re-ranking of the top `top_n` hits of an image search. The query's
+    SIFT features are extracted once and matched (ratio test + RANSAC
+    homography) against the cached features of the candidates in the "sift"
+    process pool, so OpenCV never runs on the API worker. A candidate's score
+    gains `weight * inliers / query keypoints`. The work stops at the request's
+    time budget: unverified candidates keep their score, and if the pool
+    doesn't answer in time the hits are returned unchanged.
+    """
+
+    def __init__(
+        self,
+        store: SiftFeatureStore,
+        top_n: int = SIFT_RERANK_TOP_N,
+        budget_ms: float = SIFT_RERANK_BUDGET_MS,
+        max_descriptors: int = SIFT_MAX_DESCRIPTORS,
+        ratio: float = SIFT_RATIO,
+        weight: float = SIFT_RERANK_WEIGHT,
+    ):
+        self.store = store
+        self.top_n = top_n
+        self.budget_ms = budget_ms
+        self.max_descriptors = max_descriptors
+        self.ratio = ratio
+        self.weight = weight
+
+    @classmethod
+    def load(cls, index_path: str) -> Optional["SiftReranker"]:
+        """Re-ranker over the SIFT cache of the image index at `index_path`, None when there is none."""
+        store = SiftFeatureStore.open(sift_features_path(index_path))
+        if store is None:
+            return None
+        print(f"Loaded SIFT features of {len(store)} images for {index_path}")
+        return cls(store)
+
+    async def rerank(self, image: Image.Image, hits: List[Dict]) -> List[Dict]:
+        """`hits` (result dicts in rank order, higher score = better) with the top_n re-scored and re-sorted."""
+        head, tail = hits[:self.top_n], hits[self.top_n:]
+        if not head:
+            return hits
+        started = time.time()
+        deadline = started + self.budget_ms / 1000.0
+        gray = await run_in_stage("decode", gray_image, image)
+        candidates = self.store.get(faiss_ids(hit["image_id"] for hit in head))
+        try:
+            query_count, inliers = await asyncio.wait_for(
+                run_in_stage("sift", match_candidates, gray, candidates, self.max_descriptors, self.ratio, deadline),
+                timeout=max(deadline - time.time(), 0.0),
+            )
+        except asyncio.TimeoutError:
+            return hits
+
+        reranked = []
+        for hit, count in zip(head, inliers):
+            if count < 0:
+                reranked.append(hit)
+                continue
+            boost = self.weight * count / max(query_count, 1)
+            reranked.append(dict(hit, score=hit["score"] + boost, sift_inliers=count))
+        order = np.argsort([-hit["score"] for hit in reranked], kind="stable")
+        return [reranked[i] for i in order.tolist()] + tail
@@ -1,13 +1,19 @@
+import os
 import json
+import itertools
 import numpy as np
 from pathlib import Path
 from PIL import Image
-import cv2
-from sklearn.cluster import MiniBatchKMeans
-import pickle
 from app.db.mongo import embedding_cnn_faiss_metadata_col, embedding_clip_faiss_metadata_col, embedding_clip_faiss_text_metadata_col, products_col
-from app.model import extract_embedding, extract_clip_embedding, extract_clip_text_embedding
-from app.search import build_faiss_index, save_index
+from app.model import extract_embedding, embed_preprocessed_batch, extract_clip_text_embeddings_batch, EMBEDDING_DIMS, model_version
+from app.image_loader import PrefetchingImageLoader, StageStats
+from app.build_checkpoint import BuildCheckpoint, publish_metadata
+from app.build_manifest import ImageManifest, plan_image_build, select_records, ids_digest
+from app.search import build_faiss_index, save_index, iter_json_array, vectors_path, open_vectors, ids_path, open_ids, faiss_id, faiss_ids, VectorStore
+from app.item_index import item_index_path, save_item_ids
+from app.filters import product_attributes
+from app.partitions import save_partitions
+from app.sift import SiftFeatureStore, SiftCodebook, extract_files, reservoir_sample, sift_features_path
 from app.config import (
     FAISS_INDEX_PATH,
     FAISS_HYBRID_INDEX_PATH,
@@ -16,7 +22,16 @@ from app.config import (
     KMEANS_MODEL_PATH,
     SHOE_PRODUCT_JSON_PATH, 
     CLIP_FAISS_INDEX_PATH, 
-    CLIP_FAISS_INDEX_TEXT_PATH
+    CLIP_FAISS_INDEX_TEXT_PATH,
+    INFERENCE_BACKEND,
+    MODEL_PRECISION,
+    FAISS_CATEGORY_PARTITIONS,
+    FAISS_ITEM_CENTROIDS,
+    CATEGORY_PARTITION_MIN_SIZE,
+    CATEGORY_PROMPT,
+    FAISS_RERANK_K,
+    SIFT_CODEBOOK_K,
+    SIFT_CODEBOOK_TRAIN_SIZE,
 )
 import time
 
@@ -80,6 +95,7 @@ BATCH_SIZE = 1000
 LOG_FILE_PATH = "faiss_build_time.log"  # You can customize the log file path
 
 CLIP_LOG_FILE_PATH = "clip_faiss_build_time.log"  # Separate log file for CLIP
+IMAGE_INDEXES_LOG_FILE_PATH = "image_faiss_build_time.log"  # CNN + CLIP built together
 
 def build_clip_text_faiss_index():
     with open(SHOE_PRODUCT_JSON_PATH, "r") as f:
@@ -87,317 +103,481 @@ def build_clip_text_faiss_index():
 
     print(f"Processing {len(products)} products for CLIP text FAISS index...")
 
-    # Clear existing metadata
-    embedding_clip_faiss_metadata_col.delete_many({})
-
     all_text_embeddings = []
     all_metadata_docs = []
-
-    for idx, product in enumerate(products):
-        item_id = product.get("item_id")
-        metadata = product.get("metadata", {})
+    seen_item_ids = set()
+
+    for batch_start in range(0, len(products), BATCH_SIZE):
+        # One text vector per item_id, its faiss id is derived from the item_id
+        batch_products = [
+            product for product in products[batch_start:batch_start + BATCH_SIZE]
+            if product.get("item_id") not in seen_item_ids
+        ]
+        seen_item_ids.update(product.get("item_id") for product in batch_products)
+        if not batch_products:
+            continue
 
         # Convert metadata dict to descriptive text
-        text = metadata_to_text(metadata)  # You need to implement this helper
+        texts = [metadata_to_text(product.get("metadata", {})) for product in batch_products]
 
         try:
-            emb = extract_clip_text_embedding(text=text)  # Use CLIP text encoder here
-            all_text_embeddings.append(emb)
+            batch_embeddings = extract_clip_text_embeddings_batch(texts)  # Use CLIP text encoder here
+        except Exception as e:
+            print(f"Failed to embed metadata for products {batch_start} - {batch_start + len(batch_products)}: {e}")
+            continue
 
+        for product, text in zip(batch_products, texts):
             all_metadata_docs.append({
-                "faiss_index": idx,
-                "item_id": item_id,
+                "faiss_id": faiss_id(product.get("item_id")),
+                "item_id": product.get("item_id"),
                 "metadata_text": text
             })
+        all_text_embeddings.append(batch_embeddings)
 
-        except Exception as e:
-            print(f"Failed to embed metadata for item {item_id}: {e}")
-
-        if (idx + 1) % 100 == 0 or (idx + 1) == len(products):
-            print(f"Processed {idx + 1}/{len(products)} products")
+        print(f"Processed {min(batch_start + BATCH_SIZE, len(products))}/{len(products)} products")
 
     if not all_text_embeddings:
         print("No text embeddings extracted. Exiting.")
         return
 
-    embeddings_np = np.stack(all_text_embeddings).astype("float32")
+    embeddings_np = np.concatenate(all_text_embeddings).astype("float32")
 
-    index = build_faiss_index(embeddings_np)
+    text_ids = np.array([doc["faiss_id"] for doc in all_metadata_docs], dtype="int64")
+    index = build_faiss_index(embeddings_np, ids=text_ids)
     save_index(index, CLIP_FAISS_INDEX_TEXT_PATH)  # Use a separate path for text index
+    # Text vectors by item faiss_id, fetched by CLIPFaissSearch.search_image_text
+    VectorStore.save(CLIP_FAISS_INDEX_TEXT_PATH, text_ids, embeddings_np)
     embedding_clip_faiss_text_metadata_col.delete_many({})
     embedding_clip_faiss_text_metadata_col.insert_many(all_metadata_docs)
-    embedding_clip_faiss_text_metadata_col.create_index("faiss_index")
-
-    print(f"CLIP text FAISS index saved to {FAISS_INDEX_PATH} with {len(all_text_embeddings)} embeddings.")
-
-
-def build_clip_faiss_index():
-    with open(IMAGE_PATHS_JSON, "r") as f:
-        original_metadata = json.load(f)
-
-    total_images = len(original_metadata)
-    print(f"Processing {total_images} images for CLIP FAISS index in batches of {BATCH_SIZE}...")
+    embedding_clip_faiss_text_metadata_col.create_index("faiss_id")
+
+    print(f"CLIP text FAISS index saved to {CLIP_FAISS_INDEX_TEXT_PATH} with {len(all_metadata_docs)} embeddings.")
+
+
+# model name -> (label, metadata collection, index path) of the image FAISS indexes
+IMAGE_FAISS_TARGETS = {
+    "cnn": ("CNN", embedding_cnn_faiss_metadata_col, FAISS_INDEX_PATH),
+    "clip": ("CLIP", embedding_clip_faiss_metadata_col, CLIP_FAISS_INDEX_PATH),
+}
+
+
+def _kept_rows(index_path, metadata_col, keep_ids, dim):
+    """
+    Where to read the vectors of the images in `keep_ids` from the current index:
+    returns (current vectors, their row numbers in it, their metadata docs).
+    Rows are found through the ids file next to the vectors file.
+    """
+    keep_ids = set(keep_ids)
+    docs = [doc for doc in metadata_col.find({}, {"_id": 0}) if str(doc["image_id"]) in keep_ids]
+    old_ids = open_ids(ids_path(index_path))
+    rows = np.flatnonzero(np.isin(old_ids, np.array([doc["faiss_id"] for doc in docs], dtype="int64")))
+    return open_vectors(vectors_path(index_path), dim), rows, docs
+
+
+def _build_image_faiss_indexes(model_names, log_file_path, full_rebuild=False):
+    """
+    Embed the images listed in IMAGE_PATHS_JSON and save one FAISS index per model.
+    Each image is decoded once and embedded by all `model_names` in the same pass.
+    Vectors are stored under `faiss_id(image_id)` (IndexIDMap2), the key of
+    their Mongo metadata, so ids stay the same across builds and adds.
+
+    Every index has a manifest (image_id -> content hash + model version). When
+    all of them exist only new or changed images are embedded; the vectors of
+    unchanged images are copied over from the current index and removed images
+    are dropped. `full_rebuild=True` re-embeds everything.
+    Incremental only saves the embedding work: the index is still trained and
+    written anew from the kept + new vectors. The manifests cover the catalog
+    images of IMAGE_PATHS_JSON only, so images added at runtime through
+    AddController (not in the vectors file nor the manifest) are not carried
+    over and are gone from the index and its metadata after any build; add
+    them to IMAGE_PATHS_JSON (or re-add them) first.
+
+    Every batch is committed to a BuildCheckpoint, so a killed build resumes
+    from the last committed batch. The indexes and their Mongo metadata are only
+    replaced once all images are embedded; until then the old ones keep serving.
+
+    Memory stays bounded: IMAGE_PATHS_JSON is streamed, vectors are written
+    into the checkpoint's memory-mapped matrix as they are produced, and the
+    index is filled from that file in chunks. The matrix is kept next to the
+    index as `vectors_path(index_path)`.
+    """
+    labels = "+".join(IMAGE_FAISS_TARGETS[name][0] for name in model_names)
+
+    manifests = {name: ImageManifest.load(f"faiss_{name}") for name in model_names}
+    # Indexes without an ids file predate stable ids and are rebuilt in full
+    incremental = not full_rebuild and all(
+        manifests[name].exists() and os.path.exists(ids_path(IMAGE_FAISS_TARGETS[name][2])) for name in model_names
+    )
+    versions = {name: model_version(name) for name in model_names}
+    to_embed, keep, fingerprints = plan_image_build(
+        iter_json_array(IMAGE_PATHS_JSON), SHOE_IMAGES_FOLDER, manifests, versions, incremental
+    )
+    total_images = len(fingerprints)
+    if incremental:
+        unchanged = all(len(keep[name]) == len(manifests[name].entries) for name in model_names)
+        if not to_embed and unchanged:
+            print(f"{labels} FAISS index is up to date with {total_images} images.")
+            return
+        print(f"Incremental {labels} FAISS build: {len(to_embed)} new or changed images, "
+              f"{min(len(ids) for ids in keep.values())} unchanged.")
+    print(f"Processing {len(to_embed)} images for {labels} FAISS index...")
+
+    checkpoint = BuildCheckpoint(
+        f"faiss_{'+'.join(model_names)}",
+        {name: EMBEDDING_DIMS[name] for name in model_names},
+        {
+            "source": IMAGE_PATHS_JSON,
+            "records": len(to_embed),
+            "images": ids_digest(to_embed),
+            "backend": INFERENCE_BACKEND,
+            "precision": MODEL_PRECISION,
+            "ids": "faiss_id",
+        },
+        capacity=len(to_embed),
+    )
+    resume_offset = checkpoint.resume()
 
-    # Clear existing metadata before starting
-    embedding_clip_faiss_metadata_col.delete_many({})
-
-    all_embeddings = []
-    all_metadata_docs = []
-
-    total_time_ms = 0
     batch_times = []
 
-    for batch_start in range(0, total_images, BATCH_SIZE):
-        batch_end = min(batch_start + BATCH_SIZE, total_images)
-        batch_metadata = original_metadata[batch_start:batch_end]
-
-        batch_embeddings = []
-        batch_metadata_docs = []
-
+    # Decode/preprocess runs ahead in a thread pool while this loop runs inference
+    stats = StageStats()
+    loader = PrefetchingImageLoader(
+        itertools.islice(select_records(iter_json_array(IMAGE_PATHS_JSON), to_embed), resume_offset, None),
+        SHOE_IMAGES_FOLDER,
+        tuple(model_names),
+        stats=stats,
+        start=resume_offset,
+    )
+
+    for batch in loader:
         batch_start_time = time.perf_counter()
 
-        for idx, record in enumerate(batch_metadata, start=batch_start):
-            relative_path = Path(record["image_path"])
-            image_id = record["image_id"]
-            item_id = record["item_id"]
-            image_file_path = Path(SHOE_IMAGES_FOLDER) / relative_path
-
-            if not image_file_path.exists():
-                print(f"Image not found: {image_file_path}")
-                continue
-
+        batch_embeddings = None
+        if batch.loaded:
             try:
-                image = Image.open(image_file_path).convert("RGB")
-                emb = extract_clip_embedding(image)
-                batch_embeddings.append(emb)
-
-                batch_metadata_docs.append({
-                    "faiss_index": idx,
-                    "image_id": image_id,
-                    "item_id": item_id,
-                    "image_path": str(relative_path)
-                })
-
+                batch_embeddings = {name: embed_preprocessed_batch(name, batch.tensors[name]) for name in model_names}
             except Exception as e:
-                print(f"Failed to process {relative_path}: {e}")
-
-            if (idx + 1) % 100 == 0 or (idx + 1) == total_images:
-                print(f"Processed {idx + 1}/{total_images} images")
-
-        batch_end_time = time.perf_counter()
-        batch_duration_ms = (batch_end_time - batch_start_time) * 1000
-        total_time_ms += batch_duration_ms
-        batch_times.append(batch_duration_ms)
+                print(f"Failed to embed batch {batch.start} - {batch.end}: {e}")
+        stats.add("inference", time.perf_counter() - batch_start_time, len(batch.loaded))
 
-        print(f"Batch {batch_start} - {batch_end} processed in {batch_duration_ms:.2f} ms")
-        print(f"Total time elapsed: {total_time_ms / 1000:.2f} seconds")
-
-        if not batch_embeddings:
-            print(f"No embeddings extracted in batch {batch_start} - {batch_end}. Skipping batch.")
-            continue
-
-        embedding_clip_faiss_metadata_col.insert_many(batch_metadata_docs)
-
-        all_embeddings.extend(batch_embeddings)
-        all_metadata_docs.extend(batch_metadata_docs)
-
-    if not all_embeddings:
-        print("No embeddings extracted overall. Exiting CLIP FAISS build.")
+        write_start_time = time.perf_counter()
+        batch_metadata_docs = []
+        if batch_embeddings is not None:
+            batch_metadata_docs = [
+                {
+                    "faiss_id": faiss_id(record["image_id"]),
+                    "image_id": record["image_id"],
+                    "item_id": record["item_id"],
+                    "image_path": str(Path(record["image_path"]))
+                }
+                for _, record in batch.loaded
+            ]
+        else:
+            print(f"No embeddings extracted in batch {batch.start} - {batch.end}. Skipping batch.")
+        checkpoint.commit(batch.end, batch_embeddings or {}, batch_metadata_docs)
+        stats.add("checkpoint write", time.perf_counter() - write_start_time, len(batch_metadata_docs))
+
+        batch_times.append((time.perf_counter() - batch_start_time) * 1000)
+
+        if batch.end % BATCH_SIZE < loader.batch_size or batch.end == len(to_embed):
+            print(f"Processed {batch.end}/{len(to_embed)} images")
+            print(f"Total time elapsed: {time.perf_counter() - stats.started:.2f} seconds")
+            for line in stats.report():
+                print(f"  {line}")
+
+    if not checkpoint.num_rows and not any(keep.values()):
+        print(f"No embeddings extracted overall. Exiting {labels} FAISS build.")
+        checkpoint.clear()
         return
 
-    embeddings_np = np.stack(all_embeddings).astype("float32")
-
-    index = build_faiss_index(embeddings_np)
-    save_index(index, CLIP_FAISS_INDEX_PATH)
-
-    # Create index on faiss_index for faster queries
-    embedding_clip_faiss_metadata_col.create_index("faiss_index")
-
-    print(f"CLIP FAISS index saved to {CLIP_FAISS_INDEX_PATH} with {len(all_embeddings)} embeddings.")
+    # Publish: every model's index and metadata is swapped in only now
+    for name in model_names:
+        label, metadata_col, index_path = IMAGE_FAISS_TARGETS[name]
+        dim = EMBEDDING_DIMS[name]
+        tmp_vectors_path = vectors_path(index_path) + ".tmp"
+        tmp_ids_path = ids_path(index_path) + ".tmp"
+        new_ids = np.fromiter((doc["faiss_id"] for doc in checkpoint.metadata_docs()), dtype="int64")
+
+        kept_docs = []
+        if keep[name]:
+            # Unchanged rows first, then this build's rows, copied chunk by chunk into a new file
+            old_vectors, rows, kept_docs = _kept_rows(index_path, metadata_col, keep[name], dim)
+            ids = np.concatenate([open_ids(ids_path(index_path))[rows], new_ids])
+            new_vectors = checkpoint.vectors(name)
+            vectors = np.memmap(tmp_vectors_path, dtype="float32", mode="w+", shape=(len(rows) + len(new_vectors), dim))
+            for start in range(0, len(rows), BATCH_SIZE):
+                vectors[start:start + BATCH_SIZE] = old_vectors[rows[start:start + BATCH_SIZE]]
+            for start in range(0, len(new_vectors), BATCH_SIZE):
+                vectors[len(rows) + start:len(rows) + start + BATCH_SIZE] = new_vectors[start:start + BATCH_SIZE]
+            vectors.flush()
+            del old_vectors, new_vectors
+        else:
+            ids = new_ids
+            checkpoint.move_vectors(name, tmp_vectors_path)
+            vectors = open_vectors(tmp_vectors_path, dim)
+        ids.tofile(tmp_ids_path)
+
+        index = build_faiss_index(vectors, ids=ids)
+        del vectors
+
+        publish_metadata(metadata_col, itertools.chain(kept_docs, checkpoint.metadata_docs()))
+        save_index(index, index_path)
+        os.replace(tmp_vectors_path, vectors_path(index_path))
+        os.replace(tmp_ids_path, ids_path(index_path))
+
+        manifest = ImageManifest(manifests[name].name)
+        for doc in kept_docs:
+            manifest.entries[str(doc["image_id"])] = manifests[name].entries[str(doc["image_id"])]
+        for doc in checkpoint.metadata_docs():
+            image_id = str(doc["image_id"])
+            if image_id in fingerprints:
+                manifest.entries[image_id] = dict(fingerprints[image_id], model=versions[name])
+        manifest.save()
+
+        print(f"{label} FAISS index saved to {index_path} with {index.ntotal} embeddings "
+              f"({checkpoint.num_rows} embedded in this build).")
+        del index
+
+    checkpoint.clear()
+
+    if FAISS_CATEGORY_PARTITIONS:
+        for name in model_names:
+            _build_category_partitions(name)
+    if FAISS_ITEM_CENTROIDS:
+        for name in model_names:
+            _build_item_centroid_index(name)
 
     # Write timing info to log file
-    with open(CLIP_LOG_FILE_PATH, "w") as log_file:
-        log_file.write(f"Processed {total_images} images in {total_time_ms / 1000:.2f} seconds\n")
+    with open(log_file_path, "w") as log_file:
+        log_file.write(f"Processed {len(to_embed) - resume_offset} images in {time.perf_counter() - stats.started:.2f} seconds\n")
+        if incremental:
+            log_file.write(f"Incremental build over {total_images} images\n")
+        if resume_offset:
+            log_file.write(f"Resumed from checkpoint at image {resume_offset}\n")
+        log_file.write("Throughput per stage:\n")
+        for line in stats.report():
+            log_file.write(f"{line}\n")
         log_file.write("Batch processing times (ms):\n")
         for i, t in enumerate(batch_times):
             log_file.write(f"Batch {i + 1}: {t:.2f} ms\n")
 
-    print(f"Timing log saved to {CLIP_LOG_FILE_PATH}")
-
-def build_cnn_faiss_index():
-    with open(IMAGE_PATHS_JSON, "r") as f:
-        original_metadata = json.load(f)
-
-    total_images = len(original_metadata)
-    print(f"Processing {total_images} images for CNN FAISS index in batches of {BATCH_SIZE}...")
-
-    # Clear existing metadata before starting
-    embedding_cnn_faiss_metadata_col.delete_many({})
-
-    all_embeddings = []
-    all_metadata_docs = []
-
-    total_time_ms = 0
-    batch_times = []
-
-    for batch_start in range(0, total_images, BATCH_SIZE):
-        batch_end = min(batch_start + BATCH_SIZE, total_images)
-        batch_metadata = original_metadata[batch_start:batch_end]
-
-        batch_embeddings = []
-        batch_metadata_docs = []
-
-        batch_start_time = time.perf_counter()
-
-        for idx, record in enumerate(batch_metadata, start=batch_start):
-            relative_path = Path(record["image_path"])
-            image_id = record["image_id"]
-            item_id = record["item_id"]
-            image_file_path = Path(SHOE_IMAGES_FOLDER) / relative_path
-
-            if not image_file_path.exists():
-                print(f"Image not found: {image_file_path}")
-                continue
-
-            try:
-                image = Image.open(image_file_path).convert("RGB")
-                emb = extract_embedding(image)
-                batch_embeddings.append(emb)
-
-                batch_metadata_docs.append({
-                    "faiss_index": idx,
-                    "image_id": image_id,
-                    "item_id": item_id,
-                    "image_path": str(relative_path)
-                })
-
-            except Exception as e:
-                print(f"Failed to process {relative_path}: {e}")
-
-            if (idx + 1) % 100 == 0 or (idx + 1) == total_images:
-                print(f"Processed {idx + 1}/{total_images} images")
-
-        batch_end_time = time.perf_counter()
-        batch_duration_ms = (batch_end_time - batch_start_time) * 1000
-        total_time_ms += batch_duration_ms
-        batch_times.append(batch_duration_ms)
-
-        print(f"Batch {batch_start} - {batch_end} processed in {batch_duration_ms:.2f} ms")
-        print(f"Total time elapsed: {total_time_ms / 1000:.2f} seconds")
+    print(f"Timing log saved to {log_file_path}")
+
+
+def _row_item_ids(metadata_col, stored_ids):
+    """item_id of every row of an index's vectors file (given its ids), "" for rows without metadata."""
+    ids, items = [], []
+    for doc in metadata_col.find({}, {"_id": 0, "faiss_id": 1, "item_id": 1}):
+        ids.append(doc["faiss_id"])
+        items.append(str(doc.get("item_id") or ""))
+    if not ids:
+        return np.full(len(stored_ids), "", dtype=object)
+    ids, items = np.array(ids, dtype="int64"), np.array(items, dtype=object)
+    order = np.argsort(ids)
+    ids, items = ids[order], items[order]
+    pos = np.minimum(np.searchsorted(ids, stored_ids), len(ids) - 1)
+    return np.where(ids[pos] == stored_ids, items[pos], "")
+
+
+def _build_category_partitions(name):
+    """
+    One sub-index per product category next to the `name` image index, built
+    from its vectors file with the same faiss ids, plus the CLIP text embedding
+    of CATEGORY_PROMPT for every category (used to route queries). Categories
+    with fewer than CATEGORY_PARTITION_MIN_SIZE images get no sub-index; queries
+    routed there use the global index.
+    """
+    label, metadata_col, index_path = IMAGE_FAISS_TARGETS[name]
+    store = VectorStore.open(index_path, EMBEDDING_DIMS[name])
+    stored_ids = open_ids(ids_path(index_path))
+
+    # Category of every row of the vectors file
+    item_categories = {
+        str(product["item_id"]): product_attributes(product.get("metadata") or {}).get("category", "")
+        for product in products_col.find({}, {"_id": 0, "item_id": 1, "metadata": 1})
+    }
+    row_categories = np.array(
+        [item_categories.get(item_id, "") for item_id in _row_item_ids(metadata_col, stored_ids)], dtype=object
+    )
+
+    categories, counts = np.unique(row_categories[row_categories != ""], return_counts=True)
+    if not len(categories):
+        print(f"No product categories found, no {label} partitions built.")
+        return
 
-        if not batch_embeddings:
-            print(f"No embeddings extracted in batch {batch_start} - {batch_end}. Skipping batch.")
+    partitions = {}
+    for category, count in zip(categories.tolist(), counts.tolist()):
+        if count < CATEGORY_PARTITION_MIN_SIZE:
+            print(f"{label} category '{category}' has {count} images, served by the global index.")
             continue
-
-        embedding_cnn_faiss_metadata_col.insert_many(batch_metadata_docs)
-
-        all_embeddings.extend(batch_embeddings)
-        all_metadata_docs.extend(batch_metadata_docs)
-
-    if not all_embeddings:
-        print("No embeddings extracted overall. Exiting CNN FAISS build.")
+        rows = np.flatnonzero(row_categories == category)
+        # One category's vectors in RAM at a time
+        partitions[category] = build_faiss_index(store.vectors[rows], ids=np.asarray(stored_ids[rows]))
+        print(f"{label} partition '{category}': {count} images")
+
+    prompts = extract_clip_text_embeddings_batch([CATEGORY_PROMPT.format(category) for category in categories.tolist()])
+    save_partitions(index_path, partitions, categories.tolist(), prompts, FAISS_RERANK_K, image_count=len(stored_ids))
+    print(f"{label} category partitions saved next to {index_path}.")
+
+
+def _build_item_centroid_index(name):
+    """
+    Item index next to the `name` image index: one L2-normalized mean of the
+    image vectors per item_id, stored under faiss_id(item_id). Summed chunk by
+    chunk from the vectors file, so only the centroids are held in RAM.
+    """
+    label, metadata_col, index_path = IMAGE_FAISS_TARGETS[name]
+    dim = EMBEDDING_DIMS[name]
+    store = VectorStore.open(index_path, dim)
+    row_items = _row_item_ids(metadata_col, open_ids(ids_path(index_path)))
+
+    has_item = row_items != ""
+    item_ids, inverse = np.unique(row_items[has_item], return_inverse=True)
+    if not len(item_ids):
+        print(f"No {label} image metadata, no item index built.")
         return
-
-    embeddings_np = np.stack(all_embeddings).astype("float32")
-
-    index = build_faiss_index(embeddings_np)
-    save_index(index, FAISS_INDEX_PATH)
-
-    embedding_cnn_faiss_metadata_col.create_index("faiss_index")
-
-    print(f"CNN FAISS index saved to {FAISS_INDEX_PATH} with {len(all_embeddings)} embeddings.")
-
-    # Write timing info to log file
-    with open(LOG_FILE_PATH, "w") as log_file:
-        log_file.write(f"Processed {total_images} images in {total_time_ms / 1000:.2f} seconds\n")
-        log_file.write("Batch processing times (ms):\n")
-        for i, t in enumerate(batch_times):
-            log_file.write(f"Batch {i + 1}: {t:.2f} ms\n")
-
-    print(f"Timing log saved to {LOG_FILE_PATH}")
-
-# def extract_sift_descriptors(image):
-#     gray = np.array(image.convert("L"))
-#     sift = cv2.SIFT_create()
-#     _, descriptors = sift.detectAndCompute(gray, None)
-#     return descriptors if descriptors is not None else np.zeros((1, 128), dtype=np.float32)
-
-
-# def build_cnn_sift_hybrid_index(k=64, batch_size=1000):
-#     with open(IMAGE_PATHS_JSON, "r") as f:
-#         original_metadata = json.load(f)
-
-#     cnn_embeddings = []
-#     sift_descriptors_all = []
-#     metadata_docs = []
-
-#     print(f"Extracting CNN and SIFT features for {len(original_metadata)} images...")
-
-#     for idx, record in enumerate(original_metadata):
-#         relative_path = Path(record["image_path"])
-#         image_id = record["image_id"]
-#         item_id = record["item_id"]
-#         image_file_path = Path(SHOE_IMAGES_FOLDER) / relative_path
-
-#         if not image_file_path.exists():
-#             print(f"Image not found: {image_file_path}")
-#             continue
-
-#         try:
-#             image = Image.open(image_file_path).convert("RGB")
-#             cnn_emb = extract_embedding(image)
-#             cnn_embeddings.append(cnn_emb)
-
-#             sift_desc = extract_sift_descriptors(image)
-#             sift_descriptors_all.append(sift_desc)
-
-#             metadata_docs.append({
-#                 "faiss_index": idx,
-#                 "image_id": image_id,
-#                 "item_id": item_id,
-#                 "image_path": str(relative_path)
-#             })
-
-#         except Exception as e:
-#             print(f"Failed to process {relative_path}: {e}")
-
-#         if (idx + 1) % 100 == 0 or (idx + 1) == len(original_metadata):
-#             print(f"Extracted features for {idx + 1}/{len(original_metadata)} images")
-
-#     if not cnn_embeddings or not sift_descriptors_all:
-#         print("No features extracted. Exiting hybrid index build.")
-#         return
-
-#     all_sift_desc = np.vstack(sift_descriptors_all).astype(np.float32)
-
-#     print(f"Fitting KMeans with k={k} on {all_sift_desc.shape[0]} SIFT descriptors...")
-#     kmeans = MiniBatchKMeans(n_clusters=k, batch_size=batch_size, verbose=1)
-#     kmeans.fit(all_sift_desc)
-
-#     with open(KMEANS_MODEL_PATH, "wb") as f:
-#         pickle.dump(kmeans, f)
-#     print(f"KMeans model saved to {KMEANS_MODEL_PATH}")
-
-#     sift_histograms = []
-#     for sift_desc in sift_descriptors_all:
-#         words = kmeans.predict(sift_desc)
-#         hist = np.bincount(words, minlength=k).astype(np.float32)
-#         hist /= (hist.sum() + 1e-7)
-#         sift_histograms.append(hist)
-
-#     cnn_embeddings = np.stack(cnn_embeddings)
-#     sift_histograms = np.stack(sift_histograms)
-#     hybrid_embeddings = np.hstack([cnn_embeddings, sift_histograms])
-
-#     embedding_meta_hybrid_col.delete_many({})
-#     if metadata_docs:
-#         embedding_meta_hybrid_col.insert_many(metadata_docs)
-#         embedding_meta_hybrid_col.create_index("faiss_index")
-
-#     print(f"Building FAISS index for hybrid embeddings with shape {hybrid_embeddings.shape}...")
-#     index = build_faiss_index(hybrid_embeddings)
-#     save_index(index, FAISS_HYBRID_INDEX_PATH)
-
-#     print(f"Hybrid FAISS index saved to {FAISS_HYBRID_INDEX_PATH}")
-
-
+    codes = np.full(len(row_items), -1, dtype="int64")
+    codes[has_item] = inverse
+
+    centroids = np.zeros((len(item_ids), dim), dtype="float32")
+    for start in range(0, len(store), BATCH_SIZE):
+        chunk_codes = codes[start:start + BATCH_SIZE]
+        keep = chunk_codes >= 0
+        chunk_codes = chunk_codes[keep]
+        chunk = np.asarray(store.vectors[start:start + BATCH_SIZE], dtype="float32")[keep]
+        if not len(chunk_codes):
+            continue
+        # Sum the rows of each item in the chunk with one reduceat over rows sorted by item
+        order = np.argsort(chunk_codes, kind="stable")
+        chunk_codes, chunk = chunk_codes[order], chunk[order]
+        starts = np.flatnonzero(np.r_[True, chunk_codes[1:] != chunk_codes[:-1]])
+        centroids[chunk_codes[starts]] += np.add.reduceat(chunk, starts, axis=0)
+    centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+    item_path = item_index_path(index_path)
+    item_faiss_ids = faiss_ids(item_ids.tolist())
+    index = build_faiss_index(centroids, ids=item_faiss_ids)
+    save_index(index, item_path)
+    VectorStore.save(item_path, item_faiss_ids, centroids)
+    save_item_ids(item_path, item_ids.tolist(), len(store))
+    print(f"{label} item index saved to {item_path} with {len(item_ids)} items "
+          f"({len(store) / len(item_ids):.1f} images per item).")
+
+
+def build_item_centroid_indexes(model_names=("cnn", "clip")):
+    """(Re)build the item-centroid indexes of existing image indexes."""
+    for name in model_names:
+        _build_item_centroid_index(name)
+
+
+def build_category_partitions(model_names=("cnn", "clip")):
+    """(Re)build the category partitions of existing image indexes."""
+    for name in model_names:
+        _build_category_partitions(name)
+
+
+def build_clip_faiss_index(full_rebuild=False):
+    _build_image_faiss_indexes(["clip"], CLIP_LOG_FILE_PATH, full_rebuild)
+
+
+def build_cnn_faiss_index(full_rebuild=False):
+    _build_image_faiss_indexes(["cnn"], LOG_FILE_PATH, full_rebuild)
+
+
+def build_image_faiss_indexes(full_rebuild=False):
+    """Build the CNN and CLIP image indexes with one decode pass over the images."""
+    _build_image_faiss_indexes(["cnn", "clip"], IMAGE_INDEXES_LOG_FILE_PATH, full_rebuild)
+
+def build_sift_features(name="cnn"):
+    """
+    SIFT feature cache of the `name` image index (`<index>.sift`), read by
+    SiftReranker at query time. Extraction runs in SIFT_BUILD_WORKERS processes;
+    features are streamed to disk in id order as they come back.
+    """
+    label, metadata_col, index_path = IMAGE_FAISS_TARGETS[name]
+    ids, paths = [], []
+    for doc in metadata_col.find({}, {"_id": 0, "faiss_id": 1, "image_path": 1}):
+        ids.append(doc["faiss_id"])
+        paths.append(str(Path(SHOE_IMAGES_FOLDER) / doc["image_path"]))
+    print(f"Extracting SIFT features of {len(paths)} {label} images...")
+
+    start = time.time()
+
+    def records():
+        for count, (image_id, (points, descriptors)) in enumerate(zip(ids, extract_files(paths)), start=1):
+            if count % 1000 == 0 or count == len(paths):
+                print(f"SIFT features of {count}/{len(paths)} images")
+            yield image_id, points, descriptors
+
+    base = sift_features_path(index_path)
+    count = SiftFeatureStore.write(base, records())
+    print(f"SIFT features of {count} images saved to {base} in {time.time() - start:.2f} s.")
+
+def build_cnn_sift_hybrid_index(k=SIFT_CODEBOOK_K, train_size=SIFT_CODEBOOK_TRAIN_SIZE, rebuild_features=False):
+    """
+    CNN+SIFT hybrid index at FAISS_HYBRID_INDEX_PATH: every CNN image vector
+    concatenated with the L1-normalized histogram of its SIFT visual words,
+    under the CNN index's faiss ids (so its metadata is the CNN metadata).
+
+    - SIFT features come from the CNN index's cache (build_sift_features, a
+      process pool), extracted first if missing or `rebuild_features`
+    - the k-word codebook is trained by FAISS k-means on `train_size`
+      reservoir-sampled descriptors and saved to KMEANS_MODEL_PATH together
+      with the index
+    - histograms are assigned BATCH_SIZE images at a time with one
+      nearest-centroid search, and the hybrid vectors go straight into a
+      memory-mapped matrix, so no step holds every descriptor in RAM
+    """
+    label, metadata_col, index_path = IMAGE_FAISS_TARGETS["cnn"]
+    base = sift_features_path(index_path)
+    store = None if rebuild_features else SiftFeatureStore.open(base)
+    if store is None:
+        build_sift_features("cnn")
+        store = SiftFeatureStore.open(base)
+    cnn = VectorStore.open(index_path, EMBEDDING_DIMS["cnn"])
+
+    start = time.time()
+    sample = reservoir_sample(store, train_size)
+    if len(sample) < k:
+        print(f"Only {len(sample)} SIFT descriptors for {k} visual words. Exiting hybrid index build.")
+        return
+    print(f"Training FAISS k-means with k={k} on {len(sample)} of {int(store.offsets[-1])} SIFT descriptors...")
+    codebook = SiftCodebook.train(sample, k)
+    print(f"SIFT codebook trained in {time.time() - start:.2f} s")
+
+    # Images of the SIFT cache that still have a CNN vector
+    has_cnn = cnn.rows(store.ids) >= 0
+    ids = store.ids[has_cnn]
+    if not len(ids):
+        print("No CNN vectors for the SIFT features. Exiting hybrid index build.")
+        return
+    tmp_vectors_path = vectors_path(FAISS_HYBRID_INDEX_PATH) + ".tmp"
+    vectors = np.memmap(tmp_vectors_path, dtype="float32", mode="w+", shape=(len(ids), cnn.dim + k))
+    row = 0
+    for chunk_start in range(0, len(store.ids), BATCH_SIZE):
+        chunk_end = min(chunk_start + BATCH_SIZE, len(store.ids))
+        first, last = int(store.offsets[chunk_start]), int(store.offsets[chunk_end])
+        hists = codebook.histograms(store.descriptors[first:last], np.diff(store.offsets[chunk_start:chunk_end + 1]))
+        keep = has_cnn[chunk_start:chunk_end]
+        cnn_vectors, _ = cnn.get(store.ids[chunk_start:chunk_end][keep])
+        vectors[row:row + len(cnn_vectors)] = np.hstack([cnn_vectors, hists[keep]])
+        row += len(cnn_vectors)
+        print(f"Hybrid vectors of {chunk_end}/{len(store.ids)} images")
+    vectors.flush()
+    del vectors
+
+    tmp_ids_path = ids_path(FAISS_HYBRID_INDEX_PATH) + ".tmp"
+    ids.tofile(tmp_ids_path)
+
+    vectors = open_vectors(tmp_vectors_path, cnn.dim + k)
+    print(f"Building FAISS index for hybrid embeddings with shape {vectors.shape}...")
+    index = build_faiss_index(vectors, ids=ids)
+    del vectors
+
+    # Publish index, vectors, ids and codebook together, each with an atomic rename
+    save_index(index, FAISS_HYBRID_INDEX_PATH)
+    os.replace(tmp_vectors_path, vectors_path(FAISS_HYBRID_INDEX_PATH))
+    os.replace(tmp_ids_path, ids_path(FAISS_HYBRID_INDEX_PATH))
+    codebook.save(KMEANS_MODEL_PATH)
+    print(f"SIFT codebook saved to {KMEANS_MODEL_PATH}")
+    print(f"Hybrid FAISS index saved to {FAISS_HYBRID_INDEX_PATH} in {time.time() - start:.2f} s")
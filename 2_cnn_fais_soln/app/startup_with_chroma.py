@@ -1,12 +1,14 @@
-from app.model import extract_clip_embedding, extract_clip_text_embedding, extract_embedding
-import os
+from app.model import extract_clip_text_embeddings_batch, embed_preprocessed_batch, model_version
+from typing import Dict
+from app.image_loader import PrefetchingImageLoader, StageStats
+from app.build_checkpoint import BuildCheckpoint
+from app.build_manifest import ImageManifest, plan_image_build, select_records, ids_digest
+from app.search import iter_json_array
+from app.filters import chroma_filter_fields
 
-from PIL import Image
-import numpy as np
-import json
 import time
-from pathlib import Path
-from app.config import SHOE_IMAGES_FOLDER, IMAGE_PATHS_JSON, SHOE_PRODUCT_JSON_PATH, CHROMA_CLIP_IMAGE_EMBEDDINGS_COLLECTION, CHROMA_CLIP_ITEM_EMBEDDINGS_COLLECTION, CHROMA_CNN_EMBEDDINGS_COLLECTION
+import itertools
+from app.config import SHOE_IMAGES_FOLDER, IMAGE_PATHS_JSON, SHOE_PRODUCT_JSON_PATH, CHROMA_CLIP_IMAGE_EMBEDDINGS_COLLECTION, CHROMA_CLIP_ITEM_EMBEDDINGS_COLLECTION, CHROMA_CNN_EMBEDDINGS_COLLECTION, INFERENCE_BACKEND, MODEL_PRECISION
 from app.db.chroma import ChromaDBClient  # Assuming ChromaDBClient is your Chroma client
 from app.db.mongo import products_col
 
@@ -15,6 +17,7 @@ BATCH_SIZE = 1000
 CLIP_ITEM_LOG_FILE_PATH="clip_item_build_time.log"
 CLIP_IMAGE_LOG_FILE_PATH="clip_image_build_time.log"
 CNN_LOG_FILE_PATH="cnn_build_time.log"
+IMAGE_COLLECTIONS_LOG_FILE_PATH="image_collections_build_time.log"
 
 
 def flatten_metadata(metadata: dict, parent_key='', sep='.'):
@@ -43,7 +46,9 @@ def get_item_metadata_batch(item_ids):
     items = products_col.find({"item_id": {"$in": item_ids_list}})
     item_metadata_map = {}
     for item in items:
-        item_metadata_map[item['item_id']] = flatten_metadata(item.get('metadata', {}))
+        metadata = item.get('metadata', {})
+        # Normalized filter_* fields next to the flattened metadata, for `where` filters
+        item_metadata_map[item['item_id']] = {**flatten_metadata(metadata), **chroma_filter_fields(metadata)}
 
     return item_metadata_map
 
@@ -62,138 +67,187 @@ def log_batch_time(batch_start, batch_end, batch_start_time, total_time_ms, batc
     
     return total_time_ms, batch_times
 
-def build_cnn_image_collection(chroma_client: ChromaDBClient):
-    with open(IMAGE_PATHS_JSON, "r") as f:
-        original_metadata = json.load(f)
-
-    print(f"Processing {len(original_metadata)} images for CNN image collection...")
-    total_images = len(original_metadata)
-    all_image_embeddings = []
-    all_metadata_docs = []
+def _insert_image_collection_batches(chroma_client: ChromaDBClient, collections: Dict[str, str], log_file_path: str, full_rebuild: bool = False):
+    """
+    Embed every image listed in IMAGE_PATHS_JSON and insert the vectors, keyed
+    by image_id, with flattened item metadata into Chroma.
+    `collections` maps collection name -> model name ("cnn" / "clip"); each image
+    is decoded once and embedded by every model in the same pass.
+
+    When every collection has a manifest (image_id -> content hash + model
+    version), the live collections are patched in place: only new or changed
+    images are embedded and upserted, removed images are deleted.
+    Otherwise, or with `full_rebuild`, vectors go to "<collection>_staging"
+    collections that replace the live ones only when all images are in.
+    Either way every batch is checkpointed, so a killed build resumes where it stopped.
+    IMAGE_PATHS_JSON is streamed rather than loaded whole.
+    Returns the number of inserted embeddings per collection and the inference + write time in ms.
+    """
+    manifests = {collection_name: ImageManifest.load(f"chroma_{collection_name}") for collection_name in collections}
+    incremental = not full_rebuild and all(manifest.exists() for manifest in manifests.values())
+    versions = {collection_name: model_version(model_name) for collection_name, model_name in collections.items()}
+    to_embed, keep, fingerprints = plan_image_build(
+        iter_json_array(IMAGE_PATHS_JSON), SHOE_IMAGES_FOLDER, manifests, versions, incremental
+    )
+    total_images = len(fingerprints)
+    if incremental:
+        if not to_embed and all(len(keep[name]) == len(manifests[name].entries) for name in collections):
+            print(f"{', '.join(collections)} up to date with {total_images} images.")
+            return 0, 0
+        # Incremental builds write straight into the live collections
+        target_names = {collection_name: collection_name for collection_name in collections}
+    else:
+        target_names = {collection_name: f"{collection_name}_staging" for collection_name in collections}
+    print(f"Processing {len(to_embed)} images for {', '.join(collections)}...")
+
+    checkpoint = BuildCheckpoint(
+        f"chroma_{'+'.join(collections)}",
+        {},
+        {
+            "source": IMAGE_PATHS_JSON,
+            "records": len(to_embed),
+            "images": ids_digest(to_embed),
+            "incremental": incremental,
+            "backend": INFERENCE_BACKEND,
+            "precision": MODEL_PRECISION,
+        },
+    )
+    resume_offset = checkpoint.resume()
+    if not resume_offset and not incremental:
+        for staging_name in target_names.values():
+            chroma_client.reset_collection(staging_name)
 
     total_time_ms = 0
     batch_times = []
 
-    for batch_start in range(0, len(original_metadata), BATCH_SIZE):
-        batch_end = min(batch_start + BATCH_SIZE, len(original_metadata))
-        batch_metadata = original_metadata[batch_start:batch_end]
-
+    # Decode/preprocess runs ahead in a thread pool while this loop runs inference
+    model_names = tuple(collections.values())
+    stats = StageStats()
+    loader = PrefetchingImageLoader(
+        itertools.islice(select_records(iter_json_array(IMAGE_PATHS_JSON), to_embed), resume_offset, None),
+        SHOE_IMAGES_FOLDER,
+        model_names,
+        stats=stats,
+        start=resume_offset,
+    )
+
+    for batch in loader:
         batch_start_time = time.perf_counter()
 
-        # Step 1: Extract all unique item_ids in the current batch
-        item_ids = set(record['item_id'] for record in batch_metadata)
+        # Step 1: Embed the decoded batch with every model
+        embeddings = None
+        if batch.loaded:
+            try:
+                embeddings = {name: embed_preprocessed_batch(name, batch.tensors[name]) for name in model_names}
+            except Exception as e:
+                print(f"Failed to embed batch {batch.start} - {batch.end}: {e}")
+        stats.add("inference", time.perf_counter() - batch_start_time, len(batch.loaded))
 
         # Step 2: Fetch item metadata for all item_ids in the batch from MongoDB
-        item_metadata_map = get_item_metadata_batch(item_ids)
-
-        batch_embeddings = []
+        # and insert the batch of image embeddings and metadata into Chroma.
+        # Upsert, because a resumed build may re-send the batch that was cut off.
         batch_metadata_docs = []
+        if embeddings is not None:
+            write_start_time = time.perf_counter()
+            item_metadata_map = get_item_metadata_batch(set(record["item_id"] for _, record in batch.loaded))
+            batch_metadata_docs = [
+                {
+                    "image_id": record["image_id"],
+                    "item_id": record["item_id"],
+                    **item_metadata_map.get(record["item_id"], {})
+                }
+                for _, record in batch.loaded
+            ]
+            image_ids = [str(meta["image_id"]) for meta in batch_metadata_docs]
+            for collection_name, model_name in collections.items():
+                chroma_client.upsert_embeddings(
+                    collection_name=target_names[collection_name],
+                    ids=image_ids,
+                    embeddings=embeddings[model_name],
+                    metadatas=batch_metadata_docs
+                )
+            stats.add("chroma write", time.perf_counter() - write_start_time, len(image_ids))
+            if batch.start == 0:
+                print(f"metadata looks like {batch_metadata_docs[0]}")
+        # Only the image ids are checkpointed, the vectors are already in Chroma
+        checkpoint.commit(batch.end, {}, [{"image_id": meta["image_id"]} for meta in batch_metadata_docs])
+
+        total_time_ms, batch_times = log_batch_time(batch.start, batch.end, batch_start_time, total_time_ms, batch_times, log_file_path)
+
+        if batch.end % BATCH_SIZE < loader.batch_size or batch.end == len(to_embed):
+            print(f"Processed {batch.end}/{len(to_embed)} images")
+            for line in stats.report():
+                print(f"  {line}")
+
+    num_inserted = checkpoint.num_rows
+    if not incremental:
+        for collection_name, staging_name in target_names.items():
+            chroma_client.replace_collection(staging_name, collection_name)
+
+    embedded_ids = [str(doc["image_id"]) for doc in checkpoint.metadata_docs()]
+    for collection_name, manifest in manifests.items():
+        kept = set(keep[collection_name])
+        removed = [image_id for image_id in manifest.entries if image_id not in kept and image_id not in fingerprints]
+        if incremental and removed:
+            chroma_client.delete_embeddings(collection_name, removed)
+        entries = {image_id: manifest.entries[image_id] for image_id in kept}
+        for image_id in embedded_ids:
+            if image_id in fingerprints:
+                entries[image_id] = dict(fingerprints[image_id], model=versions[collection_name])
+        ImageManifest(manifest.name, entries).save()
+    checkpoint.clear()
 
-        # Step 3: Process each image and include the corresponding metadata
-        for idx, record in enumerate(batch_metadata, start=batch_start):
-            relative_path = Path(record["image_path"])
-            image_id = record["image_id"]
-            item_id = record["item_id"]
-            image_file_path = Path(os.path.join(SHOE_IMAGES_FOLDER, relative_path)) # Path(SHOE_IMAGES_FOLDER) / relative_path)
-
-            if not image_file_path.exists():
-                print(f"Image not found: {image_file_path}")
-                continue
-
-            try:
-                image = Image.open(image_file_path).convert("RGB")
-                emb = extract_embedding(image)
-
-                # Get the item metadata for this image
-                item_metadata = item_metadata_map.get(item_id, {})
-                flattened_metadata = item_metadata
+    with open(log_file_path, "a") as log_file:
+        if resume_offset:
+            log_file.write(f"Resumed from checkpoint at image {resume_offset}\n")
+        log_file.write("Throughput per stage:\n")
+        for line in stats.report():
+            log_file.write(f"{line}\n")
 
-                batch_embeddings.append(emb)
-                batch_metadata_docs.append({
-                    "image_id": image_id,
-                    "item_id": item_id,
-                    **flattened_metadata
-                })
+    return num_inserted, total_time_ms
 
-                if (idx + 1) % 100 == 0 or (idx + 1) == total_images:
-                    print(f"Processed {idx + 1}/{total_images} images")
 
-            except Exception as e:
-                print(f"Failed to process {relative_path}: {e}")
+def build_cnn_image_collection(chroma_client: ChromaDBClient, full_rebuild: bool = False):
+    num_inserted, total_time_ms = _insert_image_collection_batches(
+        chroma_client, {CHROMA_CNN_EMBEDDINGS_COLLECTION: "cnn"}, CNN_LOG_FILE_PATH, full_rebuild
+    )
 
-        # Step 4: Insert batch of image embeddings and metadata into Chroma
-        if batch_embeddings:
-            embeddings_np = np.stack(batch_embeddings).astype("float32")
-            chroma_client.insert_embeddings(
-                collection_name=CHROMA_CNN_EMBEDDINGS_COLLECTION,
-                embeddings=embeddings_np,
-                metadatas=batch_metadata_docs
-            )
-
-        total_time_ms, batch_times = log_batch_time(batch_start, batch_end, batch_start_time, total_time_ms, batch_times, CNN_LOG_FILE_PATH)
-
-    print(f"Inserted {len(all_image_embeddings)} image embeddings into Chroma CNN image collection.")
+    print(f"Inserted {num_inserted} image embeddings into Chroma CNN image collection.")
     with open(CNN_LOG_FILE_PATH, "a") as log_file:
         log_file.write(f"Total time for CNN image collection: {total_time_ms / 1000:.2f} seconds\n")
 
 
-
 def build_clip_item_collection(chroma_client: ChromaDBClient):
-    with open(SHOE_PRODUCT_JSON_PATH, "r") as f:
-        products = json.load(f)
-
-    print(f"Processing {len(products)} items for CLIP item collection...")
-
-    all_text_embeddings = []
-    all_metadata_docs = []
+    print("Processing items for CLIP item collection...")
 
+    num_inserted = 0
     total_time_ms = 0
     batch_times = []
-    total_items = len(products)
 
-    for batch_start in range(0, len(products), BATCH_SIZE):
-        batch_end = min(batch_start + BATCH_SIZE, len(products))
-        batch_metadata = products[batch_start:batch_end]
+    # Stream the product JSON a batch at a time instead of loading it whole
+    products = iter_json_array(SHOE_PRODUCT_JSON_PATH)
+    for batch_start in itertools.count(0, BATCH_SIZE):
+        batch_products = list(itertools.islice(products, BATCH_SIZE))
+        if not batch_products:
+            break
+        batch_end = batch_start + len(batch_products)
 
         batch_start_time = time.perf_counter()
 
-        # Step 1: Prepare item metadata and embed text
-        item_ids = [product['item_id'] for product in batch_metadata]
-
-        # Flatten and store metadata directly in the item entry for filtering
-        batch_embeddings = []
-        batch_metadata_docs = []
-
-        
-        for idx, product in enumerate(batch_metadata, start=batch_start):
-            item_id = product["item_id"]
-            metadata = product.get("metadata", {})
-
-            # Flatten metadata
-            flattened_metadata = flatten_metadata(metadata)
-
-            try:
-                text = metadata_to_text(metadata)
-                emb = extract_clip_text_embedding(text=text)
-
-                batch_embeddings.append(emb)
-                meta_data_curr = {
-                    "item_id": item_id,
-                    **flattened_metadata
-                }
-                batch_metadata_docs.append(meta_data_curr)
-
-                if (idx + 1) % 100 == 0 or (idx + 1) == total_items:
-                    if idx <1000 : 
-                        print(f"metadata looks like {meta_data_curr}")
-                    print(f"Processed {idx + 1}/{total_items} images")
-                
-            except Exception as e:
-                print(f"Failed to process item {item_id}: {e}")
-
-        # Step 2: Insert batch of CLIP text embeddings and metadata into Chroma
-        if batch_embeddings:
-            embeddings_np = np.stack(batch_embeddings).astype("float32")
+        # Step 1: Flatten and store metadata directly in the item entry for filtering
+        batch_metadata_docs = [
+            {
+                "item_id": product["item_id"],
+                **flatten_metadata(product.get("metadata", {})),
+                **chroma_filter_fields(product.get("metadata", {}))
+            }
+            for product in batch_products
+        ]
+        texts = [metadata_to_text(product.get("metadata", {})) for product in batch_products]
+
+        # Step 2: Embed all texts of the batch and insert them into Chroma
+        try:
+            embeddings_np = extract_clip_text_embeddings_batch(texts)
             item_ids = [meta["item_id"] for meta in batch_metadata_docs]
 
             chroma_client.insert_embeddings(
@@ -202,101 +256,47 @@ def build_clip_item_collection(chroma_client: ChromaDBClient):
                 embeddings=embeddings_np,
                 metadatas=batch_metadata_docs
             )
+            num_inserted += len(item_ids)
+            if batch_start < 1000:
+                print(f"metadata looks like {batch_metadata_docs[0]}")
+        except Exception as e:
+            print(f"Failed to process items {batch_start} - {batch_end}: {e}")
 
+        print(f"Processed {batch_end} items")
         total_time_ms, batch_times = log_batch_time(batch_start, batch_end, batch_start_time, total_time_ms, batch_times, CLIP_ITEM_LOG_FILE_PATH)
 
-    print(f"Inserted {len(all_text_embeddings)} CLIP item embeddings into Chroma item collection.")
+    print(f"Inserted {num_inserted} CLIP item embeddings into Chroma item collection.")
     with open(CLIP_ITEM_LOG_FILE_PATH, "a") as log_file:
         log_file.write(f"Total time for CLIP item collection: {total_time_ms / 1000:.2f} seconds\n")
 
 
-def build_clip_image_collection(chroma_client: ChromaDBClient):
-
-    chroma_client.reset_collection(CHROMA_CLIP_IMAGE_EMBEDDINGS_COLLECTION)
-
-    with open(IMAGE_PATHS_JSON, "r") as f:
-        original_metadata = json.load(f)
+def build_clip_image_collection(chroma_client: ChromaDBClient, full_rebuild: bool = False):
+    num_inserted, total_time_ms = _insert_image_collection_batches(
+        chroma_client, {CHROMA_CLIP_IMAGE_EMBEDDINGS_COLLECTION: "clip"}, CLIP_IMAGE_LOG_FILE_PATH, full_rebuild
+    )
 
-    print(f"Processing {len(original_metadata)} images for CLIP image collection...")
-
-    total_images = len(original_metadata)
-
-    all_image_embeddings = []
-    all_metadata_docs = []
-
-    total_time_ms = 0
-    batch_times = []
-
-    for batch_start in range(0, len(original_metadata), BATCH_SIZE):
-        batch_end = min(batch_start + BATCH_SIZE, len(original_metadata))
-        batch_metadata = original_metadata[batch_start:batch_end]
-
-        batch_start_time = time.perf_counter()
-
-        # Step 1: Extract all unique item_ids in the current batch
-        item_ids = set(record['item_id'] for record in batch_metadata)
-
-        # Step 2: Fetch item metadata for all item_ids in the batch from MongoDB
-        item_metadata_map = get_item_metadata_batch(item_ids)
-
-        batch_embeddings = []
-        batch_metadata_docs = []
-
-        # Step 3: Process each image and include the corresponding metadata
-        for idx, record in enumerate(batch_metadata, start=batch_start):
-            relative_path = Path(record["image_path"])
-            image_id = record["image_id"]
-            item_id = record["item_id"]
-            image_file_path = Path(os.path.join(SHOE_IMAGES_FOLDER, relative_path)) #Path(SHOE_IMAGES_FOLDER) / relative_path)
-
-            if not image_file_path.exists():
-                print(f"Image not found: {image_file_path}")
-                continue
-
-            try:
-                image = Image.open(image_file_path).convert("RGB")
-                emb = extract_clip_embedding(image)
-
-                # Get the item metadata for this image
-                item_metadata = item_metadata_map.get(item_id, {})
-                flattened_metadata = item_metadata
-
-                batch_embeddings.append(emb)
-
-                meta_data_curr = {
-                    "image_id": image_id,
-                    "item_id": item_id,
-                    **flattened_metadata
-                }
-                batch_metadata_docs.append(meta_data_curr)
-
-                
-                if (idx + 1) % 100 == 0 or (idx + 1) == total_images:
-                    if idx <1000 : 
-                        print(f"metadata looks like {meta_data_curr}")
-                    print(f"Processed {idx + 1}/{total_images} images")
-
-            except Exception as e:
-                print(f"Failed to process {relative_path}: {e}")
-
-        # Step 4: Insert batch of image embeddings and metadata into Chroma
-        if batch_embeddings:
-            embeddings_np = np.stack(batch_embeddings).astype("float32")
-            image_ids = [str(meta["image_id"]) for meta in batch_metadata_docs]
-            chroma_client.insert_embeddings(
-                collection_name=CHROMA_CLIP_IMAGE_EMBEDDINGS_COLLECTION,
-                ids=image_ids,
-                embeddings=embeddings_np,
-                metadatas=batch_metadata_docs
-            )
-
-        total_time_ms, batch_times = log_batch_time(batch_start, batch_end, batch_start_time, total_time_ms, batch_times, CLIP_IMAGE_LOG_FILE_PATH)
-
-    print(f"Inserted {len(all_image_embeddings)} image embeddings into Chroma CLIP image collection.")
+    print(f"Inserted {num_inserted} image embeddings into Chroma CLIP image collection.")
     with open(CLIP_IMAGE_LOG_FILE_PATH, "a") as log_file:
         log_file.write(f"Total time for CLIP image collection: {total_time_ms / 1000:.2f} seconds\n")
 
 
+def build_image_collections(chroma_client: ChromaDBClient, full_rebuild: bool = False):
+    """
+    Build the CNN and CLIP image collections in a single pass over the images,
+    so every image is read and decoded once instead of once per model.
+    """
+    num_inserted, total_time_ms = _insert_image_collection_batches(
+        chroma_client,
+        {CHROMA_CNN_EMBEDDINGS_COLLECTION: "cnn", CHROMA_CLIP_IMAGE_EMBEDDINGS_COLLECTION: "clip"},
+        IMAGE_COLLECTIONS_LOG_FILE_PATH,
+        full_rebuild
+    )
+
+    print(f"Inserted {num_inserted} image embeddings into Chroma CNN and CLIP image collections.")
+    with open(IMAGE_COLLECTIONS_LOG_FILE_PATH, "a") as log_file:
+        log_file.write(f"Total time for CNN + CLIP image collections: {total_time_ms / 1000:.2f} seconds\n")
+
+
 def metadata_to_text(metadata: dict) -> str:
     """
     Convert the metadata dictionary into a descriptive string for CLIP text embedding.
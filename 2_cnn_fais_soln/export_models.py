@@ -0,0 +1,16 @@
+import sys
+from app.model import load_model
+from app.inference_backends import INFERENCE_BACKENDS
+
+# One-time export of the embedding models for the optimized inference backends.
+# Usage: python export_models.py [torchscript] [onnx]
+# Artifacts land in MODEL_CACHE_DIR and are picked up by INFERENCE_BACKEND at load time.
+
+if __name__ == "__main__":
+    backends = sys.argv[1:] or ["torchscript", "onnx"]
+    for backend in backends:
+        if backend not in INFERENCE_BACKENDS:
+            raise SystemExit(f"Unknown backend {backend}, expected one of {INFERENCE_BACKENDS}")
+        for name in ("cnn", "clip"):
+            print(f"Preparing {name} for {backend}...")
+            load_model(name, backend)
@@ -1,5 +1,5 @@
-from app.startup import build_cnn_faiss_index, build_products_col, build_clip_faiss_index, build_clip_text_faiss_index
-from app.startup_with_chroma import build_clip_item_collection, build_cnn_image_collection, build_clip_image_collection
+from app.startup import build_cnn_faiss_index, build_products_col, build_clip_faiss_index, build_clip_text_faiss_index, build_image_faiss_indexes, build_category_partitions, build_item_centroid_indexes, build_sift_features, build_cnn_sift_hybrid_index
+from app.startup_with_chroma import build_clip_item_collection, build_cnn_image_collection, build_clip_image_collection, build_image_collections
 from app.db.chroma import ChromaDBClient
 
 
@@ -12,7 +12,13 @@ if __name__ == "__main__":
     # build_cnn_faiss_index()
     # build_clip_text_faiss_index()
     # build_clip_faiss_index()
+    # build_image_faiss_indexes()  # CNN + CLIP indexes, each image decoded once
+    # build_category_partitions()  # per-category sub-indexes of the built image indexes
+    # build_item_centroid_indexes()  # one centroid per item, for two-stage group_by_item search
+    # build_sift_features()  # SIFT cache of the CNN index, for SiftReranker
+    # build_cnn_sift_hybrid_index()  # CNN + SIFT visual word histogram index
 
     # build_cnn_image_collection(chroma_client)
     # build_clip_item_collection(chroma_client)
+    # build_image_collections(chroma_client)  # CNN + CLIP collections, each image decoded once
     build_clip_image_collection(chroma_client)
\ No newline at end of file
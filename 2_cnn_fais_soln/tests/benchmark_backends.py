@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import time
+import random
+import numpy as np
+from PIL import Image
+from app.config import IMAGE_PATHS_JSON, SHOE_IMAGES_FOLDER, SHOE_PRODUCT_JSON_PATH, EMBEDDING_BATCH_SIZE
+from app.model import load_model, extract_embeddings_batch, extract_clip_embeddings_batch, extract_clip_text_embeddings_batch
+from app.inference_backends import INFERENCE_BACKENDS
+
+# Compares the inference backends against eager PyTorch:
+# - accuracy: every embedding must stay within MIN_COSINE of the eager one
+# - query latency: p50 / p95 of batch-1 calls (what /search/ pays)
+# - build throughput: items/sec with EMBEDDING_BATCH_SIZE batches (what the builders pay)
+# Usage: python -m tests.benchmark_backends [sample_size]
+
+MIN_COSINE = 0.999
+LOG_FILE_PATH = "backend_benchmark.log"
+
+
+def load_sample_images(sample_size):
+    with open(IMAGE_PATHS_JSON, "r") as f:
+        records = json.load(f)
+    random.seed(0)
+    images = []
+    for record in random.sample(records, min(sample_size * 2, len(records))):
+        path = os.path.join(SHOE_IMAGES_FOLDER, record["image_path"])
+        if os.path.exists(path):
+            images.append(Image.open(path).convert("RGB"))
+        if len(images) == sample_size:
+            break
+    return images
+
+
+def load_sample_texts(sample_size):
+    with open(SHOE_PRODUCT_JSON_PATH, "r") as f:
+        products = json.load(f)
+    texts = []
+    for product in products[:sample_size]:
+        names = product.get("item_name", [])
+        texts.append(names[0]["value"] if names else product["item_id"])
+    return texts
+
+
+def time_calls(embed, inputs, loaded):
+    latencies = []
+    for item in inputs:
+        start = time.perf_counter()
+        embed([item], loaded)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    embeddings = embed(inputs, loaded)
+    throughput = len(inputs) / (time.perf_counter() - start)
+
+    return embeddings, np.percentile(latencies, 50), np.percentile(latencies, 95), throughput
+
+
+def main():
+    sample_size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    images = load_sample_images(sample_size)
+    texts = load_sample_texts(sample_size)
+    print(f"Benchmarking on {len(images)} images and {len(texts)} texts")
+
+    cases = [
+        ("cnn", "cnn_image", images, lambda xs, m: extract_embeddings_batch(xs, EMBEDDING_BATCH_SIZE, m)),
+        ("clip", "clip_image", images, lambda xs, m: extract_clip_embeddings_batch(xs, EMBEDDING_BATCH_SIZE, m)),
+        ("clip", "clip_text", texts, lambda xs, m: extract_clip_text_embeddings_batch(xs, EMBEDDING_BATCH_SIZE, m)),
+    ]
+
+    lines = []
+    failed = False
+    for model_name, label, inputs, embed in cases:
+        reference = None
+        for backend in INFERENCE_BACKENDS:
+            loaded = load_model(model_name, backend, "fp32")
+            embed(inputs[:2], loaded)  # warm-up
+            embeddings, p50, p95, throughput = time_calls(embed, inputs, loaded)
+
+            if reference is None:
+                reference = embeddings
+            min_cosine = float(np.min(np.sum(embeddings * reference, axis=1)))
+            ok = min_cosine >= MIN_COSINE
+            failed = failed or not ok
+
+            line = (
+                f"{label:<11} {backend:<12} p50={p50:7.2f} ms  p95={p95:7.2f} ms  "
+                f"throughput={throughput:8.1f}/s  min_cosine_vs_eager={min_cosine:.6f} {'OK' if ok else 'FAIL'}"
+            )
+            print(line)
+            lines.append(line)
+
+    with open(LOG_FILE_PATH, "w") as log_file:
+        log_file.write("\n".join(lines) + "\n")
+    print(f"Benchmark log saved to {LOG_FILE_PATH}")
+
+    if failed:
+        raise SystemExit(f"Some backends drifted below cosine {MIN_COSINE} from eager")
+
+
+if __name__ == "__main__":
+    main()
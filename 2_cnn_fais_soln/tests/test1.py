@@ -2,15 +2,14 @@ import os
 import json
 import time
 import asyncio
+from PIL import Image
 from pymongo import MongoClient
-from starlette.datastructures import UploadFile
-from app.models.search_models import SearchRequest
-from app.controllers.search_controller import SearchController
-from app.model import extract_embedding, extract_clip_embedding
+from app.model import extract_embedding, extract_clip_embedding, extract_clip_text_embedding, extract_embeddings_batch, extract_clip_embeddings_batch
+from app.search import load_index, search, search_batch
+from app.metadata_table import MetadataTable
 from app.services.cnn_faiss import CNNFaissSearch
 from app.services.clip_faiss import CLIPFaissSearch
-from app.search import load_index, search
-from app.config import SHOE_IMAGES_FOLDER, TEST_SET_MODIFY_FOLDER, FAISS_INDEX_PATH, CLIP_FAISS_INDEX_PATH, PRODUCT_COLLECTION, EMBEDDING_CLIP_FAISS_METADATA_COLLECTION, EMBEDDING_CNN_FAISS_METADATA_COLLECTION
+from app.config import SHOE_IMAGES_FOLDER, TEST_SET_MODIFY_FOLDER, FAISS_INDEX_PATH, CLIP_FAISS_INDEX_PATH, CLIP_FAISS_INDEX_TEXT_PATH, PRODUCT_COLLECTION, EMBEDDING_CLIP_FAISS_METADATA_COLLECTION, EMBEDDING_CNN_FAISS_METADATA_COLLECTION
 from tests.test_modification import apply_modification
 
 # MongoDB setup
@@ -23,13 +22,13 @@ embedding_clip_faiss_metadata_col = db[EMBEDDING_CLIP_FAISS_METADATA_COLLECTION]
 # Load FAISS indexes
 cnn_index = load_index(FAISS_INDEX_PATH)
 clip_index = load_index(CLIP_FAISS_INDEX_PATH)
+clip_text_index = load_index(CLIP_FAISS_INDEX_TEXT_PATH)
 
-# Initialize services
-cnn_faiss_service = CNNFaissSearch(cnn_index, extract_embedding, search)  # Replace None with actual search fn if needed
-clip_faiss_service = CLIPFaissSearch(clip_index, extract_clip_embedding, search)  # Replace None with actual search fn if needed
-
-# Initialize controller with both services
-search_controller = SearchController(cnn_faiss_service, clip_faiss_service)
+# Services as the API runs them (in-memory metadata, executor stages), one query per call
+cnn_faiss_service = CNNFaissSearch(cnn_index, extract_embedding, search,
+                                   metadata=MetadataTable.from_collection(embedding_cnn_faiss_metadata_col))
+clip_faiss_service = CLIPFaissSearch(clip_index, clip_text_index, extract_clip_embedding, extract_clip_text_embedding, search,
+                                     metadata=MetadataTable.from_collection(embedding_clip_faiss_metadata_col))
 
 # Ask for test case name
 test_case_name = input("Enter test case name (folder name) to save modified images and logs: ").strip()
@@ -37,18 +36,6 @@ modified_images_folder = os.path.join(TEST_SET_MODIFY_FOLDER, test_case_name)
 os.makedirs(modified_images_folder, exist_ok=True)
 print(f"Modified images and logs will be saved to: {modified_images_folder}")
 
-# Helper to create UploadFile from path
-async def create_upload_file_from_path(file_path: str) -> UploadFile:
-    file = open(file_path, "rb")
-    file_size = os.path.getsize(file_path)
-    headers = {"content-type": "image/jpeg"}
-    return UploadFile(
-        filename=os.path.basename(file_path),
-        file=file,
-        size=file_size,
-        headers=headers
-    )
-
 # Sample images once
 def sample_images(sample_size=100):
     sampled_products = list(products_col.aggregate([
@@ -64,59 +51,74 @@ def sample_images(sample_size=100):
             main_images.append(doc)
     return main_images
 
-# Generic test function for CNN or CLIP
-async def run_search_test(search_controller, metadata_col, log_file_path, method_name):
+# Generic test function for CNN or CLIP. Every original and modified image is
+# searched twice: through the service, one query at a time as the API serves it,
+# and embedded and searched in one batch (one FAISS call for the whole sample)
+async def run_search_test(service, embed_batch, log_file_path, method_name, top_k=5):
     main_images = sample_images()
-    total = len(main_images)
-    print(f"[{method_name}] Sampled {total} images for testing.")
-
-    pass_count_original = 0
-    pass_count_modified = 0
-    log_entries = []
-    total_search_duration = 0
+    print(f"[{method_name}] Sampled {len(main_images)} images for testing.")
 
     start_time = time.time()
 
-    for idx, img_meta in enumerate(main_images, 1):
+    tested = []
+    original_images = []
+    modified_images = []
+    for img_meta in main_images:
         item_id = img_meta["item_id"]
-        image_rel_path = img_meta["image_path"]
-        image_abs_path = os.path.join(SHOE_IMAGES_FOLDER, image_rel_path)
-
+        image_abs_path = os.path.join(SHOE_IMAGES_FOLDER, img_meta["image_path"])
         if not os.path.exists(image_abs_path):
-            print(f"[{method_name}] [{idx}/{total}] Image file not found: {image_abs_path}")
+            print(f"[{method_name}] Image file not found: {image_abs_path}")
             continue
 
-        upload_file_original = await create_upload_file_from_path(image_abs_path)
-        # Create SearchRequest params instance
-        params = SearchRequest(method=method_name, top_k=5)
-
-        # Original image search
-        search_start = time.time()
-        results = await search_controller.search(upload_file_original, params)
-        upload_file_original.file.close()
-        duration_original = time.time() - search_start
-        total_search_duration += duration_original
-
-        print("results",results)
-        found_original = any(r.get('item_id') == item_id for r in results)
-        if found_original:
-            pass_count_original += 1
-
         # Modified image (copy)
         modified_image_path = os.path.join(modified_images_folder, f"{item_id}_copy.jpg")
         apply_modification(image_abs_path, modified_image_path)
-        upload_file_modified = await create_upload_file_from_path(modified_image_path)
 
-        # Modified image search
+        tested.append((item_id, image_abs_path, modified_image_path))
+        original_images.append(Image.open(image_abs_path).convert("RGB"))
+        modified_images.append(Image.open(modified_image_path).convert("RGB"))
+
+    total = len(tested)
+    if not total:
+        print(f"[{method_name}] No images to test.")
+        return
+
+    # Service pass: each query embedded and searched on its own, timed end to end
+    service_durations = []
+    service_matches = []
+    for query_image in original_images + modified_images:
         search_start = time.time()
-        modified_results = await search_controller.search(upload_file_modified, params)
-        upload_file_modified.file.close()
-        duration_modified = time.time() - search_start
-        total_search_duration += duration_modified
+        results = await service.search_image(query_image, top_k)
+        service_durations.append(time.time() - search_start)
+        service_matches.append([r.get("item_id") for r in results])
+    service_duration = sum(service_durations)
+    avg_service_duration = service_duration / (2 * total)
+
+    # Batch pass: originals and modified images embedded together, then searched as one (2 * total, D) batch
+    embed_start = time.time()
+    query_embs = embed_batch(original_images + modified_images)
+    embed_duration = time.time() - embed_start
 
-        found_modified = any(r.get('item_id') == item_id for r in modified_results)
-        if found_modified:
-            pass_count_modified += 1
+    search_start = time.time()
+    ids, scores = search_batch(service.index, query_embs, top_k)
+    search_duration = time.time() - search_start
+    avg_search_duration = search_duration / (2 * total)
+
+    matched = [[hit["item_id"] for hit in service.metadata.resolve(row_ids, row_scores)] for row_ids, row_scores in zip(ids, scores)]
+
+    pass_count_original = 0
+    pass_count_modified = 0
+    batch_pass_count_original = 0
+    batch_pass_count_modified = 0
+    log_entries = []
+    for i, (item_id, image_abs_path, modified_image_path) in enumerate(tested):
+        original_matches, modified_matches = service_matches[i], service_matches[total + i]
+        found_original = item_id in original_matches
+        found_modified = item_id in modified_matches
+        pass_count_original += found_original
+        pass_count_modified += found_modified
+        batch_pass_count_original += item_id in matched[i]
+        batch_pass_count_modified += item_id in matched[total + i]
 
         log_entries.append({
             "item_id": item_id,
@@ -124,31 +126,41 @@ async def run_search_test(search_controller, metadata_col, log_file_path, method
             "found_modified": found_modified,
             "original_image_path": image_abs_path,
             "modified_image_path": modified_image_path,
-            "search_duration_original": duration_original,
-            "search_duration_modified": duration_modified,
-            "original_matched_item_ids": [r.get('item_id') for r in results],
-            "modified_matched_item_ids": [r.get('item_id') for r in modified_results],
+            "search_duration_original": service_durations[i],
+            "search_duration_modified": service_durations[total + i],
+            "original_matched_item_ids": original_matches,
+            "modified_matched_item_ids": modified_matches,
+            "batch_original_matched_item_ids": matched[i],
+            "batch_modified_matched_item_ids": matched[total + i],
         })
 
-        print(f"[{method_name}] [{idx}/{total}] Item {item_id} - Original found: {found_original}, Modified found: {found_modified} (Durations: {duration_original:.3f}s, {duration_modified:.3f}s)")
+        print(f"[{method_name}] [{i + 1}/{total}] Item {item_id} - Original found: {found_original}, Modified found: {found_modified} "
+              f"(Durations: {service_durations[i]:.3f}s, {service_durations[total + i]:.3f}s)")
 
     total_duration = time.time() - start_time
-    total_searches = total * 2  # original + modified per image
-    avg_search_duration = total_search_duration / total_searches if total_searches else 0
 
-    original_rate = (pass_count_original / total) * 100 if total else 0
-    modified_rate = (pass_count_modified / total) * 100 if total else 0
+    original_rate = (pass_count_original / total) * 100
+    modified_rate = (pass_count_modified / total) * 100
+    batch_original_rate = (batch_pass_count_original / total) * 100
+    batch_modified_rate = (batch_pass_count_modified / total) * 100
 
     print(f"\n[{method_name}] Original images pass rate: {pass_count_original}/{total} = {original_rate:.2f}%")
     print(f"[{method_name}] Modified images pass rate: {pass_count_modified}/{total} = {modified_rate:.2f}%")
-    print(f"[{method_name}] Test duration: {total_duration:.2f}s (Average search duration: {avg_search_duration:.4f}s)")
+    print(f"[{method_name}] Batch pass rates: original {batch_original_rate:.2f}%, modified {batch_modified_rate:.2f}%")
+    print(f"[{method_name}] Test duration: {total_duration:.2f}s (Average service search duration: {avg_service_duration:.4f}s; "
+          f"batch embedding: {embed_duration:.2f}s, batch search of {2 * total} queries: {search_duration:.4f}s, "
+          f"{avg_search_duration * 1000:.3f} ms/query)")
 
     with open(log_file_path, "w") as log_file:
         log_file.write(f"{method_name} Search Accuracy Test Log\n")
         log_file.write(f"Total images tested: {total}\n")
         log_file.write(f"Original images pass rate: {original_rate:.2f}%\n")
         log_file.write(f"Modified images pass rate: {modified_rate:.2f}%\n")
-        log_file.write(f"Total test duration: {total_duration:.2f}s (Average search duration: {avg_search_duration:.4f}s)\n")
+        log_file.write(f"Batch pass rates: original {batch_original_rate:.2f}%, modified {batch_modified_rate:.2f}%\n")
+        log_file.write(f"Total test duration: {total_duration:.2f}s (Average service search duration: {avg_service_duration:.4f}s)\n")
+        # All 2 * total batch queries go through one search_batch call, so only the service pass has per-image times
+        log_file.write(f"Batch embedding duration: {embed_duration:.2f}s, batch search of {2 * total} queries: "
+                       f"{search_duration:.4f}s ({avg_search_duration * 1000:.3f} ms/query average)\n")
         log_file.write("Details per image:\n")
         for entry in log_entries:
             log_file.write(json.dumps(entry) + "\n")
@@ -158,16 +170,16 @@ async def run_search_test(search_controller, metadata_col, log_file_path, method
 async def main():
     # Run CNN test
     await run_search_test(
-        search_controller=search_controller,
-        metadata_col=embedding_cnn_faiss_metadata_col,
+        service=cnn_faiss_service,
+        embed_batch=extract_embeddings_batch,
         log_file_path=os.path.join(modified_images_folder, f"{test_case_name}_cnn.log"),
         method_name="cnn_faiss"
     )
 
     # Run CLIP test
     await run_search_test(
-        search_controller=search_controller,
-        metadata_col=embedding_clip_faiss_metadata_col,
+        service=clip_faiss_service,
+        embed_batch=extract_clip_embeddings_batch,
         log_file_path=os.path.join(modified_images_folder, f"{test_case_name}_clip.log"),
         method_name="clip_faiss"
     )
@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pytest
+from app.build_checkpoint import BuildCheckpoint
+
+DIMS = {"cnn": 4}
+SIGNATURE = {"source": "products.json", "records": 10}
+
+
+@pytest.fixture(autouse=True)
+def checkpoint_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr("app.build_checkpoint.BUILD_CHECKPOINT_DIR", str(tmp_path))
+
+
+def _batch(start: int, n: int):
+    vectors = {"cnn": np.arange(start * 4, (start + n) * 4, dtype="float32").reshape(n, 4)}
+    docs = [{"image_id": f"img{i}"} for i in range(start, start + n)]
+    return vectors, docs
+
+
+def test_resume_restores_committed_rows_and_drops_uncommitted_metadata():
+    checkpoint = BuildCheckpoint("images", DIMS, SIGNATURE, capacity=10)
+    assert checkpoint.resume() == 0
+    checkpoint.commit(3, *_batch(0, 3))
+    checkpoint.commit(5, *_batch(3, 2))
+    # A killed batch that appended metadata but never committed
+    with open(checkpoint.metadata_path, "a") as f:
+        f.write('{"image_id": "partial"}\n')
+
+    resumed = BuildCheckpoint("images", DIMS, SIGNATURE, capacity=10)
+    assert resumed.resume() == 5
+    assert resumed.num_rows == 5
+    assert [doc["image_id"] for doc in resumed.metadata_docs()] == [f"img{i}" for i in range(5)]
+    np.testing.assert_array_equal(resumed.vectors("cnn"), _batch(0, 5)[0]["cnn"])
+
+    resumed.commit(7, *_batch(5, 2))
+    assert [doc["image_id"] for doc in resumed.metadata_docs()] == [f"img{i}" for i in range(7)]
+
+
+def test_resume_with_another_signature_starts_over():
+    checkpoint = BuildCheckpoint("images", DIMS, SIGNATURE, capacity=10)
+    checkpoint.resume()
+    checkpoint.commit(3, *_batch(0, 3))
+
+    changed = BuildCheckpoint("images", DIMS, {**SIGNATURE, "records": 11}, capacity=11)
+    assert changed.resume() == 0
+    assert changed.num_rows == 0
+    assert not os.path.exists(changed.metadata_path)
+
+
+def test_empty_batch_only_moves_the_offset():
+    checkpoint = BuildCheckpoint("images", DIMS, SIGNATURE, capacity=10)
+    checkpoint.resume()
+    checkpoint.commit(4, {}, [])
+
+    resumed = BuildCheckpoint("images", DIMS, SIGNATURE, capacity=10)
+    assert resumed.resume() == 4
+    assert resumed.num_rows == 0
+
+
+def test_move_vectors_publishes_only_committed_rows(tmp_path):
+    checkpoint = BuildCheckpoint("images", DIMS, SIGNATURE, capacity=10)
+    checkpoint.resume()
+    checkpoint.commit(3, *_batch(0, 3))
+    target = tmp_path / "index.vectors"
+    checkpoint.move_vectors("cnn", str(target))
+    np.testing.assert_array_equal(np.fromfile(target, dtype="float32").reshape(-1, 4), _batch(0, 3)[0]["cnn"])
@@ -0,0 +1,57 @@
+import pytest
+from app.build_manifest import ImageManifest, plan_image_build, select_records
+
+
+@pytest.fixture(autouse=True)
+def manifest_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr("app.build_manifest.BUILD_MANIFEST_DIR", str(tmp_path / "manifests"))
+
+
+def _records(images_folder, contents):
+    records = []
+    for image_id, data in contents.items():
+        (images_folder / f"{image_id}.jpg").write_bytes(data)
+        records.append({"image_id": image_id, "item_id": f"item-{image_id}", "image_path": f"{image_id}.jpg"})
+    return records
+
+
+def _manifest(name, fingerprints, model):
+    return ImageManifest(name, {image_id: {**fp, "model": model} for image_id, fp in fingerprints.items()})
+
+
+def test_full_build_embeds_everything_and_keeps_nothing(tmp_path):
+    records = _records(tmp_path, {"a": b"1", "b": b"2"})
+    todo, keep, fingerprints = plan_image_build(records, str(tmp_path), {"cnn": ImageManifest("cnn")}, {"cnn": "v1"}, False)
+    assert todo == {"a", "b"}
+    assert keep == {"cnn": []}
+    assert set(fingerprints) == {"a", "b"}
+
+
+def test_incremental_build_embeds_only_new_changed_or_outdated_images(tmp_path):
+    records = _records(tmp_path, {"a": b"1", "b": b"2", "c": b"3"})
+    _, _, fingerprints = plan_image_build(records, str(tmp_path), {"cnn": ImageManifest("cnn")}, {"cnn": "v1"}, False)
+    manifests = {
+        "cnn": _manifest("cnn", {k: fingerprints[k] for k in ("a", "b", "c")}, "v1"),
+        "clip": _manifest("clip", {k: fingerprints[k] for k in ("a", "b", "c")}, "v1"),
+    }
+    manifests["clip"].entries["c"]["model"] = "v0"
+
+    records += _records(tmp_path, {"d": b"4"})
+    _records(tmp_path, {"b": b"changed"})
+    todo, keep, fingerprints = plan_image_build(records, str(tmp_path), manifests, {"cnn": "v1", "clip": "v1"}, True)
+
+    # b changed, c is outdated for clip only, d is new: all three are embedded for every target
+    assert todo == {"b", "c", "d"}
+    assert keep == {"cnn": ["a"], "clip": ["a"]}
+    assert [r["image_id"] for r in select_records(records, todo)] == ["b", "c", "d"]
+
+
+def test_missing_files_are_neither_embedded_nor_kept(tmp_path):
+    records = _records(tmp_path, {"a": b"1"})
+    _, _, fingerprints = plan_image_build(records, str(tmp_path), {"cnn": ImageManifest("cnn")}, {"cnn": "v1"}, False)
+    manifest = _manifest("cnn", fingerprints, "v1")
+    (tmp_path / "a.jpg").unlink()
+    todo, keep, fingerprints = plan_image_build(records, str(tmp_path), {"cnn": manifest}, {"cnn": "v1"}, True)
+    assert todo == set()
+    assert keep == {"cnn": []}
+    assert fingerprints == {}
@@ -0,0 +1,35 @@
+from app.filters import FilterIndex, chroma_where, parse_filters, price_band, product_attributes
+
+
+def test_parse_filters_splits_normalizes_and_drops_empty_values():
+    values = {"category": " Rings, Earrings ,", "stone": "", "stone_color": None, "price_band": "100-250", "other": "x"}
+    assert parse_filters(values) == {"category": ["rings", "earrings"], "price_band": ["100-250"]}
+    assert parse_filters({}) == {}
+
+
+def test_chroma_where_ors_values_and_ands_filters():
+    assert chroma_where(None) is None
+    assert chroma_where({}) is None
+    assert chroma_where({"category": ["rings"]}) == {"filter_category": {"$in": ["rings"]}}
+    assert chroma_where({"category": ["rings", "earrings"], "stone": ["ruby"]}) == {
+        "$and": [
+            {"filter_category": {"$in": ["rings", "earrings"]}},
+            {"filter_stone": {"$in": ["ruby"]}},
+        ]
+    }
+
+
+def test_product_attributes_normalizes_catalog_keys():
+    metadata = {" Category": "Rings ", "stone Color": "Not Found", " Stone": "Ruby", "Price (USD)": "$1,200.50", "tags": ["a"]}
+    assert product_attributes(metadata) == {"category": "rings", "stone": "ruby", "price_band": price_band("1200.5")}
+    assert price_band("no price") is None
+
+
+def test_filter_index_matches_filtered_ids():
+    index = FilterIndex()
+    index.add([1, 2, 3], [{"category": "rings", "stone": "ruby"}, {"category": "earrings"}, {"category": "rings"}])
+    index.add([4], [{"category": "earrings", "stone": "ruby"}])
+    assert index.matching_ids({}) is None
+    assert index.matching_ids({"category": ["rings"]}).tolist() == [1, 3]
+    assert index.matching_ids({"category": ["rings", "earrings"], "stone": ["ruby"]}).tolist() == [1, 4]
+    assert index.matching_ids({"category": ["bracelets"]}).tolist() == []
@@ -0,0 +1,50 @@
+import asyncio
+from app.grouping import best_per_item, search_grouped
+
+
+def _hits(item_ids):
+    return [{"image_id": f"img{i}", "item_id": item_id, "score": 1.0 - i / 100} for i, item_id in enumerate(item_ids)]
+
+
+def test_best_per_item_keeps_first_hit_of_each_item_in_rank_order():
+    items = best_per_item(_hits(["B", "A", "B", "C", "A", "B"]), 10)
+    assert [(hit["item_id"], hit["image_id"], hit["matched_images"]) for hit in items] == [
+        ("B", "img0", 3),
+        ("A", "img1", 2),
+        ("C", "img3", 1),
+    ]
+
+
+def test_best_per_item_cuts_to_top_k_and_handles_empty_results():
+    assert [hit["item_id"] for hit in best_per_item(_hits(["B", "A", "B", "C"]), 2)] == ["B", "A"]
+    assert best_per_item([], 5) == []
+
+
+def test_best_per_item_does_not_modify_the_hits():
+    hits = _hits(["A", "A"])
+    best_per_item(hits, 1)
+    assert "matched_images" not in hits[0]
+
+
+def test_search_grouped_widens_the_scan_until_top_k_items():
+    # 10 images per item: the first fetch of top_k * overfetch hits finds too few items
+    ranked = _hits([f"item{i // 10}" for i in range(1000)])
+    fetches = []
+
+    async def fetch(n):
+        fetches.append(n)
+        return ranked[:n]
+
+    items = asyncio.run(search_grouped(fetch, 5, overfetch=4, max_fetch=500))
+    assert [hit["item_id"] for hit in items] == [f"item{i}" for i in range(5)]
+    assert fetches[0] == 20 and len(fetches) > 1 and fetches[-1] <= 500
+
+
+def test_search_grouped_stops_when_the_index_runs_out():
+    ranked = _hits(["A", "A", "B"])
+
+    async def fetch(n):
+        return ranked[:n]
+
+    items = asyncio.run(search_grouped(fetch, 5, overfetch=4, max_fetch=500))
+    assert [hit["item_id"] for hit in items] == ["A", "B"]
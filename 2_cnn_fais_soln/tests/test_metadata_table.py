@@ -0,0 +1,46 @@
+from app.metadata_table import MetadataTable
+
+
+def _doc(faiss_id, image_id, item_id):
+    return {"faiss_id": faiss_id, "image_id": image_id, "item_id": item_id, "image_path": f"{item_id}/{image_id}.jpg"}
+
+
+def _table():
+    table = MetadataTable()
+    table.add([_doc(30, "c", "Y"), _doc(10, "a", "X"), _doc(20, "b", "X")])
+    return table
+
+
+def test_resolve_keeps_search_order_and_skips_unknown_ids():
+    hits = _table().resolve([20, 99, 30], [0.9, 0.8, 0.7])
+    assert hits == [
+        {"image_id": "b", "item_id": "X", "image_path": "X/b.jpg", "score": 0.9},
+        {"image_id": "c", "item_id": "Y", "image_path": "Y/c.jpg", "score": 0.7},
+    ]
+
+
+def test_add_replaces_docs_with_the_same_faiss_id():
+    table = _table()
+    table.add([_doc(20, "b2", "Z"), _doc(40, "d", "Z"), {"image_id": "no id"}])
+    assert len(table) == 4
+    assert [hit["image_id"] for hit in table.resolve([10, 20, 30, 40], [0, 0, 0, 0])] == ["a", "b2", "c", "d"]
+    assert sorted(table.item_image_ids(["Z"]).tolist()) == [20, 40]
+    assert table.item_image_ids(["X"]).tolist() == [10]
+
+
+def test_remove_drops_ids_and_ignores_unknown_ones():
+    table = _table()
+    table.remove([10, 99])
+    assert len(table) == 2
+    assert [hit["image_id"] for hit in table.resolve([10, 20, 30], [0, 0, 0])] == ["b", "c"]
+    assert table.item_image_ids(["X", "unknown"]).tolist() == [20]
+    table.remove([20, 30])
+    assert table.resolve([20, 30], [0, 0]) == []
+
+
+def test_snapshot_taken_before_a_write_is_left_untouched():
+    table = _table()
+    (columns, strings), rows = table.rows([10])
+    table.remove([10])
+    assert columns[0].tolist() == [10, 20, 30]
+    assert rows.tolist() == [0]
@@ -0,0 +1,116 @@
+import os
+import json
+import subprocess
+import sys
+import numpy as np
+import pytest
+from app.search import faiss_id, faiss_ids, iter_json_array
+
+ARRAYS = [
+    [],
+    [1, 2.5],
+    [1.5e10],
+    [-0.25, 3e-7, 10, 0],
+    [True, False, None, "x"],
+    [{"image_id": "A1", "item_id": "A", "image_path": "a/1.jpg"}, {"nested": [1, [2, {"k": "v, ]"}]]}],
+    ["comma, inside", "bracket ] inside", "escaped \" quote", "unicode é"],
+]
+
+
+@pytest.mark.parametrize("values", ARRAYS)
+@pytest.mark.parametrize("indent", [None, 2])
+def test_iter_json_array_matches_json_load_for_every_chunk_size(tmp_path, values, indent):
+    path = tmp_path / "array.json"
+    path.write_text(json.dumps(values, indent=indent))
+    expected = json.loads(path.read_text())
+    for chunk_size in range(1, len(path.read_text()) + 2):
+        assert list(iter_json_array(str(path), chunk_size)) == expected, chunk_size
+
+
+def test_iter_json_array_leading_whitespace_longer_than_a_chunk(tmp_path):
+    path = tmp_path / "array.json"
+    path.write_text("\n" * 50 + "  [1, 2]")
+    assert list(iter_json_array(str(path), 4)) == [1, 2]
+
+
+@pytest.mark.parametrize("text", ['{"a": 1}', "[1, 2", "[1, 2x]", ""])
+@pytest.mark.parametrize("chunk_size", [1, 3, 1 << 16])
+def test_iter_json_array_rejects_invalid_files(tmp_path, text, chunk_size):
+    path = tmp_path / "array.json"
+    path.write_text(text)
+    with pytest.raises(ValueError):
+        list(iter_json_array(str(path), chunk_size))
+
+
+def test_faiss_id_is_a_fixed_63_bit_value_per_key():
+    # Pinned: ids are stored in built indexes and Mongo, they must never change between releases
+    assert faiss_id("A1") == 4174901949837708437
+    assert faiss_id("item-42") == 7644857031153300749
+    assert faiss_id(42) == faiss_id("42")
+    ids = [faiss_id(f"img{i}") for i in range(10000)]
+    assert len(set(ids)) == len(ids)
+    assert all(0 <= i < 1 << 63 for i in ids)
+
+
+def test_faiss_id_does_not_depend_on_the_process():
+    # str hashing is salted per process (PYTHONHASHSEED); faiss_id must not be
+    code = "from app.search import faiss_id; print(faiss_id('A1'))"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                         env={**os.environ, "PYTHONHASHSEED": "random"}, cwd=root)
+    assert int(out.stdout.split()[-1]) == faiss_id("A1")
+
+
+def test_faiss_ids_matches_faiss_id():
+    keys = ["A1", "B2", 3]
+    np.testing.assert_array_equal(faiss_ids(keys), np.array([faiss_id(k) for k in keys], dtype="int64"))
+
+
+def _ivfdata_files(folder):
+    return sorted(name for name in os.listdir(folder) if name.endswith(".ivfdata"))
+
+
+def test_adds_after_a_non_mmap_load_never_touch_the_published_ivfdata(tmp_path):
+    import faiss
+    from app.search import load_index, save_index
+
+    rng = np.random.default_rng(0)
+    vectors = rng.random((200, 8), dtype="float32")
+    index = faiss.IndexIVFFlat(faiss.IndexFlatL2(8), 8, 4)
+    index.train(vectors)
+    index.add(vectors[:100])
+    index_path = str(tmp_path / "index.faiss")
+    save_index(index, index_path, mmap=True)
+    [published] = _ivfdata_files(tmp_path)
+    published_bytes = (tmp_path / published).read_bytes()
+    reader = load_index(index_path, mmap=True)
+
+    writer = load_index(index_path, mmap=False)
+    writer.add(vectors[100:])
+    assert (tmp_path / published).read_bytes() == published_bytes
+    assert reader.ntotal == 100
+    np.testing.assert_array_equal(reader.search(vectors[:5], 1)[1].ravel(), np.arange(5))
+
+    save_index(writer, index_path, mmap=True)
+    [rotated] = _ivfdata_files(tmp_path)
+    assert rotated != published
+    reloaded = load_index(index_path, mmap=True)
+    assert reloaded.ntotal == 200
+    np.testing.assert_array_equal(reloaded.search(vectors[150:155], 1)[1].ravel(), np.arange(150, 155))
+
+
+def test_saving_an_index_with_ondisk_lists_rotates_its_ivfdata(tmp_path):
+    import faiss
+    from app.search import load_index, save_index
+
+    vectors = np.random.default_rng(1).random((50, 8), dtype="float32")
+    index = faiss.IndexIVFFlat(faiss.IndexFlatL2(8), 8, 2)
+    index.train(vectors)
+    index.add(vectors)
+    index_path = str(tmp_path / "index.faiss")
+    save_index(index, index_path, mmap=True)
+    [first] = _ivfdata_files(tmp_path)
+    save_index(load_index(index_path, mmap=True), index_path, mmap=True)
+    [second] = _ivfdata_files(tmp_path)
+    assert second != first
+    assert load_index(index_path, mmap=True).ntotal == 50
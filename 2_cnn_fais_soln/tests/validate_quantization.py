@@ -0,0 +1,86 @@
+import os
+import sys
+import json
+import random
+import numpy as np
+from app.config import (
+    IMAGE_PATHS_JSON,
+    SHOE_IMAGES_FOLDER,
+    FAISS_INDEX_PATH,
+    CLIP_FAISS_INDEX_PATH,
+    INFERENCE_BACKEND,
+    EMBEDDING_BATCH_SIZE,
+)
+from app.data_loading import load_batch_images
+from app.model import load_model, extract_embeddings_batch, extract_clip_embeddings_batch
+from app.search import load_index
+
+# Checks whether MODEL_PRECISION=int8 is safe to deploy:
+# re-embeds a sample of the catalog with fp32 and int8 encoders and reports
+# - cosine drift (1 - cos) between fp32 and int8 embeddings of the same image
+# - top-k overlap between fp32-query and int8-query results on the fp32 index
+# Usage: python -m tests.validate_quantization [sample_size] [top_k]
+
+MIN_TOPK_OVERLAP = 0.9
+LOG_FILE_PATH = "quantization_validation.log"
+
+
+def sample_images(sample_size):
+    with open(IMAGE_PATHS_JSON, "r") as f:
+        records = json.load(f)
+    random.seed(0)
+    sampled = random.sample(records, min(sample_size, len(records)))
+    images, _ = load_batch_images(sampled, SHOE_IMAGES_FOLDER)
+    return images
+
+
+def validate(label, model_name, embed, index_path, images, top_k):
+    fp32 = embed(images, EMBEDDING_BATCH_SIZE, load_model(model_name, INFERENCE_BACKEND, "fp32"))
+    int8 = embed(images, EMBEDDING_BATCH_SIZE, load_model(model_name, INFERENCE_BACKEND, "int8"))
+
+    drift = 1.0 - np.sum(fp32 * int8, axis=1)
+
+    index = load_index(index_path)
+    _, fp32_ids = index.search(fp32, top_k)
+    _, int8_ids = index.search(int8, top_k)
+    overlap = np.array([len(set(a) & set(b)) / top_k for a, b in zip(fp32_ids, int8_ids)])
+
+    ok = overlap.mean() >= MIN_TOPK_OVERLAP
+    lines = [
+        f"[{label}] images: {len(images)}, backend: {INFERENCE_BACKEND}",
+        f"[{label}] cosine drift mean={drift.mean():.5f} p95={np.percentile(drift, 95):.5f} max={drift.max():.5f}",
+        f"[{label}] top-{top_k} overlap mean={overlap.mean():.3f} min={overlap.min():.3f} -> {'OK' if ok else 'FAIL'}",
+    ]
+    for line in lines:
+        print(line)
+    return lines, ok
+
+
+def main():
+    sample_size = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    top_k = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    images = sample_images(sample_size)
+
+    all_lines = []
+    all_ok = True
+    for label, model_name, embed, index_path in [
+        ("cnn", "cnn", extract_embeddings_batch, FAISS_INDEX_PATH),
+        ("clip", "clip", extract_clip_embeddings_batch, CLIP_FAISS_INDEX_PATH),
+    ]:
+        if not index_path or not os.path.exists(index_path):
+            print(f"[{label}] fp32 index not found at {index_path}, skipping")
+            continue
+        lines, ok = validate(label, model_name, embed, index_path, images, top_k)
+        all_lines.extend(lines)
+        all_ok = all_ok and ok
+
+    with open(LOG_FILE_PATH, "w") as log_file:
+        log_file.write("\n".join(all_lines) + "\n")
+    print(f"Validation log saved to {LOG_FILE_PATH}")
+
+    if not all_ok:
+        raise SystemExit(f"int8 top-{top_k} overlap below {MIN_TOPK_OVERLAP}, keep MODEL_PRECISION=fp32")
+
+
+if __name__ == "__main__":
+    main()